@@ -0,0 +1,158 @@
+# 1プロセスで同時に開いておけるチャット（ストリーミング）の数を比較する
+#   threads: Flask をスレッドプール（WSGI）だけで動かす。LLM の応答を待つ間もスレッドを1つ占有する
+#   asgi:    asgi.py（/save_chat をイベントループで処理し、それ以外は同じ数のスレッドで Flask を動かす）
+# どちらも uvicorn の1プロセスで起動し、スレッド数は同じにする
+# チャットを一斉に送り、応答を受信中のチャット数の最大値と、最初のトークンまでの時間、
+# その間の別の画面（/login）の応答時間を表示する
+#
+#   python bench_async_serving.py --chats 100 --threads 10 --completion-latency 2
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common import CHACHAT_DIR, Client, free_port, summarize, stub_env, wait_for_http
+from load_test import QUESTIONS, Stages, login_author, prepare_user, upload_document
+from pdfgen import make_pdf
+from stub_openai import StubConfig, start_stub_server
+
+THREADS_APP = (
+    'import sys; sys.path.insert(0, %r)\n'
+    'import uvicorn\n'
+    'from uvicorn.middleware.wsgi import WSGIMiddleware\n'
+    'from app import app, init_app\n'
+    'init_app()\n'
+    'uvicorn.run(WSGIMiddleware(app, workers=%d), host="127.0.0.1", port=%d, log_level="warning", lifespan="off")\n'
+)
+
+
+def spawn(mode, env, port, threads):
+    if mode == 'threads':
+        args = ['-c', THREADS_APP % (os.path.abspath(CHACHAT_DIR), threads, port)]
+    else:
+        args = ['-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+    env = dict(env, CHACHAT_ASGI_THREADS=str(threads))
+    proc = subprocess.Popen([sys.executable, *args], cwd=CHACHAT_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wait_for_http(f'http://127.0.0.1:{port}/login', proc)
+    return proc
+
+
+def stream_chat(client, question):
+    # (最初のトークンを受け取った時刻, 終了時刻) を返す
+    first = None
+    with client.post_json('/save_chat', {'content': question, 'is_user_message': True, 'stream': True}) as response:
+        for line in response:
+            if not line.startswith(b'data: '):
+                continue
+            event = json.loads(line[len('data: '):])
+            if event.get('token') and first is None:
+                first = time.perf_counter()
+            if event.get('status') == 'error':
+                raise RuntimeError(event.get('message'))
+    return first, time.perf_counter()
+
+
+def max_open(intervals):
+    # 同時に応答を受信していたチャット数の最大値
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    current = peak = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    return peak
+
+
+def run(mode, args, stub_url):
+    instance_path = tempfile.mkdtemp(prefix=f'chachat-{mode}-')
+    port = free_port()
+    proc = spawn(mode, stub_env(stub_url, instance_path), port, args.threads)
+    base_url = f'http://127.0.0.1:{port}'
+    stages = Stages()
+    run_id = uuid.uuid4().hex[:8]
+    try:
+        author = login_author(base_url, stages, run_id)
+        upload_document(author, stages, make_pdf(args.pages), 'benchmark')
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            clients = list(pool.map(lambda i: prepare_user(base_url, stages, run_id, i, '1'), range(args.chats)))
+
+        intervals = []
+        first_token = []
+        errors = []
+        probes = []
+        done = threading.Event()
+
+        def chat(index):
+            # 回答キャッシュに当たらないよう、チャットごとに質問を変える
+            question = f'{QUESTIONS[index % len(QUESTIONS)]} ({run_id}-{index})'
+            start = time.perf_counter()
+            try:
+                first, end = stream_chat(clients[index], question)
+            except Exception as e:
+                errors.append(e)
+                return
+            intervals.append((first, end))
+            first_token.append(first - start)
+
+        def probe():
+            client = Client(base_url)
+            while not done.is_set():
+                start = time.perf_counter()
+                client.get('/login')
+                probes.append(time.perf_counter() - start)
+                time.sleep(0.1)
+
+        prober = threading.Thread(target=probe)
+        start = time.perf_counter()
+        prober.start()
+        with ThreadPoolExecutor(max_workers=args.chats) as pool:
+            list(pool.map(chat, range(args.chats)))
+        wall = time.perf_counter() - start
+        done.set()
+        prober.join()
+
+        ttft = summarize(first_token)
+        login = summarize(probes)
+        print(f'  {mode:<9}{args.chats:>6}{len(errors):>8}{max_open(intervals):>10}{ttft["p50"]:>10.2f}'
+              f'{ttft["p99"]:>10.2f}{wall:>9.2f}{login["p99"] * 1000:>14.1f}')
+        if errors:
+            print(f'    first error: {errors[0]}')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='スレッド（WSGI）と非同期（ASGI）で同時に開けるチャット数を比較する')
+    parser.add_argument('--chats', type=int, default=100, help='同時に送るチャットの数')
+    parser.add_argument('--threads', type=int, default=10, help='アプリのスレッド数（両方のモードで同じ）')
+    parser.add_argument('--pages', type=int, default=5, help='アップロードする生成PDFのページ数')
+    parser.add_argument('--completion-latency', type=float, default=2.0)
+    parser.add_argument('--token-latency', type=float, default=0.05)
+    parser.add_argument('--modes', nargs='+', default=['threads', 'asgi'], choices=['threads', 'asgi'])
+    args = parser.parse_args()
+
+    stub, _ = start_stub_server(config=StubConfig(
+        completion_latency=args.completion_latency,
+        token_latency=args.token_latency,
+    ))
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}/v1'
+    print(f'threads={args.threads}  completion latency={args.completion_latency}s  '
+          f'token latency={args.token_latency}s')
+    print(f'  {"mode":<9}{"chats":>6}{"errors":>8}{"max open":>10}{"ttft p50":>10}{"ttft p99":>10}'
+          f'{"wall s":>9}{"/login p99 ms":>14}')
+    try:
+        for mode in args.modes:
+            run(mode, args, stub_url)
+    finally:
+        stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# 1つのチャットで質問を続けたときの、回答のプロンプトのトークン数と LLM の応答時間を比較する
+#   none:   変更前と同じく会話の履歴を入れない（続きの質問に答えられない）
+#   full:   それまでの会話をすべてプロンプトに入れる
+#   budget: 会話の要約と直近の会話を CHAT_HISTORY_TOKEN_BUDGET に収めて入れる（要約は回答の後に少しずつ進める）
+# スタブの LLM はプロンプトの長さに比例して遅くなる（--prompt-token-latency）
+# 要約の呼び出し回数と要約に渡したトークン数は、毎回会話全体を要約し直す場合とも比べる
+#
+#   python bench_chat_history.py --turns 100 --budget 1024
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from common import CHACHAT_DIR, summarize
+from stub_openai import StubConfig, start_stub_server
+
+QUESTIONS = ['副業をしている人の割合はどれくらいですか', 'その理由として多いものは何ですか',
+             '前回の調査と比べてどう変わりましたか', '在宅勤務との関係について教えてください',
+             '年代による違いはありますか', 'さきほどの数値をもう一度まとめてください']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='長いチャットでのプロンプトの大きさと応答時間を比較する')
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--budget', type=int, default=1024, help='CHAT_HISTORY_TOKEN_BUDGET')
+    parser.add_argument('--answer-tokens', type=int, default=80, help='スタブの回答のトークン数')
+    parser.add_argument('--completion-latency', type=float, default=0.05)
+    parser.add_argument('--prompt-token-latency', type=float, default=0.0002, help='プロンプトの1トークンあたりの遅延（秒）')
+    parser.add_argument('--report-every', type=int, default=20)
+    args = parser.parse_args()
+
+    config = StubConfig(embedding_latency=0.0, completion_latency=args.completion_latency, token_latency=0.0,
+                        answer_tokens=args.answer_tokens, prompt_token_latency=args.prompt_token_latency)
+    server, _ = start_stub_server(config=config)
+    os.environ.update({
+        'OPENAI_API_BASE': f'http://127.0.0.1:{server.server_address[1]}/v1',
+        'OPENAI_API_KEY': 'sk-stub',
+        'CHACHAT_INSTANCE_PATH': tempfile.mkdtemp(prefix='bench-history-'),
+        'CHACHAT_VECTOR_STORE': 'numpy',
+        'CHACHAT_HISTORY_TOKEN_BUDGET': str(args.budget),
+    })
+    sys.path.insert(0, CHACHAT_DIR)
+    import app as chachat
+    from app import Chat, Data, Group, User, app, create_tables, db
+    from chat_memory import assemble_history, count_tokens, message_tokens
+
+    create_tables()
+    with app.app_context():
+        group = Group(unique_code='bench001', mail='bench@example.com', name='bench', password_hash='x')
+        user = User(unique_id='benchuser1', mail='user@example.com', name='user', group_code='1', password_hash='x')
+        db.session.add_all([group, user])
+        data = Data(group.unique_code, 'survey.pdf', '', 'survey')
+        db.session.add(data)
+        db.session.commit()
+        pages = [f'問{i}「副業の有無」では、{i % 90 + 5}.{i % 10}％が「ある」と回答した。' * 10 for i in range(50)]
+        chachat.add_data_to_group_index(data, iter(pages))
+
+    def load_history(mode, chat_session):
+        if mode == 'none':
+            return None
+        if mode == 'budget':
+            return chachat.load_prompt_history(chat_session)
+        chats = (db.session.query(Chat.is_user_message, Chat.content)
+                 .filter_by(user_unique_id=chat_session.user_unique_id, chat_page_index=chat_session.chat_page_index)
+                 .order_by(Chat.id).all())
+        return assemble_history('', [tuple(chat) for chat in chats], 10 ** 9)
+
+    results = {}
+    for page, mode in enumerate(('none', 'full', 'budget')):
+        rows = []
+        summary_calls = config.counts['completions']
+        for turn in range(1, args.turns + 1):
+            query = f'{QUESTIONS[turn % len(QUESTIONS)]}（{turn}）'
+            with app.app_context():
+                chat_session = (chachat.get_chat_session('benchuser1', page)
+                                or chachat.add_chat_session('benchuser1', page))
+                start = time.perf_counter()
+                history = load_history(mode, chat_session)
+                history_time = time.perf_counter() - start
+                prompt = chachat.build_answer_prompt('bench001', query, history=history)
+                start = time.perf_counter()
+                answer = chachat.get_llm().invoke(prompt).strip()
+                llm_time = time.perf_counter() - start
+                user_chat = Chat('benchuser1', query, page, True)
+                if mode == 'budget':
+                    chachat.save_chat_turn(user_chat, answer, history)
+                else:
+                    chachat.save_chats(user_chat, chachat.make_bot_chat(user_chat, answer))
+            chachat.get_chat_log().flush()
+            # 要約は回答の後にバックグラウンドで作る（次の質問の前に終わるのを待つ）
+            chachat.summary_executor.submit(lambda: None).result()
+            rows.append((count_tokens(prompt), history_time, llm_time,
+                         message_tokens(True, query) + message_tokens(False, answer)))
+        summary_calls = config.counts['completions'] - summary_calls - args.turns
+        results[mode] = (rows, summary_calls)
+
+    print(f'turns: {args.turns}  budget: {args.budget} tokens  '
+          f'prompt latency: {args.prompt_token_latency * 1000:.2f} ms/token')
+    print(f'  {"turn":>6}' + ''.join(f'{mode + " tok":>12}{mode + " ms":>12}' for mode in results))
+    for end in range(args.report_every, args.turns + 1, args.report_every):
+        line = f'  {end:>6}'
+        for rows, _ in results.values():
+            window = rows[end - args.report_every:end]
+            line += f'{window[-1][0]:>12}{summarize([row[2] for row in window])["p50"] * 1000:>12.0f}'
+        print(line)
+    for mode, (rows, summary_calls) in results.items():
+        history = summarize([row[1] for row in rows])
+        print(f'  {mode:<8} max prompt: {max(row[0] for row in rows)} tokens  '
+              f'history p50: {history["p50"] * 1000:.1f} ms  p99: {history["p99"] * 1000:.1f} ms')
+
+    # 毎回会話全体を要約し直す場合に要約へ渡すトークン数（各回の時点での会話全体の合計）
+    rows, summary_calls = results['budget']
+    turn_tokens = [row[3] for row in rows]
+    recompute = sum(sum(turn_tokens[:i + 1]) for i in range(len(turn_tokens)))
+    stats = chachat.summary_stats
+    print(f'  summaries: {summary_calls} calls ({stats["summarized_messages"]} messages folded, '
+          f'{stats["time"]:.1f}s in background)  recompute every turn: {len(rows)} calls, '
+          f'{recompute} input tokens vs {sum(turn_tokens)} folding each message once')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
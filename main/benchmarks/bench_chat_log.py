@@ -0,0 +1,82 @@
+# チャットの保存にかかる時間（リクエストのスレッドから見た時間）を比較する
+#   sync:   質問と回答をその場でコミットする（変更前の save_chats）
+#   queued: WriteBehindQueue に入れ、バックグラウンドでまとめて書き込む（現在の save_chats）
+#
+#   python bench_chat_log.py --threads 8 --saves 200
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from common import CHACHAT_DIR, print_table
+
+work_dir = tempfile.mkdtemp(prefix='bench-chat-log-')
+os.environ['CHACHAT_INSTANCE_PATH'] = work_dir
+sys.path.insert(0, CHACHAT_DIR)
+from app import Chat, app, db, get_chat_log, save_chats  # noqa: E402
+
+
+def sync_save(*chats):
+    with app.app_context():
+        db.session.add_all(chats)
+        db.session.commit()
+
+
+def run(name, save, args, stages):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(index):
+        user = f'u{index:08d}'
+        answer = 'あ' * args.answer_size
+        local = []
+        for i in range(args.saves):
+            chats = (Chat(user, f'question {i}', 0, True), Chat(user, answer, 0, False))
+            start = time.perf_counter()
+            save(*chats)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    request_wall = time.perf_counter() - start
+    if name == 'queued':
+        get_chat_log().flush()
+    wall = time.perf_counter() - start
+    stages[name] = latencies
+    print(f'  {name:<8} saves={len(latencies)}  request side {len(latencies) / request_wall:.0f}/s  '
+          f'until written {len(latencies) / wall:.0f}/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='チャット保存のレイテンシを比較する')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--saves', type=int, default=200, help='1スレッドあたりの保存回数（質問と回答の組）')
+    parser.add_argument('--answer-size', type=int, default=400)
+    args = parser.parse_args()
+
+    try:
+        with app.app_context():
+            db.create_all()
+        stages = {}
+        run('sync', sync_save, args, stages)
+        run('queued', save_chats, args, stages)
+        print_table('save_chats latency', stages)
+        with app.app_context():
+            print(f'\nrows: {Chat.query.count()} (expected {args.threads * args.saves * 2 * 2})')
+        print(f'chat_log: {get_chat_log().stats()}')
+    finally:
+        get_chat_log().close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# CharacterTextSplitter(chunk_size=100) と SentenceTokenSplitter の比較
+# チャンク数・埋め込みの呼び出し回数・検索レイテンシを表示する
+#
+#   python bench_chunker.py --pdf ~/FreelanceSurvey2023.pdf
+import argparse
+import io
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pypdf import PdfReader
+
+from common import CHACHAT_DIR, print_table
+from pdfgen import make_pdf
+from stub_openai import stub_vector
+
+sys.path.insert(0, CHACHAT_DIR)
+from chunker import SentenceTokenSplitter  # noqa: E402
+from langchain.text_splitter import CharacterTextSplitter  # noqa: E402
+from numpy_store import NumpyVectorStore  # noqa: E402
+
+REPO_DIR = os.path.join(CHACHAT_DIR, '..', '..')
+DEFAULT_TEXTS = [
+    os.path.join(REPO_DIR, 'itou_teruki', 'sample.txt'),
+    os.path.join(REPO_DIR, 'itou_teruki', 'qa01.txt'),
+]
+QUERIES = ['主食・主菜・副菜について教えて', 'フリーランスのリモートワークの実態', 'remote work survey result']
+
+
+class StubEmbeddings:
+    # スタブサーバーと同じ決定的なベクトルを返し、呼び出し回数を数える
+    def __init__(self, dims):
+        self.dims = dims
+        self.inputs = 0
+
+    def embed_documents(self, texts):
+        self.inputs += len(texts)
+        return [stub_vector(text, self.dims) for text in texts]
+
+    def embed_query(self, text):
+        return stub_vector(text, self.dims)
+
+
+def old_splitter():
+    return CharacterTextSplitter(separator="\n", chunk_size=100, chunk_overlap=0, length_function=len)
+
+
+def measure(name, pages, make_docs, args, stages):
+    token_counter = SentenceTokenSplitter()
+    start = time.perf_counter()
+    docs = make_docs(pages)
+    split_time = time.perf_counter() - start
+
+    embeddings = StubEmbeddings(args.dims)
+    directory = tempfile.mkdtemp(prefix='bench-chunker-')
+    try:
+        store = NumpyVectorStore(persist_directory=directory, embedding_function=embeddings)
+        start = time.perf_counter()
+        store.add_documents(docs)
+        index_time = time.perf_counter() - start
+
+        latencies = []
+        for i in range(args.queries):
+            query_start = time.perf_counter()
+            store.similarity_search(QUERIES[i % len(QUERIES)])
+            latencies.append(time.perf_counter() - query_start)
+        stages[name] = latencies
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    tokens = [token_counter.count_tokens(doc.page_content) for doc in docs]
+    print(f'  {name:<10} chunks={len(docs):>6}  avg tokens={sum(tokens) / max(len(docs), 1):>6.1f}  '
+          f'embedded texts={embeddings.inputs:>6}  embedding requests={math.ceil(embeddings.inputs / args.batch):>4}  '
+          f'split={split_time * 1000:.1f}ms  index={index_time * 1000:.1f}ms')
+
+
+def run(label, pages, args):
+    print(f'\n{label}: {len(pages)} page(s), {sum(len(p) for p in pages)} chars')
+    stages = {}
+    new = SentenceTokenSplitter(chunk_size=args.chunk_tokens, chunk_overlap=args.overlap_tokens)
+    # 変更前はページを連結してから100文字ごとに分割していた
+    measure('before', pages, lambda p: old_splitter().create_documents(['\n'.join(p)]), args, stages)
+    measure('after', pages, lambda p: new.create_documents(p), args, stages)
+    print_table(f'retrieval latency ({label})', stages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='チャンク分割の比較')
+    parser.add_argument('--text', nargs='*', default=DEFAULT_TEXTS, help='テキストファイル')
+    parser.add_argument('--pdf', help='PDFファイル（省略時は生成したPDFを使う）')
+    parser.add_argument('--pages', type=int, default=50, help='生成するPDFのページ数')
+    parser.add_argument('--chunk-tokens', type=int, default=256)
+    parser.add_argument('--overlap-tokens', type=int, default=32)
+    parser.add_argument('--batch', type=int, default=64, help='埋め込み1リクエストあたりのテキスト数')
+    parser.add_argument('--dims', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args()
+
+    for path in args.text:
+        text = open(path, encoding='utf-8').read()
+        if not text.strip():
+            print(f'\n{path}: empty, skipped')
+            continue
+        run(os.path.basename(path), [text], args)
+
+    if args.pdf:
+        reader = PdfReader(args.pdf)
+        label = os.path.basename(args.pdf)
+    else:
+        reader = PdfReader(io.BytesIO(make_pdf(args.pages)))
+        label = f'generated {args.pages}-page PDF'
+    run(label, [page.extract_text() for page in reader.pages], args)
@@ -0,0 +1,127 @@
+# 回答に使うチャンクの検索を、変更前（毎回質問を埋め込んでベクトルの近傍検索だけを行う）と
+# 語句の一致（BM25）とベクトルの近傍検索を RRF でまとめる現在の検索で比較する
+#   quote:      資料の設問名や数値をそのまま含む質問（語句だけで検索できれば埋め込みを省く）
+#   paraphrase: 資料と言い回しの違う質問（語句とベクトルの両方で検索する）
+# 質問ごとの検索時間・埋め込みの呼び出し回数・正解のチャンクが上位に入った割合を表示する
+# スタブのベクトルには意味が無いので、正解率は語句の一致の効果だけを表す
+#
+#   python bench_hybrid_retrieval.py --pages 200 --queries 200 --embedding-latency 0.1
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from common import CHACHAT_DIR, summarize
+from stub_openai import StubConfig, start_stub_server
+
+TOPICS = ['副業', '在宅勤務', '収入', '契約単価', '労働時間', '取引先', 'スキル', '案件', '確定申告', '社会保険',
+          '報酬', '発注者', '働き方', '満足度', '開業', '通勤', '育児', '介護', '健康診断', '研修']
+ASPECTS = ['の有無', 'の変化', 'の理由', 'の満足度', 'の平均', 'の課題', 'の見通し', 'の割合', 'の手段', 'の頻度']
+ANSWERS = ['増えた', '減った', '変わらない', 'わからない', '満足', '不満', 'ある', 'ない']
+PARAPHRASES = ['家で仕事をする人はどれくらいいますか', 'お金の面で困っていることは何ですか',
+               '仕事の満足度は高いですか', '去年と比べて何が変わりましたか', '仕事をどこで見つけていますか']
+
+
+def make_pages(pages, items_per_page, seed=0):
+    # 設問ごとに「設問名・割合・回答」を書いた調査報告のようなページと、設問の一覧を作る
+    rng = random.Random(seed)
+    texts = []
+    items = []
+    for page_no in range(pages):
+        lines = []
+        for i in range(items_per_page):
+            number = page_no * items_per_page + i + 1
+            name = f'{rng.choice(TOPICS)}{rng.choice(ASPECTS)}'
+            percent = rng.randint(1, 99)
+            line = (f'問{number}「{name}」では、{percent}.{rng.randint(0, 9)}％が「{rng.choice(ANSWERS)}」と回答した。'
+                    f'前回の調査から{rng.randint(1, 20)}ポイント{rng.choice(["上昇", "低下"])}している。')
+            lines.append(line)
+            items.append((number, name, line))
+        texts.append('\n'.join(lines))
+    return texts, items
+
+
+def make_queries(items, count, seed=1):
+    rng = random.Random(seed)
+    quotes = []
+    for number, name, line in rng.sample(items, min(count, len(items))):
+        quotes.append((f'問{number}「{name}」の結果を教えて', line))
+    paraphrases = [(rng.choice(PARAPHRASES) + f'（{i}）', None) for i in range(count)]
+    return quotes, paraphrases
+
+
+def main():
+    parser = argparse.ArgumentParser(description='語句とベクトルの検索を比較する')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--items-per-page', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--embedding-latency', type=float, default=0.1, help='スタブの埋め込みの応答時間（秒）')
+    parser.add_argument('--vector-store', default='numpy', choices=['numpy', 'chroma'])
+    args = parser.parse_args()
+
+    config = StubConfig(embedding_latency=args.embedding_latency)
+    server, _ = start_stub_server(config=config)
+    os.environ.update({
+        'OPENAI_API_BASE': f'http://127.0.0.1:{server.server_address[1]}/v1',
+        'OPENAI_API_KEY': 'sk-stub',
+        'CHACHAT_INSTANCE_PATH': tempfile.mkdtemp(prefix='bench-hybrid-'),
+        'CHACHAT_VECTOR_STORE': args.vector_store,
+    })
+    sys.path.insert(0, CHACHAT_DIR)
+    import app as chachat
+    from app import Data, Group, app, create_tables, db
+
+    create_tables()
+    texts, items = make_pages(args.pages, args.items_per_page)
+    quotes, paraphrases = make_queries(items, args.queries)
+    with app.app_context():
+        group = Group(unique_code='bench001', mail='bench@example.com', name='bench', password_hash='x')
+        db.session.add(group)
+        data = Data(group.unique_code, 'survey.pdf', '\n'.join(texts), 'survey')
+        db.session.add(data)
+        db.session.commit()
+        start = time.perf_counter()
+        chachat.add_data_to_group_index(data, iter(texts))
+        ingest = time.perf_counter() - start
+        lexical = chachat.load_lexical_index(group.unique_code)
+        print(f'pages: {args.pages}  chunks: {lexical.stats()["chunks"]}  ingest: {ingest:.1f}s  '
+              f'lexical index: {lexical.stats()}  embedding latency: {args.embedding_latency}s')
+
+        # 同じ質問を2回（変更前・現在）検索するので、埋め込みキャッシュを通さずに毎回スタブに問い合わせる
+        uncached = chachat.get_embeddings().underlying
+        chachat.get_embeddings = lambda: uncached
+
+        def before(query):
+            query_vector = uncached.embed_query(query)
+            docs = chachat.load_group_index(group.unique_code).similarity_search_by_vector(query_vector)
+            return chachat.load_chunk_texts([doc.metadata['chunk_id'] for doc in docs], {})
+
+        def after(query):
+            _, query_vector, _, lexical = chachat.lookup_cached_answer(group.unique_code, query)
+            return chachat.retrieve_chunk_texts(group.unique_code, query, query_vector, lexical)
+
+        print(f'  {"queries":<12}{"mode":<8}{"p50 ms":>9}{"p99 ms":>9}{"embed/q":>9}{"found":>8}')
+        for label, queries in (('quote', quotes), ('paraphrase', paraphrases)):
+            for mode, retrieve in (('before', before), ('after', after)):
+                before_count = config.counts['embedding_inputs']
+                latencies = []
+                found = 0
+                for query, expected in queries:
+                    start = time.perf_counter()
+                    chunks = retrieve(query)
+                    latencies.append(time.perf_counter() - start)
+                    if expected is not None and any(expected in chunk for chunk in chunks):
+                        found += 1
+                s = summarize(latencies)
+                embedded = (config.counts['embedding_inputs'] - before_count) / len(queries)
+                found_rate = f'{found / len(queries):.0%}' if label == 'quote' else '-'
+                print(f'  {label:<12}{mode:<8}{s["p50"] * 1000:>9.1f}{s["p99"] * 1000:>9.1f}{embedded:>9.2f}'
+                      f'{found_rate:>8}')
+        print(f'  retrieval: {chachat.retrieval_stats}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# チャットのたびに行うユーザーとグループの解決（load_user → グループ → データの有無）の
+# SQL の数と時間を、変更前（毎回データベースを引く）と identity_cache を使う場合で比較する
+#
+#   python bench_identity_cache.py --threads 8 --lookups 2000
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from common import CHACHAT_DIR, summarize
+
+os.environ.setdefault('CHACHAT_INSTANCE_PATH', tempfile.mkdtemp(prefix='bench-identity-'))
+sys.path.insert(0, CHACHAT_DIR)
+from flask import session  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app import (Data, Group, User, app, create_tables, db, identity_cache, load_user,  # noqa: E402
+                 resolve_chat_group)
+
+statements = 0
+statements_lock = threading.Lock()
+
+
+def count_statement(*args):
+    global statements
+    with statements_lock:
+        statements += 1
+
+
+def before(user_id):
+    # 変更前の load_user と save_chat の処理
+    user = User.query.get(int(user_id))
+    group = Group.query.filter_by(id=user.group_code).first()
+    has_data = group is not None and db.session.query(Data.id).filter_by(group_unique_id=group.unique_code).first()
+    return group.unique_code if has_data else None
+
+
+def after(user_id):
+    user = load_user(user_id)
+    return resolve_chat_group(user.group_code)
+
+
+def run(label, resolve, user_ids, args):
+    global statements
+    statements = 0
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(index):
+        user_id = user_ids[index % len(user_ids)]
+        local = []
+        for _ in range(args.lookups):
+            # リクエストごとに新しいコンテキスト（セッション）になるのと同じにする
+            with app.test_request_context():
+                session['user_type'] = 'user'
+                start = time.perf_counter()
+                if resolve(user_id) is None:
+                    raise RuntimeError('group was not resolved')
+                local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    s = summarize(latencies)
+    print(f'  {label:<8}{len(latencies) / wall:>12.0f}/s{s["p50"] * 1e6:>10.0f}{s["p99"] * 1e6:>10.0f}'
+          f'{statements / len(latencies):>12.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ユーザーとグループの解決を比較する')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--lookups', type=int, default=2000, help='1スレッドあたりの回数')
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    create_tables()
+    with app.app_context():
+        group = Group.create_new_group(f'bench-{time.time()}@example.com', 'password', 'bench')
+        db.session.add(Data(group.unique_code, 'bench.pdf', 'content', 'bench'))
+        user_ids = []
+        for i in range(args.users):
+            user = User(unique_id=f'u{time.time_ns() % 10 ** 9:09d}', mail=f'bench-{time.time_ns()}@example.com',
+                        password_hash='x', name=f'user{i}', group_code=str(group.id))
+            db.session.add(user)
+            db.session.flush()
+            user_ids.append(str(user.id))
+        db.session.commit()
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+
+    print(f'threads={args.threads}  lookups/thread={args.lookups}  users={args.users}  '
+          f'ttl={identity_cache.ttl}s  (instance: {app.instance_path})')
+    print(f'  {"mode":<8}{"throughput":>14}{"p50 us":>10}{"p99 us":>10}{"SQL/chat":>12}')
+    run('before', before, user_ids, args)
+    run('after', after, user_ids, args)
+    print(f'  identity cache: {identity_cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
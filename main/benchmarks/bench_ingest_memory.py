@@ -0,0 +1,123 @@
+# PDF取り込みのピークメモリ（RSS）をページ数ごとに測る
+# 変更前の取り込み（アップロード全体の読み込み・全ページのリスト化・"\n".join・全チャンクの一括埋め込み）と
+# 現在の run_ingest_job（ページを1枚ずつ取り出し、バッチごとに埋め込んで追加する）を別プロセスで実行して比べる
+#
+#   python bench_ingest_memory.py --pages 50 200 500
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from common import CHACHAT_DIR, stub_env
+from pdfgen import make_pdf
+from stub_openai import StubConfig, start_stub_server
+
+# 子プロセスで実行するコード（ピークRSSを測るため、1回の取り込みごとにプロセスを分ける）
+CHILD = r'''
+import json, os, resource, sys, time, tracemalloc
+sys.path.insert(0, %(chachat)r)
+from app import (app, db, Data, Group, IngestJob, add_data_to_group_index, get_embedding_scheduler,
+                 get_text_splitter, run_ingest_job, split_pdf)
+from tempfile import NamedTemporaryFile
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+mode, pdf_path = sys.argv[1], sys.argv[2]
+with app.app_context():
+    db.create_all()
+    group = Group(unique_code='bench001', mail='bench@example.com', name='bench', password_hash='x')
+    db.session.add(group)
+    db.session.commit()
+    get_text_splitter()
+    get_embedding_scheduler()
+    # 起動直後のRSS（アプリとライブラリの読み込み分）
+    baseline = rss_mb()
+    # RSS にはメモリマップしたインデックスや SQLite のページも含まれるので、Pythonのヒープも別に測る
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == 'old':
+        # 変更前の upload_file の処理
+        with open(pdf_path, 'rb') as upload:
+            file_content = upload.read()
+        with NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
+            temp_file.write(file_content)
+        pages = split_pdf(temp_file.name)
+        page_texts = [page.page_content for page in pages]
+        content = "\n".join(page_texts)
+        data = Data(group_unique_id='bench001', file_name='bench.pdf', content=content, data_name='bench')
+        db.session.add(data)
+        db.session.commit()
+        # 全チャンクを一度に埋め込んで追加する
+        app.config['INGEST_EMBED_BATCH_SIZE'] = 10 ** 9
+        add_data_to_group_index(data, pages=page_texts)
+        os.remove(temp_file.name)
+    else:
+        job = IngestJob(group_unique_id='bench001', file_name='bench.pdf', data_name='bench', file_path=pdf_path)
+        db.session.add(job)
+        db.session.commit()
+        run_ingest_job(job.id)
+        db.session.expire_all()
+        job = db.session.get(IngestJob, job.id)
+        assert job.status == 'done', (job.status, job.error)
+    elapsed = time.perf_counter() - start
+    heap_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    print(json.dumps({'baseline_mb': baseline, 'peak_mb': peak_mb(), 'heap_mb': heap_peak, 'seconds': elapsed}))
+'''
+
+
+def run_child(mode, pdf_bytes, env, work_dir):
+    pdf_path = os.path.join(work_dir, f'{mode}.pdf')
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf_bytes)
+    instance_path = os.path.join(work_dir, f'instance-{mode}')
+    child_env = dict(env, CHACHAT_INSTANCE_PATH=instance_path)
+    result = subprocess.run([sys.executable, '-c', CHILD % {'chachat': os.path.abspath(CHACHAT_DIR)}, mode, pdf_path],
+                            cwd=CHACHAT_DIR, env=child_env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PDF取り込みのピークメモリを測る')
+    parser.add_argument('--pages', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--lines', type=int, default=40, help='1ページあたりの行数')
+    parser.add_argument('--vector-store', default='numpy', choices=['numpy', 'chroma'])
+    parser.add_argument('--embedding-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, _ = start_stub_server(config=StubConfig(embedding_latency=args.embedding_latency))
+    env = stub_env(f'http://127.0.0.1:{server.server_address[1]}/v1', '')
+    env['CHACHAT_VECTOR_STORE'] = args.vector_store
+
+    print(f'{"pages":>6}{"pdf MB":>9}{"mode":>6}{"base MB":>10}{"peak MB":>10}{"delta MB":>10}{"heap MB":>10}'
+          f'{"sec":>8}')
+    try:
+        for pages in args.pages:
+            pdf_bytes = make_pdf(pages, args.lines)
+            for mode in ('old', 'new'):
+                work_dir = tempfile.mkdtemp(prefix='bench-ingest-')
+                try:
+                    r = run_child(mode, pdf_bytes, env, work_dir)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                print(f'{pages:>6}{len(pdf_bytes) / 1024 / 1024:>9.1f}{mode:>6}{r["baseline_mb"]:>10.1f}'
+                      f'{r["peak_mb"]:>10.1f}{r["peak_mb"] - r["baseline_mb"]:>10.1f}{r["heap_mb"]:>10.1f}'
+                      f'{r["seconds"]:>8.1f}')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
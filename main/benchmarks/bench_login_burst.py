@@ -0,0 +1,156 @@
+# 授業の開始時のように、大勢が一斉に /login する場合のログインの p50/p99 と、
+# その間のほかのリクエスト（GET /login）の応答時間を比較する
+#   inline: 変更前と同じく要求スレッドでハッシュを確かめる（CHACHAT_PASSWORD_HASH_WORKERS=0）
+#   pool:   PasswordHasher のスレッドプールで確かめ、待ち行列があふれたら 503 を返す
+#   --methods を指定すると、その方式（コスト）に作り直すログイン（1回目）と作り直した後（2回目）も測る
+#
+#   python bench_login_burst.py --users 60 --methods scrypt:16384:8:1 pbkdf2:sha256:600000
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from common import CHACHAT_DIR, Client, free_port, spawn_app, summarize
+
+TEMPLATE_DIR = tempfile.mkdtemp(prefix='bench-login-')
+os.environ['CHACHAT_INSTANCE_PATH'] = TEMPLATE_DIR
+sys.path.insert(0, CHACHAT_DIR)
+from app import Group, app, create_tables, db, password_hasher, provision_users  # noqa: E402
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # ログイン後の /chachat の表示は含めずに測る
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def create_users(count):
+    create_tables()
+    run_id = uuid.uuid4().hex[:8]
+    mails = [f'user{i}-{run_id}@example.com' for i in range(count)]
+    text = 'mail,password,name\n' + ''.join(f'{mail},password,user{i}\n' for i, mail in enumerate(mails))
+    with app.app_context():
+        group = Group.create_new_group(f'author-{run_id}@example.com', 'password', 'bench')
+        provision_users(group, text)
+        # WAL の内容を site.db に書き戻してからコピーする
+        db.engine.dispose()
+    return mails
+
+
+def burst(base_url, mails):
+    # 全員のログイン画面を開いてから、同時にログインを送る
+    clients = []
+    for mail in mails:
+        client = Client(base_url)
+        client.get('/login')
+        client.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(client.cookies), NoRedirect)
+        clients.append((client, mail))
+
+    start_barrier = threading.Barrier(len(clients) + 1)
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def login(client, mail):
+        data = urllib.parse.urlencode({'csrf_token': client.csrf_token, 'mail': mail, 'password': 'password',
+                                       'submit': 'Login'}).encode()
+        start_barrier.wait()
+        start = time.perf_counter()
+        try:
+            with client.opener.open(base_url + '/login', data=data, timeout=600) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        elapsed = time.perf_counter() - start
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 302:
+                latencies.append(elapsed)
+
+    # ログインの間に、ほかの利用者の軽いリクエストがどれだけ待たされるか
+    probe_latencies = []
+    done = threading.Event()
+
+    def probe():
+        start_barrier.wait()
+        while not done.is_set():
+            start = time.perf_counter()
+            urllib.request.urlopen(base_url + '/login', timeout=600).read()
+            probe_latencies.append(time.perf_counter() - start)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=login, args=pair) for pair in clients]
+    probe_thread = threading.Thread(target=probe)
+    for thread in threads:
+        thread.start()
+    probe_thread.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    done.set()
+    probe_thread.join()
+    return latencies, statuses, probe_latencies, wall
+
+
+def report(label, result):
+    latencies, statuses, probe_latencies, wall = result
+    s = summarize(latencies)
+    p = summarize(probe_latencies)
+    print(f'  {label:<34}{statuses.get(302, 0):>5}{statuses.get(503, 0):>5}{statuses.get(302, 0) / wall:>9.1f}'
+          f'{s["p50"] * 1000:>9.0f}{s["p99"] * 1000:>9.0f}{p["p50"] * 1000:>9.0f}{p["p99"] * 1000:>9.0f}')
+    others = {code: n for code, n in statuses.items() if code not in (302, 503)}
+    if others:
+        print(f'    ! unexpected responses: {others}')
+
+
+def run(label, mails, env_overrides, bursts=1):
+    # 毎回、作ったばかりのデータベースのコピーを使う（前の実行での作り直しの影響を受けない）
+    instance_path = tempfile.mkdtemp(prefix='bench-login-run-')
+    shutil.copy(os.path.join(TEMPLATE_DIR, 'site.db'), instance_path)
+    env = dict(os.environ, CHACHAT_INSTANCE_PATH=instance_path, **env_overrides)
+    port = free_port()
+    proc = spawn_app(env, port)
+    try:
+        for i in range(bursts):
+            suffix = f' ({"rehash" if i == 0 else "after"})' if bursts > 1 else ''
+            report(label + suffix, burst(f'http://127.0.0.1:{port}', mails))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(instance_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='一斉ログインの応答時間を比較する')
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--workers', type=int, default=None, help='pool のスレッド数（既定は CPU 数と 4 の小さい方）')
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--methods', nargs='*', default=[], help='作り直す先のハッシュの方式（werkzeug の method 形式）')
+    args = parser.parse_args()
+
+    mails = create_users(args.users)
+    pool = {'CHACHAT_PASSWORD_HASH_MAX_QUEUE': str(args.max_queue)}
+    if args.workers is not None:
+        pool['CHACHAT_PASSWORD_HASH_WORKERS'] = str(args.workers)
+
+    print(f'CPU: {os.cpu_count()}  users: {args.users}  stored hash: {password_hasher.method_prefix}')
+    print(f'  {"mode":<34}{"ok":>5}{"503":>5}{"login/s":>9}{"p50 ms":>9}{"p99 ms":>9}'
+          f'{"probe50":>9}{"probe99":>9}')
+    run('inline', mails, {'CHACHAT_PASSWORD_HASH_WORKERS': '0'})
+    run('pool', mails, pool)
+    for method in args.methods:
+        run(f'pool {method}', mails, dict(pool, CHACHAT_PASSWORD_HASH_METHOD=method), bursts=2)
+    shutil.rmtree(TEMPLATE_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
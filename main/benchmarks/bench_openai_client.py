@@ -0,0 +1,126 @@
+# OpenAI API のクライアントを呼び出しごとに作る場合（変更前）と、
+# openai_clients.OpenAIClientRegistry の接続プールを使い回す場合の、1回あたりの時間と張った接続数を比較する
+# 開発用サーバーと同じく、リクエストごとに新しいスレッドで「質問の埋め込み + 回答の生成」を行う
+# async は asgi.py と同じく、1つのイベントループで ainvoke を呼ぶ
+#
+#   python bench_openai_client.py --requests 200 --concurrency 8
+# スタブは HTTP なので TLS のハンドシェイクは含まれない（実際の API では差がもっと大きくなる）
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from common import CHACHAT_DIR, summarize
+from stub_openai import StubConfig, start_stub_server
+
+sys.path.insert(0, CHACHAT_DIR)
+import openai  # noqa: E402
+from langchain.embeddings.openai import OpenAIEmbeddings  # noqa: E402
+from langchain.llms import OpenAI  # noqa: E402
+
+from openai_clients import OpenAIClientRegistry  # noqa: E402
+
+
+def before_call():
+    # 変更前の generate_answer と同じく、毎回ラッパーを作る
+    OpenAIEmbeddings(max_retries=1).embed_query('question')
+    OpenAI(temperature=0).invoke('prompt')
+
+
+def registry_call(registry):
+    registry.embeddings(max_retries=1).embed_query('question')
+    registry.llm(temperature=0).invoke('prompt')
+
+
+def run_threads(call, args):
+    # リクエストごとにスレッドを作り、同時に concurrency 個まで動かす
+    latencies = []
+    slots = threading.BoundedSemaphore(args.concurrency)
+
+    def worker():
+        try:
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+        finally:
+            slots.release()
+
+    threads = []
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        slots.acquire()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def run_async(registry, args):
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                if registry is not None:
+                    registry.use_aiohttp_session()
+                    llm = registry.llm(temperature=0)
+                else:
+                    llm = OpenAI(temperature=0)
+                start = time.perf_counter()
+                await llm.ainvoke('prompt')
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.requests)))
+        wall = time.perf_counter() - start
+        if registry is not None:
+            await registry.aclose()
+        return latencies, wall
+    return asyncio.run(main())
+
+
+def report(label, stub_config, result, calls_per_request):
+    latencies, wall = result
+    with stub_config.lock:
+        connections = stub_config.counts['connections']
+        stub_config.counts['connections'] = 0
+    s = summarize(latencies)
+    api_calls = len(latencies) * calls_per_request
+    print(f'  {label:<16}{len(latencies) / wall:>10.1f}/s{s["p50"] * 1000:>10.1f}{s["p99"] * 1000:>10.1f}'
+          f'{connections:>13}{1 - connections / api_calls if api_calls else 0:>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI クライアントの接続の使い回しを比較する')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.005, help='スタブの応答の遅延（秒）')
+    args = parser.parse_args()
+
+    stub, stub_config = start_stub_server(config=StubConfig(
+        embedding_latency=args.latency, completion_latency=args.latency, token_latency=0.0))
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}/v1'
+    os.environ.update({'OPENAI_API_BASE': stub_url, 'OPENAI_API_KEY': 'sk-stub'})
+    openai.api_base = stub_url
+    print(f'requests={args.requests}  concurrency={args.concurrency}  stub latency={args.latency * 1000:.0f}ms')
+    print(f'  {"mode":<16}{"throughput":>12}{"p50 ms":>10}{"p99 ms":>10}{"connections":>13}{"reuse":>10}')
+    try:
+        report('before', stub_config, run_threads(before_call, args), 2)
+        report('before async', stub_config, run_async(None, args), 1)
+
+        registry = OpenAIClientRegistry(api_key='sk-stub', api_base=stub_url, pool_size=args.concurrency).install()
+        report('registry', stub_config, run_threads(lambda: registry_call(registry), args), 2)
+        report('registry async', stub_config, run_async(registry, args), 1)
+        print(f'  registry stats: {registry.stats()}')
+        registry.close()
+    finally:
+        stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# PDFのテキスト抽出の速度（ページ/秒）を比較する
+# 変更前の PyPDFLoader.load_and_split() と、pdf_extract.iter_pdf_pages のワーカー数ごとの結果を表示する
+#
+#   python bench_pdf_extract.py --pages 100 500 --workers 1 2 4
+#   python bench_pdf_extract.py --pdf ~/FreelanceSurvey2023.pdf
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from common import CHACHAT_DIR
+from pdfgen import make_pdf
+
+sys.path.insert(0, CHACHAT_DIR)
+from langchain.document_loaders import PyPDFLoader  # noqa: E402
+from pdf_extract import get_process_pool, iter_pdf_pages, shutdown_process_pools  # noqa: E402
+
+
+def measure(label, pages, func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'  {label:<28}{best * 1000:>10.1f} ms{pages / best:>12.1f} pages/s')
+    return result
+
+
+def run(label, path, args):
+    pages = len(PyPDFLoader(path).load())
+    print(f'\n== {label} ({pages} pages, {os.path.getsize(path) / 1024 / 1024:.1f} MB) ==')
+    baseline = measure('load_and_split (before)', pages, lambda: PyPDFLoader(path).load_and_split(), args.repeat)
+    expected = [doc.page_content for doc in PyPDFLoader(path).load()]
+    for workers in args.workers:
+        if workers > 1:
+            # プロセスの起動時間は含めない（アプリでは一度起動したプールを使い回す）
+            pool = get_process_pool(workers)
+            list(pool.map(abs, range(workers)))
+        texts = measure(f'iter_pdf_pages workers={workers}', pages,
+                        lambda: list(iter_pdf_pages(path, workers, args.pages_per_shard, min_parallel_pages=0)),
+                        args.repeat)
+        if texts != expected:
+            print('    ! 抽出結果が load() と一致しません')
+    del baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PDFのテキスト抽出の速度を比較する')
+    parser.add_argument('--pdf', nargs='*', default=[], help='測定するPDF（省略時は生成したPDF）')
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 500])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--pages-per-shard', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'CPU: {os.cpu_count()}')
+    try:
+        for path in args.pdf:
+            run(os.path.basename(path), os.path.expanduser(path), args)
+        if not args.pdf:
+            for pages in args.pages:
+                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+                    f.write(make_pdf(pages))
+                try:
+                    run(f'generated', f.name, args)
+                finally:
+                    os.remove(f.name)
+    finally:
+        shutdown_process_pools()
+
+
+if __name__ == '__main__':
+    main()
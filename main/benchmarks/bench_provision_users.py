@@ -0,0 +1,82 @@
+# ユーザーの登録速度（人/秒）を比較する
+#   before: /register と同じく User.create_new_user() を1人ずつ呼ぶ（ID とメールの確認、ハッシュ、コミットを毎回行う）
+#   after:  provision_users()（ハッシュをプロセスプールで並列に計算し、まとめて INSERT して1回でコミット）
+#
+#   python bench_provision_users.py --users 200 --workers 1 2 4
+# パスワードのハッシュ（scrypt）は1人あたり約0.1秒かかり、CPU の数以上には速くならないので、
+# ハッシュを定数に置き換えてデータベースの分だけを比べた結果も表示する
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+from common import CHACHAT_DIR
+
+os.environ.setdefault('CHACHAT_INSTANCE_PATH', tempfile.mkdtemp(prefix='bench-provision-'))
+sys.path.insert(0, CHACHAT_DIR)
+import app as chachat  # noqa: E402
+import provisioning  # noqa: E402
+from app import Group, User, app, create_tables, provision_users  # noqa: E402
+from pdf_extract import get_process_pool, shutdown_process_pools  # noqa: E402
+
+
+def make_csv(count):
+    run_id = uuid.uuid4().hex[:8]
+    lines = ['mail,password,name']
+    lines += [f'user{i}-{run_id}@example.com,password{i},user{i}' for i in range(count)]
+    return '\n'.join(lines) + '\n'
+
+
+def report(label, count, elapsed):
+    print(f'  {label:<22}{count:>8}{elapsed:>10.2f}s{count / elapsed:>12.1f} users/s')
+
+
+def compare(group, workers_list, before_users, users):
+    run_id = uuid.uuid4().hex[:8]
+    start = time.perf_counter()
+    for i in range(before_users):
+        User.create_new_user(f'before{i}-{run_id}@example.com', f'password{i}', f'user{i}', str(group.id))
+    report('create_new_user', before_users, time.perf_counter() - start)
+
+    for workers in workers_list:
+        app.config['PROVISION_HASH_WORKERS'] = workers
+        if workers > 1:
+            # プロセスの起動時間は含めない（アプリでは一度起動したプールを使い回す）
+            list(get_process_pool(workers).map(abs, range(workers)))
+        text = make_csv(users)
+        start = time.perf_counter()
+        result = provision_users(group, text)
+        elapsed = time.perf_counter() - start
+        if result['created'] != users:
+            print(f'    ! created {result["created"]} of {users}: {result}')
+        report(f'provision workers={workers}', users, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ユーザーの一括登録の速度を比較する')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--before-users', type=int, default=50, help='1人ずつ登録する場合の人数（遅いので少なめ）')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--db-users', type=int, default=5000, help='ハッシュを除いた比較の人数')
+    args = parser.parse_args()
+
+    create_tables()
+    print(f'CPU: {os.cpu_count()}  (instance: {app.instance_path})')
+    print(f'  {"mode":<22}{"users":>8}{"time":>11}{"throughput":>18}')
+    try:
+        with app.app_context():
+            group = Group.create_new_group(f'bench-{uuid.uuid4().hex}@example.com', 'password', 'bench')
+            compare(group, args.workers, args.before_users, args.users)
+
+            print('\n  database only (password hash replaced with a constant):')
+            chachat.password_hasher.hash = lambda password: 'x'
+            provisioning.generate_password_hash = lambda password, method=None: 'x'
+            compare(group, [1], args.db_users // 5, args.db_users)
+    finally:
+        shutdown_process_pools()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# アプリの起動時間（import app）を新しいプロセスで測り、python -X importtime の結果から重いモジュールを表示する
+# preload_rag()（サーバーの起動時に langchain などを読み込む処理）の時間も別に表示する
+#
+#   python bench_startup.py --repeat 5
+#   python bench_startup.py --chachat-dir /path/to/old/checkout/main/chachat   # 別の版と比べる
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import CHACHAT_DIR
+
+HEAVY = ('langchain', 'langchain_core', 'langchain_community', 'chromadb', 'openai', 'aiohttp', 'tiktoken',
+         'numpy', 'pypdf')
+
+CODE = (
+    'import sys, time, json\n'
+    'start = time.perf_counter()\n'
+    'import app\n'
+    'imported = time.perf_counter()\n'
+    'loaded = [m for m in %r if m in sys.modules]\n'
+    'preload = getattr(app, "preload_rag", None)\n'
+    'if preload is not None and "--preload" in sys.argv:\n'
+    '    preload()\n'
+    'done = time.perf_counter()\n'
+    'print(json.dumps({"import": imported - start, "preload": done - imported, "loaded": loaded}))\n'
+) % (HEAVY,)
+
+
+def run_once(chachat_dir, instance_path, preload=False):
+    env = dict(os.environ, CHACHAT_INSTANCE_PATH=instance_path, OPENAI_API_KEY='sk-stub')
+    start = time.perf_counter()
+    args = ['--preload'] if preload else []
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CODE, *args], cwd=chachat_dir, env=env,
+                          capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['wall'] = wall
+    result['modules'] = parse_importtime(proc.stderr)
+    return result
+
+
+def parse_importtime(output):
+    # import app の直下で読み込まれたモジュールの累積時間（秒）
+    modules = {}
+    in_app = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        in_app.append((depth, name.strip(), int(cumulative) / 1e6))
+        if name.strip() == 'app' and depth == 0:
+            # importtime は読み込みが終わった順に出力するので、app より前の深さ1の行が app の直下
+            for d, module, seconds in in_app:
+                if d == 1:
+                    modules[module] = seconds
+            break
+        if depth == 0:
+            in_app = []
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='アプリの起動時間を測る')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='表示する重いモジュールの数')
+    parser.add_argument('--chachat-dir', default=CHACHAT_DIR, help='app.py のあるフォルダ')
+    args = parser.parse_args()
+
+    chachat_dir = os.path.abspath(args.chachat_dir)
+    with tempfile.TemporaryDirectory(prefix='chachat-startup-') as instance_path:
+        # 1回目はバイトコードの作成を含むので捨てる
+        run_once(chachat_dir, instance_path)
+        results = [run_once(chachat_dir, instance_path) for _ in range(args.repeat)]
+        preloaded = [run_once(chachat_dir, instance_path, preload=True) for _ in range(args.repeat)]
+
+    print(f'{chachat_dir}  (median of {args.repeat})')
+    for runs, key, label in ((results, 'wall', 'process (python -c "import app")'),
+                             (results, 'import', 'import app'),
+                             (preloaded, 'preload', 'preload_rag()'),
+                             (preloaded, 'wall', 'process with preload_rag()')):
+        values = [r[key] for r in runs]
+        print(f'  {label:<36}{statistics.median(values) * 1000:>10.1f} ms  (min {min(values) * 1000:.1f})')
+    print(f'  heavy modules loaded by import app: {", ".join(results[-1]["loaded"]) or "none"}')
+
+    print('\n  slowest imports under app:')
+    modules = results[-1]['modules']
+    for name, seconds in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'    {name:<40}{seconds * 1000:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# NumpyVectorStore と Chroma の比較
+# ランダムな埋め込みで索引作成時間・検索レイテンシ・開き直しにかかる時間を測る
+#
+#   python bench_vector_store.py --sizes 1000 10000 50000 --dims 1536
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import CHACHAT_DIR, print_table
+
+sys.path.insert(0, CHACHAT_DIR)
+from numpy_store import vectorstore_class  # noqa: E402
+
+
+class PrecomputedEmbeddings:
+    # テキストに対応するベクトルを事前に用意しておき、APIを呼ばずに返す
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+
+def run_store(name, size, dims, queries, k, batch, bulk=False):
+    rng = np.random.default_rng(size)
+    matrix = rng.standard_normal((size, dims)).astype(np.float32)
+    texts = [f'chunk-{i}' for i in range(size)]
+    vectors = {text: matrix[i].tolist() for i, text in enumerate(texts)}
+    query_texts = [f'query-{i}' for i in range(queries)]
+    for i, text in enumerate(query_texts):
+        vectors[text] = rng.standard_normal(dims).astype(np.float32).tolist()
+    embeddings = PrecomputedEmbeddings(vectors)
+
+    directory = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    cls = vectorstore_class(name)
+    try:
+        start = time.perf_counter()
+        store = cls(persist_directory=directory, embedding_function=embeddings)
+        # --bulk は取り込みと同じく、バッチの追加をまとめて最後に一度だけ公開する
+        with (store.bulk_add() if bulk and hasattr(store, 'bulk_add') else contextlib.nullcontext()):
+            for i in range(0, size, batch):
+                store.add_texts(texts[i:i + batch], metadatas=[{'data_id': 1}] * len(texts[i:i + batch]))
+        build = time.perf_counter() - start
+
+        # 別プロセスが開いた場合を想定して開き直す
+        start = time.perf_counter()
+        store = cls(persist_directory=directory, embedding_function=embeddings)
+        store.similarity_search(query_texts[0], k=k)
+        open_time = time.perf_counter() - start
+
+        latencies = []
+        for text in query_texts:
+            start = time.perf_counter()
+            store.similarity_search(text, k=k)
+            latencies.append(time.perf_counter() - start)
+        return build, open_time, latencies
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NumpyVectorStore と Chroma の比較')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--dims', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=5000, help='add_texts 1回あたりのチャンク数')
+    parser.add_argument('--bulk', action='store_true', help='NumpyVectorStore の追加を bulk_add() でまとめる')
+    parser.add_argument('--stores', nargs='+', default=['numpy', 'chroma'])
+    args = parser.parse_args()
+
+    os.environ.setdefault('ANONYMIZED_TELEMETRY', 'False')
+    for size in args.sizes:
+        stages = {}
+        for name in args.stores:
+            build, open_time, latencies = run_store(name, size, args.dims, args.queries, args.k, args.batch,
+                                                       args.bulk)
+            print(f'{name:>6} n={size}: build {build:.2f}s, open+first query {open_time * 1000:.1f}ms')
+            stages[f'{name} query'] = latencies
+        print_table(f'query latency (n={size}, dims={args.dims}, k={args.k})', stages)
+        print()
@@ -0,0 +1,161 @@
+# ベンチマークで共通して使う処理（アプリの起動、HTTPクライアント、集計）
+import http.cookiejar
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+CHACHAT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chachat')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else 0.0,
+    }
+
+
+def print_table(title, stages):
+    print(f'\n== {title} ==')
+    print(f'{"stage":<20}{"count":>8}{"p50 ms":>12}{"p95 ms":>12}{"p99 ms":>12}{"max ms":>12}')
+    for name, values in stages.items():
+        s = summarize(values)
+        print(f'{name:<20}{s["count"]:>8}{s["p50"] * 1000:>12.1f}{s["p95"] * 1000:>12.1f}'
+              f'{s["p99"] * 1000:>12.1f}{s["max"] * 1000:>12.1f}')
+
+
+def stub_env(stub_url, instance_path):
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_BASE': stub_url,
+        'OPENAI_API_KEY': 'sk-stub',
+        'CHACHAT_INSTANCE_PATH': instance_path,
+    })
+    return env
+
+
+def spawn_app(env, port, extra_args=()):
+    # 開発用サーバーでアプリを起動する（マルチスレッド）
+    code = (
+        'import sys; sys.path.insert(0, %r)\n'
+        'from app import app, db, resume_ingest_jobs\n'
+        'with app.app_context():\n'
+        '    db.create_all()\n'
+        '    resume_ingest_jobs()\n'
+        'app.run(host="127.0.0.1", port=%d, threaded=True, debug=False)\n'
+    ) % (os.path.abspath(CHACHAT_DIR), port)
+    proc = subprocess.Popen([sys.executable, '-c', code, *extra_args], cwd=CHACHAT_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wait_for_http(f'http://127.0.0.1:{port}/login', proc)
+    return proc
+
+
+def wait_for_http(url, proc=None, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError('app exited during startup:\n' + proc.stderr.read().decode('utf-8', 'replace'))
+        try:
+            urllib.request.urlopen(url, timeout=2).read()
+            return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError(f'timed out waiting for {url}')
+
+
+class Client:
+    # ログイン状態（Cookie）を持つ簡単なHTTPクライアント
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+        self.csrf_token = None
+
+    def get(self, path):
+        with self.opener.open(self.base_url + path, timeout=300) as response:
+            body = response.read().decode('utf-8')
+        self._remember_csrf(body)
+        return body
+
+    def post_form(self, path, fields):
+        data = urllib.parse.urlencode(fields).encode('utf-8')
+        with self.opener.open(self.base_url + path, data=data, timeout=300) as response:
+            body = response.read().decode('utf-8')
+            url = response.geturl()
+        self._remember_csrf(body)
+        return url, body
+
+    def post_file(self, path, fields, file_field, file_name, file_bytes, content_type='application/pdf'):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        parts.append((f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                      f'filename="{file_name}"\r\nContent-Type: {content_type}\r\n\r\n').encode())
+        parts.append(file_bytes)
+        parts.append(f'\r\n--{boundary}--\r\n'.encode())
+        request = urllib.request.Request(self.base_url + path, data=b''.join(parts), headers={
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+        })
+        with self.opener.open(request, timeout=300) as response:
+            body = response.read().decode('utf-8')
+            url = response.geturl()
+        self._remember_csrf(body)
+        return url, body
+
+    def get_json(self, path):
+        with self.opener.open(self.base_url + path, timeout=300) as response:
+            return json.loads(response.read())
+
+    def post_json(self, path, payload):
+        request = urllib.request.Request(self.base_url + path, data=json.dumps(payload).encode('utf-8'), headers={
+            'Content-Type': 'application/json',
+            'X-CSRFToken': self.csrf_token or '',
+        })
+        return self.opener.open(request, timeout=300)
+
+    def _remember_csrf(self, body):
+        match = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', body) or \
+            re.search(r'const csrfToken = "([^"]+)"', body)
+        if match:
+            self.csrf_token = match.group(1)
+
+    def login(self, mail, password, path='/login'):
+        self.get(path)
+        url, _ = self.post_form(path, {'csrf_token': self.csrf_token, 'mail': mail, 'password': password,
+                                       'submit': 'Login'})
+        return url
+
+    def register(self, mail, password, name, group_code='', path='/register'):
+        self.get(path)
+        fields = {'csrf_token': self.csrf_token, 'mail': mail, 'password': password,
+                  'confirm_password': password, 'name': name, 'submit': 'Register'}
+        if path == '/register':
+            fields['group_code'] = group_code
+        return self.post_form(path, fields)[0]
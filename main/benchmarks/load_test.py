@@ -0,0 +1,185 @@
+# chachat の負荷試験
+# ユーザー登録・ログイン・PDFアップロード・同時チャットを行い、段階ごとのレイテンシを集計する
+#
+#   python load_test.py --users 20 --questions 5 --concurrency 10
+#
+# --base-url を指定しない場合は、スタブのOpenAIサーバーと一時ディレクトリを使うアプリを起動する
+import argparse
+import json
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common import Client, free_port, print_table, spawn_app, stub_env
+from pdfgen import make_pdf
+from stub_openai import StubConfig, start_stub_server
+
+QUESTIONS = [
+    'What does the survey say about remote work?',
+    'How many hours do freelancers work per week?',
+    'What is the typical contract rate?',
+    'Which platforms are used to find clients?',
+    'How did income change compared to last year?',
+]
+
+
+class Stages:
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+
+def timed(stages, name, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    stages.add(name, time.perf_counter() - start)
+    return result
+
+
+def login_author(base_url, stages, run_id):
+    author = Client(base_url)
+    mail = f'author-{run_id}@example.com'
+    timed(stages, 'author_register', author.register, mail, 'password', f'author-{run_id}', path='/author_register')
+    timed(stages, 'author_login', author.login, mail, 'password', path='/author_login')
+    return author
+
+
+def upload_document(author, stages, pdf_bytes, name):
+    author.get('/file_upload')
+    url, _ = timed(stages, 'upload_request', author.post_file, '/upload_file',
+                   {'csrf_token': author.csrf_token, 'data_name': name}, 'file', f'{name}.pdf', pdf_bytes)
+
+    # 取り込みジョブが終わるまで待つ
+    job_id = url.rsplit('job_id=', 1)[-1]
+    start = time.perf_counter()
+    while True:
+        job = author.get_json(f'/upload_status/{job_id}')
+        if job['status'] in ('done', 'error'):
+            break
+        time.sleep(0.1)
+    stages.add('ingest_total', time.perf_counter() - start)
+    if job['status'] == 'error':
+        raise RuntimeError(f'ingest failed: {job["error"]}')
+    return job
+
+
+def prepare_user(base_url, stages, run_id, index, group_code):
+    client = Client(base_url)
+    mail = f'user-{run_id}-{index}@example.com'
+    timed(stages, 'register', client.register, mail, 'password', f'user{index}', group_code)
+    timed(stages, 'login', client.login, mail, 'password')
+    client.get('/chachat')
+    return client
+
+
+def ask(client, stages, question, stream):
+    start = time.perf_counter()
+    with client.post_json('/save_chat', {'content': question, 'is_user_message': True, 'stream': stream}) as response:
+        if not stream:
+            payload = json.loads(response.read())
+            if payload.get('status') != 'success':
+                raise RuntimeError(payload.get('message'))
+            elapsed = time.perf_counter() - start
+            stages.add('chat_first_byte', elapsed)
+            stages.add('chat_total', elapsed)
+            return
+
+        first = None
+        for line in response:
+            if not line.startswith(b'data: '):
+                continue
+            event = json.loads(line[len('data: '):])
+            if event.get('token') and first is None:
+                first = time.perf_counter() - start
+                stages.add('chat_first_byte', first)
+            if event.get('status') == 'error':
+                raise RuntimeError(event.get('message'))
+    stages.add('chat_total', time.perf_counter() - start)
+
+
+def run(args):
+    stages = Stages()
+    run_id = uuid.uuid4().hex[:8]
+    if args.pdf:
+        documents = [open(args.pdf, 'rb').read()]
+    else:
+        documents = [make_pdf(args.pages, seed=i) for i in range(args.documents)]
+
+    proc = None
+    stub = None
+    base_url = args.base_url
+    try:
+        if not base_url:
+            stub, stub_config = start_stub_server(config=StubConfig(
+                embedding_latency=args.embedding_latency,
+                completion_latency=args.completion_latency,
+                token_latency=args.token_latency,
+                rate_limit_ratio=args.rate_limit_ratio,
+            ))
+            instance_path = tempfile.mkdtemp(prefix='chachat-bench-')
+            port = free_port()
+            env = stub_env(f'http://127.0.0.1:{stub.server_address[1]}/v1', instance_path)
+            proc = spawn_app(env, port)
+            base_url = f'http://127.0.0.1:{port}'
+            print(f'app: {base_url} (instance: {instance_path})')
+
+        author = login_author(base_url, stages, run_id)
+        for i, pdf_bytes in enumerate(documents):
+            upload_document(author, stages, pdf_bytes, f'benchmark{i}')
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            clients = list(pool.map(lambda i: prepare_user(base_url, stages, run_id, i, args.group_code),
+                                    range(args.users)))
+
+            jobs = [(client, QUESTIONS[(i + q) % len(QUESTIONS)])
+                    for i, client in enumerate(clients) for q in range(args.questions)]
+            errors = []
+
+            def worker(job):
+                try:
+                    ask(job[0], stages, job[1], not args.no_stream)
+                except Exception as e:
+                    errors.append(e)
+
+            start = time.perf_counter()
+            list(pool.map(worker, jobs))
+            wall = time.perf_counter() - start
+
+        print_table('latency by stage', stages.samples)
+        print(f'\nchat requests: {len(jobs)}  errors: {len(errors)}  wall: {wall:.2f}s  '
+              f'throughput: {len(jobs) / wall:.2f} req/s')
+        if stub is not None:
+            print(f'stub api calls: {stub_config.counts}')
+        print(f'app caches: {author.get_json("/cache_stats")}')
+        if errors:
+            print(f'first error: {errors[0]}')
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if stub is not None:
+            stub.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chachat の負荷試験')
+    parser.add_argument('--base-url', help='起動済みのアプリを使う場合のURL（省略時はスタブ環境で起動）')
+    parser.add_argument('--group-code', default='1', help='ユーザー登録時のグループコード（Group.id）')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--questions', type=int, default=3, help='ユーザーごとの質問数')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--pdf', help='アップロードするPDF（省略時は生成）')
+    parser.add_argument('--pages', type=int, default=20, help='生成するPDFのページ数')
+    parser.add_argument('--documents', type=int, default=1, help='アップロードする生成PDFの数')
+    parser.add_argument('--no-stream', action='store_true', help='ストリーミングを使わずに質問する')
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--completion-latency', type=float, default=0.5)
+    parser.add_argument('--token-latency', type=float, default=0.02)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='スタブの埋め込みAPIが 429 を返す割合')
+    run(parser.parse_args())
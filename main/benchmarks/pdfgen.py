@@ -0,0 +1,63 @@
+# ベンチマーク用の簡単なPDFを生成する（外部ライブラリ不要）
+import random
+
+
+def make_pdf(pages=10, lines_per_page=40, seed=0):
+    rng = random.Random(seed)
+    words = ['freelance', 'survey', 'remote', 'work', 'income', 'contract', 'skill', 'client',
+             'project', 'hours', 'rate', 'platform', 'growth', 'market', 'report', 'result']
+
+    objects = []
+    font_id = 3
+    page_ids = []
+    content_ids = []
+    next_id = 4
+    for _ in range(pages):
+        page_ids.append(next_id)
+        content_ids.append(next_id + 1)
+        next_id += 2
+
+    objects.append((1, b'<< /Type /Catalog /Pages 2 0 R >>'))
+    kids = ' '.join(f'{page_id} 0 R' for page_id in page_ids)
+    objects.append((2, f'<< /Type /Pages /Kids [{kids}] /Count {pages} >>'.encode()))
+    objects.append((font_id, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'))
+
+    for page_no, (page_id, content_id) in enumerate(zip(page_ids, content_ids)):
+        lines = [f'Page {page_no + 1} item {i + 1}: ' + ' '.join(rng.choice(words) for _ in range(8))
+                 for i in range(lines_per_page)]
+        stream = ['BT', '/F1 10 Tf', '12 TL', '40 800 Td']
+        for line in lines:
+            stream.append(f'({line}) Tj T*')
+        stream.append('ET')
+        data = '\n'.join(stream).encode('latin-1')
+        objects.append((page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+            f'/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>'
+        ).encode()))
+        objects.append((content_id, b'<< /Length ' + str(len(data)).encode() + b' >>\nstream\n' + data + b'\nendstream'))
+
+    objects.sort()
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for obj_id, body in objects:
+        offsets.append(len(out))
+        out += f'{obj_id} 0 obj\n'.encode() + body + b'\nendobj\n'
+    xref_offset = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n'.encode()
+    out += b'0000000000 65535 f \n'
+    for offset in offsets:
+        out += f'{offset:010d} 00000 n \n'.encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode()
+    return bytes(out)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='ベンチマーク用PDFを生成する')
+    parser.add_argument('output')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=40)
+    args = parser.parse_args()
+    with open(args.output, 'wb') as f:
+        f.write(make_pdf(args.pages, args.lines))
@@ -0,0 +1,219 @@
+# OpenAI API (embeddings / completions / chat.completions) の代わりになるローカルサーバー
+# ネットワークの無い環境でも決まった結果を返し、遅延を指定して負荷試験ができるようにする
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    def __init__(self, dims=1536, embedding_latency=0.05, completion_latency=0.5,
+                 token_latency=0.02, answer_tokens=40, rate_limit_ratio=0.0, prompt_token_latency=0.0):
+        self.dims = dims
+        # 1リクエストあたりの遅延（秒）
+        self.embedding_latency = embedding_latency
+        # 最初のトークンが出るまでの遅延と、その後のトークンごとの遅延（秒）
+        self.completion_latency = completion_latency
+        self.token_latency = token_latency
+        # プロンプトの長さに比例する遅延（プロンプトの1トークンあたりの秒数。トークン数は文字数の半分で数える）
+        self.prompt_token_latency = prompt_token_latency
+        self.answer_tokens = answer_tokens
+        # 埋め込みリクエストのうち 429 を返す割合
+        self.rate_limit_ratio = rate_limit_ratio
+        self.counts = {'embeddings': 0, 'embedding_inputs': 0, 'completions': 0, 'chat_completions': 0,
+                       'rate_limited': 0, 'connections': 0}
+        self.lock = threading.Lock()
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.counts[key] += value
+
+
+def stub_vector(item, dims):
+    # 入力から決定的に単位ベクトルを作る
+    seed = hashlib.sha256(json.dumps(item, ensure_ascii=False).encode('utf-8')).digest()
+    values = []
+    block = seed
+    while len(values) < dims:
+        block = hashlib.sha256(block).digest()
+        values.extend((b - 127.5) / 127.5 for b in block)
+    values = values[:dims]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+def stub_answer_tokens(prompt, count):
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return [f' stub{digest[i % len(digest)]}{i}' for i in range(count)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None
+    # ヘッダーと本文を別々に書き込むので、keep-alive の接続で Nagle による遅延が出ないようにする
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        # ハンドラーは接続ごとに作られるので、ここで新しい接続の数を数える
+        super().setup()
+        self.config.count('connections')
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.config.lock:
+                self._send_json(dict(self.config.counts))
+        else:
+            self._send_json({'error': {'message': 'not found'}}, 404)
+
+    def do_POST(self):
+        path = self.path.rstrip('/')
+        body = self._read_json()
+        if path.endswith('/embeddings'):
+            self._embeddings(body)
+        elif path.endswith('/chat/completions'):
+            self._completions(body, chat=True)
+        elif path.endswith('/completions'):
+            self._completions(body, chat=False)
+        else:
+            self._send_json({'error': {'message': 'not found'}}, 404)
+
+    def _embeddings(self, body):
+        inputs = body.get('input')
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        if random.random() < self.config.rate_limit_ratio:
+            self.config.count('rate_limited')
+            self._send_json({'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': None}}, 429)
+            return
+        self.config.count('embeddings')
+        self.config.count('embedding_inputs', len(inputs))
+        time.sleep(self.config.embedding_latency)
+
+        data = []
+        for i, item in enumerate(inputs):
+            vector = stub_vector(item, self.config.dims)
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(struct.pack(f'{len(vector)}f', *vector)).decode('ascii')
+            else:
+                embedding = vector
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        tokens = sum(len(item) if isinstance(item, list) else len(item) // 2 + 1 for item in inputs)
+        self._send_json({
+            'object': 'list',
+            'data': data,
+            'model': body.get('model', 'text-embedding-ada-002'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+    def _completions(self, body, chat):
+        self.config.count('chat_completions' if chat else 'completions')
+        if chat:
+            prompt = '\n'.join(message.get('content') or '' for message in body.get('messages', []))
+        else:
+            prompt = body.get('prompt')
+            if isinstance(prompt, list):
+                prompt = prompt[0]
+        tokens = stub_answer_tokens(prompt or '', self.config.answer_tokens)
+        model = body.get('model', 'stub')
+        object_name = 'chat.completion' if chat else 'text_completion'
+
+        time.sleep(self.config.completion_latency + self.config.prompt_token_latency * (len(prompt or '') // 2))
+        if not body.get('stream'):
+            time.sleep(self.config.token_latency * len(tokens))
+            text = ''.join(tokens)
+            choice = {'index': 0, 'finish_reason': 'stop', 'logprobs': None}
+            if chat:
+                choice['message'] = {'role': 'assistant', 'content': text}
+            else:
+                choice['text'] = text
+            self._send_json({
+                'id': 'stub', 'object': object_name, 'created': int(time.time()), 'model': model,
+                'choices': [choice],
+                'usage': {'prompt_tokens': len(prompt or '') // 2, 'completion_tokens': len(tokens),
+                          'total_tokens': len(prompt or '') // 2 + len(tokens)},
+            })
+            return
+
+        # ストリーミングは Server-Sent Events をチャンク転送で返す
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.config.token_latency)
+            if chat:
+                choice = {'index': 0, 'delta': {'content': token}, 'finish_reason': None}
+            else:
+                choice = {'index': 0, 'text': token, 'logprobs': None, 'finish_reason': None}
+            self._write_chunk({'id': 'stub', 'object': object_name + '.chunk' if chat else object_name,
+                               'created': int(time.time()), 'model': model, 'choices': [choice]})
+        self._write_chunk('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, payload):
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        event = f'data: {data}\n\n'.encode('utf-8')
+        self.wfile.write(f'{len(event):x}\r\n'.encode('ascii') + event + b'\r\n')
+        self.wfile.flush()
+
+
+def start_stub_server(host='127.0.0.1', port=0, config=None):
+    config = config or StubConfig()
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenAI API のスタブサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--dims', type=int, default=1536)
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--completion-latency', type=float, default=0.5)
+    parser.add_argument('--token-latency', type=float, default=0.02)
+    parser.add_argument('--answer-tokens', type=int, default=40)
+    parser.add_argument('--prompt-token-latency', type=float, default=0.0, help='プロンプトの1トークンあたりの遅延（秒）')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='埋め込みリクエストに 429 を返す割合')
+    args = parser.parse_args()
+
+    server, _ = start_stub_server(args.host, args.port, StubConfig(
+        dims=args.dims,
+        embedding_latency=args.embedding_latency,
+        completion_latency=args.completion_latency,
+        token_latency=args.token_latency,
+        answer_tokens=args.answer_tokens,
+        rate_limit_ratio=args.rate_limit_ratio,
+        prompt_token_latency=args.prompt_token_latency,
+    ))
+    print(f'Stub OpenAI server listening on http://{args.host}:{server.server_address[1]}/v1')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
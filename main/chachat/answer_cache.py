@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    # 全角・半角や大文字・小文字、空白、文末の記号の違いを吸収する
+    query = unicodedata.normalize('NFKC', query).lower()
+    query = re.sub(r'\s+', ' ', query).strip()
+    return query.rstrip('?？!！。.、, ')
+
+
+# 前の会話を指す語（指示語・「では」などの接続の語・「もっと」「詳しく」など）
+FOLLOW_UP_PATTERN = re.compile(
+    r'それ|これ|あれ|その|この|あの|そこ|ここ|そう|こう|そちら|こちら|上記|前述|先ほど|さっき|'
+    r'前の|今の|同じ|続き|続けて|もっと|詳しく|くわしく|他に|ほかに|他の|ほかの|具体的に|'
+    r'^(では|じゃあ|なぜ|どうして|また|ちなみに)|'
+    r'\b(it|its|this|that|these|those|they|them|their|above|previous|more|else|again|why)\b|'
+    r'^(and|but|also|so|then|what about|how about)\b'
+)
+
+
+def is_follow_up(query, standalone_min_chars):
+    # 会話の続きの質問（前の会話を指す語を含む質問、standalone_min_chars 文字より短い「東京は？」のような質問）か
+    # それ以外は前の会話が無くても答えられる質問とみなす
+    query = normalize_query(query)
+    return len(query) < standalone_min_chars or FOLLOW_UP_PATTERN.search(query) is not None
+
+
+class _Entry:
+    __slots__ = ('answer', 'vector', 'created_at', 'cost_seconds')
+
+    def __init__(self, answer, vector, cost_seconds):
+        self.answer = answer
+        self.vector = vector
+        self.created_at = time.monotonic()
+        self.cost_seconds = cost_seconds
+
+
+# グループごとの回答キャッシュ
+# 1段目は正規化した質問文の完全一致、2段目は質問の埋め込みの近傍検索で引く
+# グループのインデックスのバージョンが変わったら（データが追加されたら）そのグループの分は捨てる
+class AnswerCache:
+    def __init__(self, max_entries=256, ttl=3600, similarity_threshold=0.95):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._groups = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def _entries(self, group, version):
+        # 呼び出し側で self._lock を取っていること
+        if self._versions.get(group) != version:
+            self._groups.pop(group, None)
+            self._versions[group] = version
+        return self._groups.setdefault(group, OrderedDict())
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry.created_at > self.ttl
+
+    def _hit(self, entries, key, entry, semantic):
+        entries.move_to_end(key)
+        if semantic:
+            self.semantic_hits += 1
+        else:
+            self.exact_hits += 1
+        self.saved_seconds += entry.cost_seconds
+        return entry.answer
+
+    def get(self, group, query, version=None):
+        key = normalize_query(query)
+        with self._lock:
+            entries = self._entries(group, version)
+            entry = entries.get(key)
+            if entry is not None and self._expired(entry):
+                del entries[key]
+                entry = None
+            if entry is not None:
+                return self._hit(entries, key, entry, semantic=False)
+        return None
+
+    def get_similar(self, group, query_vector, version=None):
+        # 完全一致しなかった後に呼ばれる前提なので、外れた場合はここでミスとして数える
+        # numpy は app の import を遅くしないよう、埋め込みを扱うときに読み込む
+        import numpy as np
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            entries = self._entries(group, version)
+            for key in [key for key, entry in entries.items() if self._expired(entry)]:
+                del entries[key]
+
+            candidates = [(key, entry) for key, entry in entries.items() if entry.vector is not None]
+            if candidates:
+                scores = np.stack([entry.vector for _, entry in candidates]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    key, entry = candidates[best]
+                    return self._hit(entries, key, entry, semantic=True)
+            self.misses += 1
+        return None
+
+    def record_miss(self):
+        # 近傍検索をしないで外れた場合（質問の埋め込みを省いた場合など）に呼び出し側で数える
+        with self._lock:
+            self.misses += 1
+
+    def put(self, group, query, answer, query_vector=None, cost_seconds=0.0, version=None):
+        vector = None
+        if query_vector is not None:
+            import numpy as np
+            vector = np.asarray(query_vector, dtype=np.float32)
+            vector = vector / (np.linalg.norm(vector) or 1.0)
+        key = normalize_query(query)
+        with self._lock:
+            entries = self._entries(group, version)
+            entries[key] = _Entry(answer, vector, cost_seconds)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, group):
+        with self._lock:
+            self._groups.pop(group, None)
+            self._versions.pop(group, None)
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': hits / total if total else 0.0,
+                'saved_seconds': self.saved_seconds,
+                'entries': sum(len(entries) for entries in self._groups.values()),
+                'groups': len(self._groups),
+                'similarity_threshold': self.similarity_threshold,
+            }
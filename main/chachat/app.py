@@ -1,17 +1,28 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, session
+from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify, Response, stream_with_context, abort, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, event
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, EqualTo, Optional
 from datetime import datetime, timedelta
+import asyncio
+import atexit
+import click
+import hashlib
+import hmac
+import json
 import os
 import random
 import string
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
 from io import BytesIO
-from langchain.document_loaders import PyPDFLoader
 from werkzeug.utils import secure_filename
 from tempfile import NamedTemporaryFile
 from flask_migrate import Migrate
@@ -20,18 +31,109 @@ from flask_wtf import CSRFProtect
 from flask_wtf.file import FileField, FileRequired
 
 from dotenv import load_dotenv
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.indexes import VectorstoreIndexCreator
-from langchain.document_loaders import TextLoader
 
-app = Flask(__name__)
+# langchain・Chroma・numpy などを使うモジュール（chat_memory, chunker, embedding_cache, embedding_scheduler,
+# lexical_index, numpy_store, openai_clients）は読み込みに時間がかかるので、使う関数の中で import する
+# （answer_cache の numpy と pdf_extract の pypdf も、使うときに読み込む）
+# （/login などの画面やコマンドの起動を遅くしない。サーバーでは起動時に preload_rag() で読み込んでおく）
+from answer_cache import AnswerCache, is_follow_up
+from identity_cache import IdentityCache, MISSING
+from metrics import (MetricsExporter, MetricsRegistry, StageTimer, TimedIterator, bind_labels, current_labels,
+                     set_group_label)
+from file_lock import FileLock
+from database import configure_sqlite, database_uri, engine_options, is_sqlite
+from pdf_extract import count_pages, default_workers, get_process_pool, iter_pdf_pages, load_pdf_documents
+from password_hashing import HashQueueFull, PasswordHasher
+from provisioning import hash_passwords, insert_users, parse_users_csv
+from write_behind import WriteBehindQueue
+
+# .envファイルは起動時に一度だけ読み込む
+load_dotenv()
+
+# instance フォルダ（site.db やインデックスの保存先）は環境変数で変更できる
+app = Flask(__name__, instance_path=os.environ.get('CHACHAT_INSTANCE_PATH'))
 csrf = CSRFProtect(app)
 
 app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+# SQLite のロック待ちの上限（ミリ秒）と synchronous の設定
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 10000
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'
+# PostgreSQL などを使う場合の接続プール（1プロセスあたり）
+app.config['DB_POOL_SIZE'] = int(os.environ.get('CHACHAT_DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('CHACHAT_DB_MAX_OVERFLOW', 20))
+app.config['DB_POOL_TIMEOUT'] = 30
+app.config['DB_POOL_RECYCLE'] = 1800
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
 app.config['REMEMBER_COOKIE_DURATION'] = timedelta(days=30)
+app.config['EMBEDDING_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+# 埋め込みAPIへの1リクエストあたりの最大テキスト数・同時リクエスト数・バッチをまとめるための待ち時間（秒）
+app.config['EMBEDDING_BATCH_SIZE'] = 256
+app.config['EMBEDDING_MAX_IN_FLIGHT'] = 4
+app.config['EMBEDDING_BATCH_WAIT'] = 0.01
+# ベクトルストアは 'chroma' または 'numpy'（numpy_store.NumpyVectorStore）
+app.config['VECTOR_STORE'] = os.environ.get('CHACHAT_VECTOR_STORE', 'chroma')
+app.config['INGEST_WORKERS'] = 2
+# チャンクの大きさと重なり（tiktoken のトークン数）
+app.config['CHUNK_TOKENS'] = 256
+app.config['CHUNK_OVERLAP_TOKENS'] = 32
+# 検索：語句の一致（BM25）と埋め込みの近傍検索の上位 RETRIEVAL_CANDIDATES 件ずつを
+# RRF（順位の逆数の和、定数 RRF_K）でまとめ、上位 RETRIEVAL_TOP_K 件のチャンクを回答に使う
+app.config['RETRIEVAL_TOP_K'] = 4
+app.config['RETRIEVAL_CANDIDATES'] = 20
+app.config['RRF_K'] = 60
+# 語句の一致の1位のチャンクに、質問の LEXICAL_FAST_PATH_MIN_CHARS 文字以上がそのまま含まれ、
+# 資料に出てくる質問の語（IDF で重み付け）の LEXICAL_FAST_PATH_COVERAGE 以上が含まれる場合は、
+# 質問の埋め込みを省いて語句の一致だけで検索する（MIN_CHARS を 0 にすると常に埋め込む）
+app.config['LEXICAL_FAST_PATH_MIN_CHARS'] = int(os.environ.get('CHACHAT_LEXICAL_FAST_PATH_MIN_CHARS', 8))
+app.config['LEXICAL_FAST_PATH_COVERAGE'] = 0.8
+# 回答キャッシュ（グループごと）の件数・有効期限（秒）・近傍検索で同じ質問とみなす類似度
+app.config['ANSWER_CACHE_MAX_ENTRIES'] = 256
+app.config['ANSWER_CACHE_TTL'] = 3600
+app.config['ANSWER_CACHE_SIMILARITY'] = 0.95
+# 会話の途中の質問でも、前の会話を指す語を含まず STANDALONE_QUESTION_MIN_CHARS 文字以上の質問は、
+# 履歴を使わずに最初の質問と同じように答え、回答キャッシュも使う（とても大きくすると会話の途中では常に履歴を使う）
+app.config['STANDALONE_QUESTION_MIN_CHARS'] = int(os.environ.get('CHACHAT_STANDALONE_QUESTION_MIN_CHARS', 10))
+# ユーザー・グループの解決結果とグループのインデックスをプロセス内で覚えておく秒数と件数
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('CHACHAT_IDENTITY_CACHE_TTL', 60))
+app.config['IDENTITY_CACHE_MAX_ENTRIES'] = 10000
+app.config['CHAT_HISTORY_PAGE_SIZE'] = 50
+# 回答のプロンプトに入れる会話の履歴（要約と直近の会話）と、会話の要約のトークン数の上限
+app.config['CHAT_HISTORY_TOKEN_BUDGET'] = int(os.environ.get('CHACHAT_HISTORY_TOKEN_BUDGET', 1024))
+app.config['CHAT_SUMMARY_TOKENS'] = 256
+# 1回の要約に回す会話のトークン数の上限と、直近の会話として読み込むメッセージ数の上限
+app.config['CHAT_SUMMARY_INPUT_TOKENS'] = 2048
+app.config['CHAT_HISTORY_MAX_MESSAGES'] = 50
+# チャットの保存は後回しにして、この件数か秒数に達したらまとめて書き込む
+app.config['CHAT_LOG_BATCH_SIZE'] = 200
+app.config['CHAT_LOG_FLUSH_INTERVAL'] = 0.5
+app.config['INGEST_EMBED_BATCH_SIZE'] = 64
+# アップロードを保存するときに一度に読み込む大きさ（バイト）
+app.config['UPLOAD_CHUNK_BYTES'] = 1024 * 1024
+# PDFのテキスト抽出に使うプロセス数（1なら並列にしない）・1プロセスに渡すページ数・並列にする最小ページ数
+app.config['PDF_EXTRACT_WORKERS'] = int(os.environ.get('CHACHAT_PDF_WORKERS', default_workers()))
+app.config['PDF_PAGES_PER_SHARD'] = 16
+app.config['PDF_PARALLEL_MIN_PAGES'] = 64
+# OpenAI API への接続・読み込みのタイムアウト（秒）、接続プールの大きさ、使っていない接続を残しておく秒数
+app.config['OPENAI_CONNECT_TIMEOUT'] = float(os.environ.get('CHACHAT_OPENAI_CONNECT_TIMEOUT', 10))
+app.config['OPENAI_TIMEOUT'] = float(os.environ.get('CHACHAT_OPENAI_TIMEOUT', 120))
+app.config['OPENAI_POOL_SIZE'] = int(os.environ.get('CHACHAT_OPENAI_POOL_SIZE', 20))
+app.config['OPENAI_KEEPALIVE'] = 30
+# パスワードのハッシュの方式とコスト（werkzeug の method 形式。例: scrypt:16384:8:1, pbkdf2:sha256:600000）
+# 変更すると、既存のアカウントのハッシュは次のログインのときに新しい方式で作り直す
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('CHACHAT_PASSWORD_HASH_METHOD', 'scrypt')
+# ログイン・登録時のハッシュを計算するスレッドの数と、待たせる数の上限（超えたら 503 を返す）
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('CHACHAT_PASSWORD_HASH_WORKERS', default_workers()))
+app.config['PASSWORD_HASH_MAX_QUEUE'] = int(os.environ.get('CHACHAT_PASSWORD_HASH_MAX_QUEUE', 64))
+
+# ユーザーの一括登録：パスワードのハッシュに使うプロセス数・1回の INSERT の行数・1回で登録できる人数
+app.config['PROVISION_HASH_WORKERS'] = int(os.environ.get('CHACHAT_PROVISION_WORKERS', default_workers()))
+app.config['PROVISION_BATCH_SIZE'] = 500
+app.config['PROVISION_MAX_USERS'] = 5000
+# /metrics（Prometheus 形式）の取得に必要なトークン（Authorization: Bearer ...）。空なら誰でも取得できる
+app.config['METRICS_TOKEN'] = os.environ.get('CHACHAT_METRICS_TOKEN', '')
+# 複数のプロセスで動かす場合に、各プロセスの値を書き出す間隔（秒）
+app.config['METRICS_EXPORT_INTERVAL'] = 5
 app.permanent_session_lifetime = timedelta(days=30)
 
 # Flask-Loginの初期化
@@ -39,6 +141,9 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 db = SQLAlchemy(app)
+if is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+    with app.app_context():
+        configure_sqlite(db.engine, app.config)
 
 # Flask-Migrateの初期化
 migrate = Migrate(app, db)
@@ -47,35 +152,33 @@ migrate = Migrate(app, db)
 csrf.init_app(app)
 
 def split_pdf(file_path: str) -> list:
-    loader = PyPDFLoader(file_path)
-    pages = loader.load_and_split()
-    return pages
-
-def create_answer(user_query, content):
-    # .envファイルを読み込む
-    load_dotenv()
+    with time_stage('pdf_parse'):
+        return load_pdf_documents(file_path, **pdf_extract_options())
 
-    # APIキーの登録が必要
-    os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
-    openai_api_key = os.environ.get("OPENAI_API_KEY")
+def pdf_extract_options():
+    return {
+        'workers': app.config['PDF_EXTRACT_WORKERS'],
+        'pages_per_shard': app.config['PDF_PAGES_PER_SHARD'],
+        'min_parallel_pages': app.config['PDF_PARALLEL_MIN_PAGES'],
+    }
 
+def create_answer(user_query, content):
     # テキストを一時ファイルに保存
     with NamedTemporaryFile(delete=False, mode='w', encoding='utf-8') as temp_file:
         temp_file.write(content)
         temp_file_path = temp_file.name
 
+    from langchain.document_loaders import TextLoader
+    from langchain.indexes import VectorstoreIndexCreator
+    from numpy_store import vectorstore_class
+
     loader = TextLoader(temp_file_path)
 
-    text_splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=100,
-        chunk_overlap=0,
-        length_function=len,
-    )
+    text_splitter = get_text_splitter()
 
     index = VectorstoreIndexCreator(
-        vectorstore_cls=Chroma,
-        embedding=OpenAIEmbeddings(),
+        vectorstore_cls=vectorstore_class(app.config['VECTOR_STORE']),
+        embedding=get_embeddings(),
         text_splitter=text_splitter,
     ).from_loaders([loader])
 
@@ -86,40 +189,593 @@ def create_answer(user_query, content):
 
     return answer
 
-def generate_answer(data_content, query):
-    # LangChainのロジックをここに移植
-    # .envファイルを読み込む
-    load_dotenv()
-
-    # APIキーの登録が必要
-    os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
-    openai_api_key = os.environ.get("OPENAI_API_KEY")
-
-    # 一時ファイルとしてdata_contentを保存
-    with NamedTemporaryFile(delete=False, suffix=".txt") as temp_file:
-        temp_file.write(data_content.encode('utf-8'))
-        temp_file_path = temp_file.name
-
-    loader = TextLoader(temp_file_path)
-    text_splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=100,
-        chunk_overlap=0,
-        length_function=len,
+def get_index_dir(group_unique_id):
+    # ベクトルインデックスは site.db と同じ instance フォルダにベクトルストアの種類・グループごとに保存する
+    return os.path.join(app.instance_path, 'indexes', app.config['VECTOR_STORE'], f'group_{group_unique_id}')
+
+# 同じグループのインデックスへの同時書き込みを防ぐためのロック
+index_locks = {}
+index_locks_lock = threading.Lock()
+
+def get_index_lock(group_unique_id):
+    with index_locks_lock:
+        return index_locks.setdefault(group_unique_id, threading.Lock())
+
+@contextmanager
+def lock_group_index(group_unique_id):
+    # インデックス（ベクトル・語句）を読み込んでから保存するまで、ほかのスレッドとプロセスの書き込みを待たせる
+    # （lexical.npz は読み込んで変更してから全体を書き直すので、重なると先に保存した方の追加が消える）
+    # ロックのファイルはインデックスのフォルダの外に置く（フォルダが空かどうかで作り直しを判断するため）
+    index_dir = get_index_dir(group_unique_id)
+    os.makedirs(os.path.dirname(index_dir), exist_ok=True)
+    with get_index_lock(group_unique_id), FileLock(index_dir + '.lock'):
+        yield
+
+embedding_cache = None
+
+def get_embedding_cache():
+    # 埋め込みキャッシュは instance フォルダに置き、プロセス内で使い回す
+    global embedding_cache
+    if embedding_cache is None:
+        from embedding_cache import EmbeddingCache
+        embedding_cache = EmbeddingCache(
+            os.path.join(app.instance_path, 'embedding_cache.sqlite'),
+            max_bytes=app.config['EMBEDDING_CACHE_MAX_BYTES'],
+        )
+    return embedding_cache
+
+openai_clients = None
+openai_clients_lock = threading.Lock()
+
+def get_openai_clients():
+    # OpenAI API のクライアントと接続プールはプロセス内で1つだけ作って使い回す
+    global openai_clients
+    with openai_clients_lock:
+        if openai_clients is None:
+            from openai_clients import OpenAIClientRegistry
+            openai_clients = OpenAIClientRegistry(
+                api_key=os.environ.get('OPENAI_API_KEY'),
+                api_base=os.environ.get('OPENAI_API_BASE'),
+                connect_timeout=app.config['OPENAI_CONNECT_TIMEOUT'],
+                read_timeout=app.config['OPENAI_TIMEOUT'],
+                pool_size=app.config['OPENAI_POOL_SIZE'],
+                keepalive=app.config['OPENAI_KEEPALIVE'],
+            ).install()
+    return openai_clients
+
+embedding_scheduler = None
+embedding_scheduler_lock = threading.Lock()
+
+def get_embedding_scheduler():
+    # 取り込みと質問の埋め込みはすべてプロセス内で共有するスケジューラーを通して送る
+    global embedding_scheduler
+    with embedding_scheduler_lock:
+        if embedding_scheduler is None:
+            from embedding_scheduler import EmbeddingScheduler
+            # 429 の再送はスケジューラー側で行う
+            client = get_openai_clients().embeddings(max_retries=1)
+            embedding_scheduler = EmbeddingScheduler(
+                client.embed_documents,
+                max_batch_size=app.config['EMBEDDING_BATCH_SIZE'],
+                max_in_flight=app.config['EMBEDDING_MAX_IN_FLIGHT'],
+                max_wait=app.config['EMBEDDING_BATCH_WAIT'],
+            )
+            embedding_scheduler.model = client.model
+    return embedding_scheduler
+
+def get_embeddings():
+    from embedding_cache import CachedEmbeddings
+    from embedding_scheduler import ScheduledEmbeddings
+    scheduler = get_embedding_scheduler()
+    return CachedEmbeddings(ScheduledEmbeddings(scheduler, scheduler.model), get_embedding_cache(),
+                            on_embed=record_embedding)
+
+def get_text_splitter():
+    # 日本語の文の区切りを守り、トークン数でチャンクの大きさをそろえる
+    from chunker import SentenceTokenSplitter
+    return SentenceTokenSplitter(
+        chunk_size=app.config['CHUNK_TOKENS'],
+        chunk_overlap=app.config['CHUNK_OVERLAP_TOKENS'],
     )
-    index = VectorstoreIndexCreator(
-        vectorstore_cls=Chroma,
-        embedding=OpenAIEmbeddings(),
-        text_splitter=text_splitter,
-    ).from_loaders([loader])
 
-    answer = index.query(query)
+def open_group_index(group_unique_id):
+    from numpy_store import vectorstore_class
+    index_dir = get_index_dir(group_unique_id)
+    os.makedirs(index_dir, exist_ok=True)
+    return vectorstore_class(app.config['VECTOR_STORE'])(persist_directory=index_dir, embedding_function=get_embeddings())
+
+def add_data_to_group_index(data, pages=None, on_progress=None):
+    # アップロード時に一度だけ分割してチャンクを data_chunks に保存し、
+    # 埋め込んでグループのインデックスに data_id・chunk_id 付きで追加する
+    # ページごとに分割するので、チャンクがページをまたぐことはない
+    # pages はジェネレーターでもよく、INGEST_EMBED_BATCH_SIZE 件ずつ埋め込んで追加するので
+    # メモリに載るのは1バッチ分のチャンクだけ
+    # pages を渡さない場合（インデックスの作り直し）は保存済みのチャンクをそのまま使う
+    # index_build の時間にはチャンク分割と埋め込み（chunking・embedding）も含まれる
+    with time_stage('index_build'):
+        return build_group_index(data, pages, on_progress)
+
+def build_group_index(data, pages, on_progress):
+    data_id, group_unique_id = data.id, data.group_unique_id
+    batch_size = app.config['INGEST_EMBED_BATCH_SIZE']
+
+    with lock_group_index(group_unique_id):
+        vectorstore = open_group_index(group_unique_id)
+        indexed = get_indexed_data_ids(group_unique_id, vectorstore)
+        if pages is None and data_id in indexed:
+            # ほかのプロセスが先に追加した
+            return vectorstore
+        # 追加するチャンクは、ほかの取り込み・作り直しが終わるのを待ってから決める
+        docs = get_index_docs(data, pages)
+        if docs is None:
+            # 追加するチャンクが無いデータも、追加済みとして記録する（開くたびに作り直さない）
+            write_indexed_data_ids(group_unique_id, indexed | {data_id})
+            return None
+        lexical = open_lexical_index(group_unique_id)
+        # 同じデータを登録し直す場合は古いチャンクを消してから追加する
+        old_ids = vectorstore.get(where={'data_id': data_id})['ids']
+        if old_ids:
+            vectorstore.delete(old_ids)
+        lexical.remove_data(data_id)
+
+        # NumpyVectorStore はバッチごとに新しいバージョンを作らず、最後に一度だけ公開する
+        bulk_add = getattr(vectorstore, 'bulk_add', nullcontext)
+        with bulk_add():
+            batch = []
+            page_count = 0
+            chunk_count = 0
+            for doc in docs:
+                batch.append(doc)
+                lexical.add(doc.metadata['chunk_id'], data_id, doc.page_content)
+                page_count = doc.metadata['page'] + 1
+                if len(batch) >= batch_size:
+                    vectorstore.add_documents(batch)
+                    chunk_count += len(batch)
+                    batch = []
+                    if on_progress:
+                        on_progress(page_count, chunk_count)
+            if batch:
+                vectorstore.add_documents(batch)
+                chunk_count += len(batch)
+        if on_progress:
+            on_progress(page_count, chunk_count)
+        with time_stage('db_commit'):
+            db.session.commit()
+        lexical.save(get_lexical_index_path(group_unique_id))
+        write_indexed_data_ids(group_unique_id, indexed | {data_id})
+        touch_index_version(group_unique_id)
+    answer_cache.invalidate(group_unique_id)
+    return vectorstore
+
+def get_index_docs(data, pages):
+    # インデックスに追加する Document を返す（追加するものが無い場合は None）
+    data_id, group_unique_id = data.id, data.group_unique_id
+    if pages is not None:
+        return store_data_pages(data_id, group_unique_id, pages)
+    if db.session.query(DataChunk.id).filter_by(data_id=data_id).first():
+        return iter_stored_chunks(data_id)
+    if db.session.query(IngestJob.id).filter_by(data_id=data_id).first():
+        # 取り込みジョブで登録したデータは content を保存しない（本文はページにある）ので、作り直しには使わない
+        return None
+    if not data.content:
+        # 本文が無い場合は、登録済みのチャンクを空のページで置き換えない
+        return None
+    # ページ・チャンクを保存する前に登録されたデータ
+    return store_data_pages(data_id, group_unique_id, [data.content])
+
+def store_data_pages(data_id, group_unique_id, pages):
+    # ページとチャンクをデータベースに書き込みながら、インデックスに追加する Document を返す
+    # 古いページ・チャンクは呼び出したときに消す（ジェネレーターの中で消すと、最初に取り出すまで遅れる）
+    delete_data_rows(data_id)
+    return iter_data_pages(data_id, group_unique_id, pages)
+
+def iter_data_pages(data_id, group_unique_id, pages):
+    text_splitter = get_text_splitter()
+    offset = 0
+    for page_no, page_text in enumerate(pages):
+        db.session.add(DataPage(data_id=data_id, page_no=page_no, content=page_text, char_start=offset))
+        with time_stage('chunking'):
+            spans = text_splitter.split_text_with_spans(page_text)
+        chunks = [
+            DataChunk(data_id=data_id, group_unique_id=group_unique_id, page_no=page_no, content=text,
+                      char_start=start, char_end=end, token_count=tokens)
+            for text, start, end, tokens in spans
+        ]
+        db.session.add_all(chunks)
+        db.session.flush()
+        # 呼び出し側でコミットされると属性が読み直しになるので、先に Document にしておく
+        docs = [chunk.to_document() for chunk in chunks]
+        yield from docs
+        offset += len(page_text) + 1
+
+def iter_stored_chunks(data_id):
+    query = DataChunk.query.filter_by(data_id=data_id).order_by(DataChunk.id)
+    for chunk in query.yield_per(app.config['INGEST_EMBED_BATCH_SIZE']):
+        yield chunk.to_document()
+
+def delete_data_rows(data_id):
+    DataChunk.query.filter_by(data_id=data_id).delete()
+    DataPage.query.filter_by(data_id=data_id).delete()
+
+def load_chunk_texts(keys, fallback):
+    # 検索で選ばれた上位k件のチャンクだけをデータベースから読み込む
+    # chunk_id の無い古いインデックスの結果は、インデックス内の本文（fallback）をそのまま使う
+    chunk_ids = [key for key in keys if isinstance(key, int)]
+    rows = {}
+    if chunk_ids:
+        rows = dict(db.session.query(DataChunk.id, DataChunk.content).filter(DataChunk.id.in_(chunk_ids)).all())
+    texts = [rows.get(key, fallback.get(key)) for key in keys]
+    # 検索の後に削除されたチャンクは飛ばす
+    return [text for text in texts if text is not None]
+
+def remove_data_from_group_index(data):
+    with lock_group_index(data.group_unique_id):
+        vectorstore = open_group_index(data.group_unique_id)
+        ids = vectorstore.get(where={'data_id': data.id})['ids']
+        if ids:
+            vectorstore.delete(ids)
+        lexical = open_lexical_index(data.group_unique_id)
+        if lexical.remove_data(data.id):
+            lexical.save(get_lexical_index_path(data.group_unique_id))
+        write_indexed_data_ids(data.group_unique_id,
+                               get_indexed_data_ids(data.group_unique_id, vectorstore) - {data.id})
+        touch_index_version(data.group_unique_id)
+    answer_cache.invalidate(data.group_unique_id)
+
+def get_indexed_data_path(group_unique_id):
+    return os.path.join(get_index_dir(group_unique_id), 'indexed_data.json')
+
+def get_indexed_data_ids(group_unique_id, vectorstore=None):
+    # インデックスに追加済みのデータの id
+    # 記録の無い古いインデックスは、インデックスのメタデータの data_id から作る
+    try:
+        with open(get_indexed_data_path(group_unique_id), encoding='utf-8') as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        if vectorstore is None:
+            vectorstore = open_group_index(group_unique_id)
+        return {metadata['data_id'] for metadata in vectorstore.get()['metadatas'] if 'data_id' in metadata}
+
+def write_indexed_data_ids(group_unique_id, data_ids):
+    # インデックスを更新したとき（lock_group_index の中）に書き換える
+    path = get_indexed_data_path(group_unique_id)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(sorted(data_ids), f)
+    os.replace(path + '.tmp', path)
+
+def touch_index_version(group_unique_id):
+    # インデックスを更新するたびにバージョンを変え、他のプロセスの回答キャッシュも無効にする
+    with open(os.path.join(get_index_dir(group_unique_id), 'VERSION'), 'w') as f:
+        f.write(uuid.uuid4().hex)
+
+def read_index_version(group_unique_id):
+    try:
+        with open(os.path.join(get_index_dir(group_unique_id), 'VERSION')) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def load_group_index(group_unique_id):
+    # 開いたインデックスはバージョンが変わるまで使い回す（開くたびにファイルを読み込まない）
+    version = read_index_version(group_unique_id)
+    cached = identity_cache.get(('index', group_unique_id))
+    if cached is not MISSING and cached[0] == version and version is not None:
+        return cached[1]
+
+    # 既存データなどでインデックスに入っていないデータがあれば、ここで追加する
+    # （インデックスが無いグループに新しくアップロードした場合も、それより前のデータはここで追加する）
+    # （取り込み中のデータはジョブがインデックスに追加するので含めない）
+    indexed = get_indexed_data_ids(group_unique_id)
+    missing = Data.query.filter_by(group_unique_id=group_unique_id).filter(is_data_ready())
+    if indexed:
+        missing = missing.filter(Data.id.notin_(indexed))
+    for data in missing.order_by(Data.id).all():
+        add_data_to_group_index(data)
+    token = identity_cache.token()
+    version = read_index_version(group_unique_id)
+    with time_stage('index_load'):
+        vectorstore = open_group_index(group_unique_id)
+    identity_cache.put(('index', group_unique_id), (version, vectorstore), token)
+    return vectorstore
+
+def get_lexical_index_path(group_unique_id):
+    return os.path.join(get_index_dir(group_unique_id), 'lexical.npz')
+
+def open_lexical_index(group_unique_id):
+    # 語句の転置インデックスを読み込む。まだ無いグループは保存済みのチャンクから作る
+    from lexical_index import LexicalIndex
+    path = get_lexical_index_path(group_unique_id)
+    if os.path.exists(path):
+        return LexicalIndex.load(path)
+    lexical = LexicalIndex()
+    rows = db.session.query(DataChunk.id, DataChunk.data_id, DataChunk.content) \
+        .filter_by(group_unique_id=group_unique_id).order_by(DataChunk.id)
+    for chunk_id, data_id, content in rows.yield_per(app.config['INGEST_EMBED_BATCH_SIZE']):
+        lexical.add(chunk_id, data_id, content)
+    return lexical
+
+def load_lexical_index(group_unique_id):
+    # ベクトルのインデックスと同じく、バージョンが変わるまで使い回す
+    version = read_index_version(group_unique_id)
+    cached = identity_cache.get(('lexical', group_unique_id))
+    if cached is not MISSING and cached[0] == version and version is not None:
+        return cached[1]
+    if version is None:
+        # 既存データなどでインデックスが無い場合は、ベクトルのインデックスと一緒に作る
+        load_group_index(group_unique_id)
+
+    token = identity_cache.token()
+    version = read_index_version(group_unique_id)
+    path = get_lexical_index_path(group_unique_id)
+    if os.path.exists(path):
+        from lexical_index import LexicalIndex
+        with time_stage('index_load'):
+            lexical = LexicalIndex.load(path)
+    else:
+        with lock_group_index(group_unique_id), time_stage('index_build'):
+            lexical = open_lexical_index(group_unique_id)
+            if not os.path.exists(path):
+                lexical.save(path)
+    identity_cache.put(('lexical', group_unique_id), (version, lexical), token)
+    return lexical
+
+def search_lexical(group_unique_id, query):
+    lexical = load_lexical_index(group_unique_id)
+    with time_stage('lexical_search'):
+        result = lexical.search(query, k=app.config['RETRIEVAL_CANDIDATES'])
+        if (result.hits and app.config['LEXICAL_FAST_PATH_MIN_CHARS'] > 0
+                and result.coverage >= app.config['LEXICAL_FAST_PATH_COVERAGE']):
+            # 質問がそのまま含まれているかは1位のチャンクの本文と比べる（語句だけで検索できそうな場合だけ読み込む）
+            from lexical_index import quoted_length
+            content = db.session.query(DataChunk.content).filter_by(id=result.hits[0][0]).scalar()
+            result.quoted = quoted_length(query, content or '')
+        return result
+
+def is_lexical_confident(lexical):
+    # 質問が資料の語句をそのまま含む場合は、埋め込みの近傍検索をしなくてよい
+    min_chars = app.config['LEXICAL_FAST_PATH_MIN_CHARS']
+    return (bool(lexical.hits) and min_chars > 0 and lexical.quoted >= min_chars
+            and lexical.coverage >= app.config['LEXICAL_FAST_PATH_COVERAGE'])
+
+retrieval_stats = {'lexical_only': 0, 'hybrid': 0}
+retrieval_stats_lock = threading.Lock()
+
+def retrieve_chunk_texts(group_unique_id, query, query_vector=None, lexical=None):
+    with time_stage('retrieval'):
+        return retrieve_chunks(group_unique_id, query, query_vector, lexical)
+
+def retrieve_chunks(group_unique_id, query, query_vector, lexical):
+    # 語句の一致と埋め込みの近傍検索の順位を RRF でまとめ、上位のチャンクの本文を返す
+    # 語句の一致の確信度が高く query_vector が無い場合は、埋め込みを使わない
+    from lexical_index import reciprocal_rank_fusion
+    if lexical is None:
+        lexical = search_lexical(group_unique_id, query)
+    if query_vector is None and not is_lexical_confident(lexical):
+        query_vector = get_embeddings().embed_query(query)
+
+    rankings = [[chunk_id for chunk_id, _ in lexical.hits]]
+    fallback = {}
+    if query_vector is not None:
+        docs = load_group_index(group_unique_id).similarity_search_by_vector(
+            query_vector, k=app.config['RETRIEVAL_CANDIDATES'])
+        ranking = []
+        for doc in docs:
+            # chunk_id の無い古いインデックスの結果は本文で区別する
+            key = doc.metadata.get('chunk_id') or doc.page_content
+            fallback[key] = doc.page_content
+            ranking.append(key)
+        rankings.append(ranking)
+    with retrieval_stats_lock:
+        retrieval_stats['hybrid' if query_vector is not None else 'lexical_only'] += 1
+
+    keys = reciprocal_rank_fusion(rankings, k=app.config['RRF_K'])[:app.config['RETRIEVAL_TOP_K']]
+    return load_chunk_texts(keys, fallback)
+
+def get_llm(streaming=False):
+    return get_openai_clients().llm(streaming=streaming, temperature=0)
+
+answer_cache = AnswerCache(
+    max_entries=app.config['ANSWER_CACHE_MAX_ENTRIES'],
+    ttl=app.config['ANSWER_CACHE_TTL'],
+    similarity_threshold=app.config['ANSWER_CACHE_SIMILARITY'],
+)
+
+# キーは ('user', User.id)・('group', Group.id)・('group_code', User.group_code)・
+# ('group_data', Group.unique_code)・('index', Group.unique_code)・('lexical', Group.unique_code)
+# User・Group・Data・IngestJob の変更はコミット時に invalidate_identity_cache で消す
+identity_cache = IdentityCache(
+    ttl=app.config['IDENTITY_CACHE_TTL'],
+    max_entries=app.config['IDENTITY_CACHE_MAX_ENTRIES'],
+)
+
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_queue=app.config['PASSWORD_HASH_MAX_QUEUE'],
+)
+
+# /metrics で出力する処理時間と件数（ラベルの group は Group.unique_code、route は Flask のルール）
+# stage: upload_read, pdf_parse, chunking, embedding, index_build, index_load, lexical_search,
+#        retrieval, llm, llm_first_token, db_commit
+metrics_registry = MetricsRegistry()
+stage_seconds = metrics_registry.histogram('chachat_stage_seconds', 'Time spent in each stage of the RAG pipeline.',
+                                  ('stage', 'group', 'route'))
+stage_errors = metrics_registry.counter('chachat_stage_errors_total', 'Stages that ended with an exception.',
+                               ('stage', 'group', 'route'))
+request_seconds = metrics_registry.histogram('chachat_request_seconds', 'Time until the response headers are sent.',
+                                    ('group', 'route'))
+requests_total = metrics_registry.counter('chachat_requests_total', 'Requests by response status.',
+                                 ('group', 'route', 'status'))
+embedding_texts = metrics_registry.counter('chachat_embedding_texts_total',
+                                  'Texts sent to the embedding API (not found in the embedding cache).',
+                                  ('group', 'route'))
+embedding_tokens = metrics_registry.counter('chachat_embedding_tokens_total', 'Tokens sent to the embedding API.',
+                                   ('group', 'route'))
+
+def time_stage(stage, labels=None):
+    # with time_stage('retrieval'): ... の形で使う（labels を省略するとリクエストのラベル）
+    return StageTimer(stage_seconds, stage_errors, stage, labels)
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe((stage,) + current_labels(), seconds)
+
+def record_embedding(texts, seconds):
+    # CachedEmbeddings が API に問い合わせたときに呼ばれる
+    from chat_memory import count_tokens
+    labels = current_labels()
+    stage_seconds.observe(('embedding',) + labels, seconds)
+    embedding_texts.inc(labels, len(texts))
+    embedding_tokens.inc(labels, sum(count_tokens(text) for text in texts))
+
+def observe_request(status, seconds):
+    labels = current_labels()
+    request_seconds.observe(labels, seconds)
+    requests_total.inc(labels + (str(status),))
+
+metrics_exporter = None
+metrics_exporter_lock = threading.Lock()
+
+def get_metrics_exporter():
+    # 書き出し用のスレッドを持つので、fork 後のワーカープロセスで最初に使うときに作る
+    global metrics_exporter
+    with metrics_exporter_lock:
+        if metrics_exporter is None:
+            metrics_exporter = MetricsExporter(metrics_registry, os.path.join(app.instance_path, 'metrics'),
+                                               interval=app.config['METRICS_EXPORT_INTERVAL'])
+    return metrics_exporter
+
+def lookup_cached_answer(group_unique_id, query, use_cache=True):
+    # 完全一致 → 質問の埋め込みの近傍の順に回答キャッシュを引く
+    # 語句の一致だけで検索できる質問は埋め込みを省く（近傍のキャッシュも引かない）
+    # 語句の検索結果と埋め込みは外れた場合の検索にもそのまま使う
+    # 会話の続きの質問（use_cache=False）は、同じ文面でも回答が変わるのでキャッシュを引かない（follow_up_history）
+    version = read_index_version(group_unique_id)
+    answer = answer_cache.get(group_unique_id, query, version) if use_cache else None
+    if answer is not None:
+        return answer, None, version, None
+    lexical = search_lexical(group_unique_id, query)
+    if is_lexical_confident(lexical):
+        if use_cache:
+            answer_cache.record_miss()
+        return None, None, version, lexical
+    query_vector = get_embeddings().embed_query(query)
+    answer = answer_cache.get_similar(group_unique_id, query_vector, version) if use_cache else None
+    return answer, query_vector, version, lexical
+
+def follow_up_history(query, history):
+    # 会話の続きの質問だけ履歴を使う（それ以外は None を返し、回答キャッシュを引いて保存する）
+    if history and is_follow_up(query, app.config['STANDALONE_QUESTION_MIN_CHARS']):
+        return history
+    return None
 
-    # 一時ファイルを削除
-    os.remove(temp_file_path)
+def build_answer_prompt(group_unique_id, query, query_vector=None, lexical=None, history=None):
+    # グループの全データをまとめたインデックスに一度だけ問い合わせる（毎回の埋め込みは行わない）
+    context = "\n\n".join(retrieve_chunk_texts(group_unique_id, query, query_vector, lexical))
+    if history:
+        from chat_memory import QA_WITH_HISTORY_PROMPT
+        return QA_WITH_HISTORY_PROMPT.format(context=context, history=history.format(), question=query)
+    from langchain.chains.question_answering.stuff_prompt import PROMPT as QA_PROMPT
+    return QA_PROMPT.format(context=context, question=query)
+
+def call_in_app_context(func, *args):
+    # 非同期の経路からスレッドで呼ぶ（データベースの読み込みにアプリケーションコンテキストが要る）
+    with app.app_context():
+        return func(*args)
+
+def generate_answer(group_unique_id, query, history=None):
+    # history はプロンプトに入れる会話の履歴（load_prompt_history）
+    history = follow_up_history(query, history)
+    start = time.perf_counter()
+    cached, query_vector, version, lexical = lookup_cached_answer(group_unique_id, query, use_cache=not history)
+    if cached is not None:
+        return cached
+
+    prompt = build_answer_prompt(group_unique_id, query, query_vector, lexical, history)
+    with time_stage('llm'):
+        answer = get_llm().invoke(prompt).strip()
+    if not history:
+        answer_cache.put(group_unique_id, query, answer, query_vector, time.perf_counter() - start, version)
+    return answer
 
+def stream_answer(group_unique_id, query, history=None):
+    # LLMが生成したトークンを順に返す（キャッシュにある場合は回答全体を一度に返す）
+    history = follow_up_history(query, history)
+    start = time.perf_counter()
+    cached, query_vector, version, lexical = lookup_cached_answer(group_unique_id, query, use_cache=not history)
+    if cached is not None:
+        yield cached
+        return
+
+    prompt = build_answer_prompt(group_unique_id, query, query_vector, lexical, history)
+    answer_parts = []
+    with time_stage('llm') as timer:
+        for token in get_llm(streaming=True).stream(prompt):
+            if not answer_parts:
+                observe_stage('llm_first_token', time.perf_counter() - timer.start)
+            answer_parts.append(token)
+            yield token
+    answer = "".join(answer_parts).strip()
+    if not history:
+        answer_cache.put(group_unique_id, query, answer, query_vector, time.perf_counter() - start, version)
+
+# 以下は asgi.py から使う非同期版
+# 埋め込みと LLM の応答はスレッドを使わずに待ち、検索・データベースの読み込み・埋め込みキャッシュの読み書きだけをスレッドで行う
+async def alookup_cached_answer(group_unique_id, query, use_cache=True):
+    version = read_index_version(group_unique_id)
+    answer = answer_cache.get(group_unique_id, query, version) if use_cache else None
+    if answer is not None:
+        return answer, None, version, None
+    lexical = await asyncio.to_thread(call_in_app_context, search_lexical, group_unique_id, query)
+    if is_lexical_confident(lexical):
+        if use_cache:
+            answer_cache.record_miss()
+        return None, None, version, lexical
+    # 最初の呼び出しでは埋め込みキャッシュ（SQLite）を開くので、スレッドで作る
+    embeddings = await asyncio.to_thread(get_embeddings)
+    query_vector = await embeddings.aembed_query(query)
+    answer = answer_cache.get_similar(group_unique_id, query_vector, version) if use_cache else None
+    return answer, query_vector, version, lexical
+
+async def agenerate_answer(group_unique_id, query, history=None):
+    history = follow_up_history(query, history)
+    start = time.perf_counter()
+    cached, query_vector, version, lexical = await alookup_cached_answer(group_unique_id, query,
+                                                                         use_cache=not history)
+    if cached is not None:
+        return cached
+
+    prompt = await asyncio.to_thread(call_in_app_context, build_answer_prompt, group_unique_id, query, query_vector,
+                                     lexical, history)
+    get_openai_clients().use_aiohttp_session()
+    with time_stage('llm'):
+        answer = (await get_llm().ainvoke(prompt)).strip()
+    if not history:
+        answer_cache.put(group_unique_id, query, answer, query_vector, time.perf_counter() - start, version)
     return answer
 
+async def astream_answer(group_unique_id, query, history=None):
+    history = follow_up_history(query, history)
+    start = time.perf_counter()
+    cached, query_vector, version, lexical = await alookup_cached_answer(group_unique_id, query,
+                                                                         use_cache=not history)
+    if cached is not None:
+        yield cached
+        return
+
+    prompt = await asyncio.to_thread(call_in_app_context, build_answer_prompt, group_unique_id, query, query_vector,
+                                     lexical, history)
+    get_openai_clients().use_aiohttp_session()
+    answer_parts = []
+    with time_stage('llm') as timer:
+        async for token in get_llm(streaming=True).astream(prompt):
+            if not answer_parts:
+                observe_stage('llm_first_token', time.perf_counter() - timer.start)
+            answer_parts.append(token)
+            yield token
+    answer = "".join(answer_parts).strip()
+    if not history:
+        answer_cache.put(group_unique_id, query, answer, query_vector, time.perf_counter() - start, version)
+
 # Userモデルの定義 (UserMixinを継承)
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -131,10 +787,10 @@ class User(UserMixin, db.Model):
     group_code = db.Column(db.String(8), nullable=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
     @classmethod
     def create_new_user(cls, mail, password, name, group_code):
@@ -166,10 +822,10 @@ class Group(UserMixin, db.Model):
     name = db.Column(db.String(64), nullable=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
     @classmethod
     def create_new_group(cls, mail, password, name):
@@ -193,6 +849,10 @@ class Group(UserMixin, db.Model):
 
 class Chat(db.Model):
     __tablename__ = 'chats'
+    # ユーザー・チャットページごとに時刻順で取り出すためのインデックス
+    __table_args__ = (
+        db.Index('ix_chats_user_page_time', 'user_unique_id', 'chat_page_index', 'time_stamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_unique_id = db.Column(db.String(10), db.ForeignKey('users.unique_id'), nullable=False)
     time_stamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -207,12 +867,183 @@ class Chat(db.Model):
         self.chat_page_index = chat_page_index
         self.is_user_message = is_user_message  # 新しいカラムを初期化
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'content': self.content,
+            'chat_page_index': self.chat_page_index,
+            'is_user_message': self.is_user_message,
+            'time_stamp': self.time_stamp.isoformat(),
+        }
+
+def load_chat_history(user_unique_id, chat_page_index=0, before_id=None, limit=None):
+    # 新しい順に limit 件を取り出し、表示用に古い順へ並べ替えて返す
+    if limit is None:
+        limit = app.config['CHAT_HISTORY_PAGE_SIZE']
+    query = Chat.query.filter_by(user_unique_id=user_unique_id, chat_page_index=chat_page_index)
+
+    # before_id より前のメッセージだけを取り出す（キーセットページング）
+    if before_id is not None:
+        anchor = Chat.query.filter_by(id=before_id, user_unique_id=user_unique_id).first()
+        if anchor is None:
+            return []
+        query = query.filter(or_(
+            Chat.time_stamp < anchor.time_stamp,
+            and_(Chat.time_stamp == anchor.time_stamp, Chat.id < anchor.id)
+        ))
+
+    chats = query.order_by(Chat.time_stamp.desc(), Chat.id.desc()).limit(limit).all()
+    chats.reverse()
+    return chats
+
+class ChatSession(db.Model):
+    __tablename__ = 'chat_sessions'
+    # ユーザーごとのチャットの一覧（同じ chat_page_index の Chat が1つのチャット）
+    __table_args__ = (
+        db.UniqueConstraint('user_unique_id', 'chat_page_index', name='uq_chat_sessions_user_page'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_unique_id = db.Column(db.String(10), db.ForeignKey('users.unique_id'), nullable=False)
+    chat_page_index = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(64), nullable=False, default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # summarized_until_id までの Chat を要約したもの（回答のプロンプトに入れる）
+    summary = db.Column(db.Text, nullable=False, default='')
+    summarized_until_id = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, user_unique_id, chat_page_index, title=''):
+        self.user_unique_id = user_unique_id
+        self.chat_page_index = chat_page_index
+        self.title = title
+        self.created_at = datetime.utcnow()
+        self.summary = ''
+        self.summarized_until_id = 0
+
+CHAT_TITLE_LENGTH = 30
+
+def list_chat_sessions(user_unique_id):
+    # 新しい順に返す（チャットが1つも無ければ chat_page_index=0 のチャットを作る）
+    chat_sessions = (ChatSession.query.filter_by(user_unique_id=user_unique_id)
+                     .order_by(ChatSession.chat_page_index.desc()).all())
+    return chat_sessions or [get_chat_session(user_unique_id, 0)]
+
+def get_chat_session(user_unique_id, chat_page_index):
+    chat_session = ChatSession.query.filter_by(user_unique_id=user_unique_id, chat_page_index=chat_page_index).first()
+    if chat_session is None and chat_page_index == 0:
+        # これまでのチャットはすべて chat_page_index=0 に保存されているので、最初に使うときに作る
+        first = (db.session.query(Chat.content)
+                 .filter_by(user_unique_id=user_unique_id, chat_page_index=0, is_user_message=True)
+                 .order_by(Chat.id).first())
+        chat_session = add_chat_session(user_unique_id, 0, first.content[:CHAT_TITLE_LENGTH] if first else '')
+    return chat_session
+
+def add_chat_session(user_unique_id, chat_page_index, title=''):
+    db.session.add(ChatSession(user_unique_id, chat_page_index, title))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 別のリクエストが同時に作った場合はそちらを使う
+        db.session.rollback()
+    return ChatSession.query.filter_by(user_unique_id=user_unique_id, chat_page_index=chat_page_index).first()
+
+def create_chat_session(user_unique_id):
+    # 新しいチャットを作る（最新のチャットがまだ空なら、それをそのまま使う）
+    latest = list_chat_sessions(user_unique_id)[0]
+    get_chat_log().flush()
+    has_chats = db.session.query(Chat.id).filter_by(
+        user_unique_id=user_unique_id, chat_page_index=latest.chat_page_index).first() is not None
+    if not has_chats:
+        return latest
+    return add_chat_session(user_unique_id, latest.chat_page_index + 1)
+
+def load_prompt_history(chat_session):
+    # 回答のプロンプトに入れる会話の履歴（会話の要約と、まだ要約していない直近の会話）を作る
+    # 合わせて CHAT_HISTORY_TOKEN_BUDGET トークンに収め、長く続いたチャットでもプロンプトが大きくならない
+    # （保存待ちのチャットは待たない。直前の回答が書き込まれるのは CHAT_LOG_FLUSH_INTERVAL 秒以内）
+    from chat_memory import assemble_history
+    chats = (db.session.query(Chat.is_user_message, Chat.content)
+             .filter(Chat.user_unique_id == chat_session.user_unique_id,
+                     Chat.chat_page_index == chat_session.chat_page_index,
+                     Chat.id > chat_session.summarized_until_id)
+             .order_by(Chat.id.desc()).limit(app.config['CHAT_HISTORY_MAX_MESSAGES']).all())
+    chats.reverse()
+    return assemble_history(chat_session.summary, [tuple(chat) for chat in chats],
+                            app.config['CHAT_HISTORY_TOKEN_BUDGET'])
+
+# 会話の要約は回答の後にバックグラウンドで1つずつ作る（同じチャットの要約は重ねて予約しない）
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-summary')
+summary_jobs = set()
+summary_jobs_lock = threading.Lock()
+summary_stats = {'scheduled': 0, 'summarized': 0, 'summarized_messages': 0, 'conflicts': 0, 'errors': 0,
+                 'time': 0.0}
+
+def schedule_chat_summary(user_unique_id, chat_page_index):
+    key = (user_unique_id, chat_page_index)
+    with summary_jobs_lock:
+        if key in summary_jobs:
+            return
+        summary_jobs.add(key)
+        summary_stats['scheduled'] += 1
+    summary_executor.submit(run_chat_summary, key)
+
+def run_chat_summary(key):
+    # 実行中に届いた回答の分は、次の予約で要約する
+    with summary_jobs_lock:
+        summary_jobs.discard(key)
+    bind_labels('chat_summary')
+    try:
+        with app.app_context():
+            update_chat_summary(*key)
+    except Exception as e:
+        print(f"Error during chat summary: {e}")
+        with summary_jobs_lock:
+            summary_stats['errors'] += 1
+
+def update_chat_summary(user_unique_id, chat_page_index):
+    # まだ要約していない会話のうち古い方を、これまでの要約に書き足す（要約全体は作り直さない）
+    # 直近の会話が予算の半分になるまで要約に回し、毎回の回答のたびに要約しないようにする
+    from chat_memory import message_tokens, select_messages_to_summarize, summarize_messages
+    get_chat_log().flush()
+    chat_session = ChatSession.query.filter_by(user_unique_id=user_unique_id, chat_page_index=chat_page_index).first()
+    if chat_session is None:
+        return
+    history = load_prompt_history(chat_session)
+    chats = (db.session.query(Chat.id, Chat.is_user_message, Chat.content)
+             .filter(Chat.user_unique_id == user_unique_id, Chat.chat_page_index == chat_page_index,
+                     Chat.id > chat_session.summarized_until_id)
+             .order_by(Chat.id).all())
+    token_counts = [message_tokens(chat.is_user_message, chat.content) for chat in chats]
+    if sum(token_counts) <= history.recent_budget:
+        return
+    folded = chats[:select_messages_to_summarize(token_counts, keep_tokens=history.recent_budget // 2,
+                                                 max_tokens=app.config['CHAT_SUMMARY_INPUT_TOKENS'])]
+
+    start = time.perf_counter()
+    with time_stage('llm'):
+        summary = summarize_messages(
+            get_openai_clients().llm(temperature=0, max_tokens=app.config['CHAT_SUMMARY_TOKENS']),
+            chat_session.summary, [(chat.is_user_message, chat.content) for chat in folded],
+            app.config['CHAT_SUMMARY_TOKENS'])
+    # 要約している間にほかのスレッドが要約を進めていたら、この結果は捨てる
+    updated = ChatSession.query.filter_by(
+        id=chat_session.id, summarized_until_id=chat_session.summarized_until_id
+    ).update({'summary': summary, 'summarized_until_id': folded[-1].id})
+    db.session.commit()
+    with summary_jobs_lock:
+        if updated:
+            summary_stats['summarized'] += 1
+            summary_stats['summarized_messages'] += len(folded)
+        else:
+            summary_stats['conflicts'] += 1
+        summary_stats['time'] += time.perf_counter() - start
+
 class Data(db.Model):
     __tablename__ = 'data'
     id = db.Column(db.Integer, primary_key=True)
     group_unique_id = db.Column(db.String(8), db.ForeignKey('groups.unique_code'), nullable=False)
     file_name = db.Column(db.String(256), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    # 全文はチャットでは使わないので、明示的に参照したときだけ読み込む
+    content = db.deferred(db.Column(db.Text, nullable=False))
     data_name = db.Column(db.String(64), nullable=False)
 
     group = db.relationship('Group', backref=db.backref('data', lazy=True))
@@ -223,6 +1054,245 @@ class Data(db.Model):
         self.content = content
         self.data_name = data_name
 
+class DataPage(db.Model):
+    __tablename__ = 'data_pages'
+    __table_args__ = (
+        db.UniqueConstraint('data_id', 'page_no'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    data_id = db.Column(db.Integer, db.ForeignKey('data.id'), nullable=False)
+    page_no = db.Column(db.Integer, nullable=False)
+    # ページを改行でつないだ全文の中での開始・終了位置
+    char_start = db.Column(db.Integer, nullable=False)
+    char_end = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+
+    def __init__(self, data_id, page_no, content, char_start):
+        self.data_id = data_id
+        self.page_no = page_no
+        self.content = content
+        self.char_start = char_start
+        self.char_end = char_start + len(content)
+        self.content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+class DataChunk(db.Model):
+    __tablename__ = 'data_chunks'
+    __table_args__ = (
+        db.Index('ix_data_chunks_data_page', 'data_id', 'page_no'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    data_id = db.Column(db.Integer, db.ForeignKey('data.id'), nullable=False)
+    group_unique_id = db.Column(db.String(8), db.ForeignKey('groups.unique_code'), nullable=False, index=True)
+    page_no = db.Column(db.Integer, nullable=False)
+    # ページの中での開始・終了位置
+    char_start = db.Column(db.Integer, nullable=False)
+    char_end = db.Column(db.Integer, nullable=False)
+    token_count = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+
+    def __init__(self, data_id, group_unique_id, page_no, content, char_start, char_end, token_count):
+        self.data_id = data_id
+        self.group_unique_id = group_unique_id
+        self.page_no = page_no
+        self.content = content
+        self.char_start = char_start
+        self.char_end = char_end
+        self.token_count = token_count
+        self.content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def to_document(self):
+        from langchain.schema import Document
+        return Document(
+            page_content=self.content,
+            metadata={'data_id': self.data_id, 'page': self.page_no, 'chunk_id': self.id}
+        )
+
+class IngestJob(db.Model):
+    __tablename__ = 'ingest_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    group_unique_id = db.Column(db.String(8), db.ForeignKey('groups.unique_code'), nullable=False)
+    file_name = db.Column(db.String(256), nullable=False)
+    data_name = db.Column(db.String(64), nullable=False)
+    file_path = db.Column(db.String(512), nullable=False)
+    # queued -> parsing -> embedding（解析・分割・埋め込み・索引への追加をページ順に行う） -> done / error
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    total_pages = db.Column(db.Integer, nullable=False, default=0)
+    processed_pages = db.Column(db.Integer, nullable=False, default=0)
+    total_chunks = db.Column(db.Integer, nullable=False, default=0)
+    processed_chunks = db.Column(db.Integer, nullable=False, default=0)
+    data_id = db.Column(db.Integer, db.ForeignKey('data.id'), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __init__(self, group_unique_id, file_name, data_name, file_path):
+        self.group_unique_id = group_unique_id
+        self.file_name = file_name
+        self.data_name = data_name
+        self.file_path = file_path
+        self.status = 'queued'
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'file_name': self.file_name,
+            'data_name': self.data_name,
+            'status': self.status,
+            'total_pages': self.total_pages,
+            'processed_pages': self.processed_pages,
+            'total_chunks': self.total_chunks,
+            'processed_chunks': self.processed_chunks,
+            'data_id': self.data_id,
+            'error': self.error,
+        }
+
+def is_data_ready():
+    # 取り込みジョブが終わっていないデータを除く条件（チャットの検索とインデックスの作り直しで使う）
+    return ~db.session.query(IngestJob.id).filter(
+        IngestJob.data_id == Data.id,
+        IngestJob.status.notin_(['done', 'error'])
+    ).exists()
+
+# アップロードされたPDFの取り込み（解析→分割→埋め込み→索引作成）はバックグラウンドで行う
+ingest_executor = ThreadPoolExecutor(max_workers=app.config['INGEST_WORKERS'])
+
+def get_upload_dir():
+    upload_dir = os.path.join(app.instance_path, 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+    return upload_dir
+
+def update_job(job, **fields):
+    for key, value in fields.items():
+        setattr(job, key, value)
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def run_ingest_job(job_id):
+    with app.app_context():
+        job = db.session.get(IngestJob, job_id)
+        if job is None:
+            return
+        bind_labels('ingest', job.group_unique_id)
+        new_data = None
+        try:
+            # 前回の実行が途中で止まっていた場合は、書きかけのデータを消してからやり直す
+            if job.data_id is not None:
+                discard_data(job, db.session.get(Data, job.data_id))
+            update_job(job, status='parsing', processed_pages=0, processed_chunks=0, total_chunks=0)
+            total_pages = count_pages(job.file_path)
+            new_data = Data(
+                group_unique_id=job.group_unique_id,
+                file_name=job.file_name,
+                content='',
+                data_name=job.data_name
+            )
+            db.session.add(new_data)
+            db.session.commit()
+            update_job(job, status='embedding', total_pages=total_pages, data_id=new_data.id)
+
+            # 本文はページごとに data_pages に保存し、全文（Data.content）は作らない
+            def store_pages():
+                # PDF の解析時間は、ページを取り出すのにかかった時間の合計を1回分として記録する
+                pdf_pages = TimedIterator(iter_pdf_pages(job.file_path, **pdf_extract_options()))
+                yield from pdf_pages
+                observe_stage('pdf_parse', pdf_pages.elapsed)
+
+            def on_progress(pages_done, chunks_done):
+                update_job(job, processed_pages=pages_done, processed_chunks=chunks_done)
+
+            add_data_to_group_index(new_data, pages=store_pages(), on_progress=on_progress)
+
+            # 重複データのチェック（ページの本文の比較はデータベース側でハッシュで行う）
+            existing_data = find_duplicate_data(new_data)
+            if existing_data:
+                discard_data(job, new_data)
+                update_job(job, status='error', error='そのファイルはすでに登録されています')
+                return
+
+            update_job(job, status='done', total_chunks=job.processed_chunks)
+        except Exception as e:
+            print(f"Error during ingest job {job_id}: {e}")
+            db.session.rollback()
+            if new_data is not None and new_data.id is not None:
+                discard_data(job, new_data)
+            update_job(job, status='error', error=str(e))
+        finally:
+            if job.status in ('done', 'error') and os.path.exists(job.file_path):
+                os.remove(job.file_path)
+
+def find_duplicate_data(data):
+    # 同じファイル名・データ名で、全ページの本文が同じ（ページ数とページごとのハッシュが一致する）データを探す
+    # ページを保存する前に登録されたデータとは比べない
+    new_page = db.aliased(DataPage)
+    old_page = db.aliased(DataPage)
+    page_count = db.select(db.func.count(new_page.id)).where(new_page.data_id == data.id).scalar_subquery()
+    old_page_count = db.select(db.func.count(old_page.id)).where(old_page.data_id == Data.id).scalar_subquery()
+    # 入れ子の EXISTS では Data が自動で外側と結び付かないので、明示する
+    differs = db.exists().where(
+        new_page.data_id == data.id,
+        ~db.exists().where(
+            old_page.data_id == Data.id,
+            old_page.page_no == new_page.page_no,
+            old_page.content_hash == new_page.content_hash,
+        ).correlate_except(old_page),
+    ).correlate_except(new_page)
+    return db.session.query(Data.id).filter(
+        Data.id != data.id,
+        Data.group_unique_id == data.group_unique_id,
+        Data.file_name == data.file_name,
+        Data.data_name == data.data_name,
+        old_page_count == page_count,
+        ~differs,
+    ).first()
+
+def discard_data(job, data):
+    # 取り込みに失敗したデータをインデックスとデータベースから消す
+    job.data_id = None
+    if data is not None:
+        remove_data_from_group_index(data)
+        delete_data_rows(data.id)
+        db.session.delete(data)
+    db.session.commit()
+
+def find_interrupted_ingest_jobs():
+    return [job_id for job_id, in db.session.query(IngestJob.id).filter(IngestJob.status.notin_(['done', 'error']))]
+
+def resume_ingest_jobs(job_ids=None):
+    # 再起動で中断されたジョブを再投入する
+    if job_ids is None:
+        job_ids = find_interrupted_ingest_jobs()
+    for job_id in job_ids:
+        ingest_executor.submit(run_ingest_job, job_id)
+
+# gunicorn では、中断されたジョブをマスターで書き出しておき（save_interrupted_ingest_jobs）、
+# 最初に起動したワーカーだけが再投入する（claim_interrupted_ingest_jobs）
+# 書き出した後にワーカーが受け付けたジョブは含まないので、実行中のジョブを二重に動かさない
+def get_interrupted_jobs_path():
+    return os.path.join(app.instance_path, 'interrupted_ingest_jobs.json')
+
+def save_interrupted_ingest_jobs():
+    with app.app_context():
+        job_ids = find_interrupted_ingest_jobs()
+    with open(get_interrupted_jobs_path(), 'w') as f:
+        json.dump(job_ids, f)
+
+def claim_interrupted_ingest_jobs():
+    # ファイルの名前の変更はどれか1つのプロセスだけが成功する
+    path = get_interrupted_jobs_path()
+    claimed_path = f'{path}.{os.getpid()}'
+    try:
+        os.rename(path, claimed_path)
+    except FileNotFoundError:
+        return
+    with open(claimed_path) as f:
+        job_ids = json.load(f)
+    os.remove(claimed_path)
+    resume_ingest_jobs(job_ids)
+
 class FileUploadForm(FlaskForm):
     file = FileField('File', validators=[FileRequired()])
     data_name = StringField('Data Name', validators=[DataRequired()])
@@ -234,12 +1304,52 @@ class LogoutForm(FlaskForm):
 # Flask-Login用のユーザーローダー関数
 @login_manager.user_loader
 def load_user(user_id):
+    # リクエストごとにデータベースを引かないよう、列の値をキャッシュしておき、その値からモデルを作る
+    # （パスワードのハッシュは持たない。ログインの確認は User.query で行う）
     user_type = session.get('user_type')
     if user_type == 'user':
-        return User.query.get(int(user_id))
+        model = User
     elif user_type == 'group':
-        return Group.query.get(int(user_id))
-    return None
+        model = Group
+    else:
+        return None
+    key = (user_type, int(user_id))
+    fields = identity_cache.get(key)
+    if fields is MISSING:
+        token = identity_cache.token()
+        account = model.query.get(int(user_id))
+        if account is None:
+            return None
+        fields = {column.key: getattr(account, column.key)
+                  for column in model.__table__.columns if column.key != 'password_hash'}
+        identity_cache.put(key, fields, token)
+    return model(**fields)
+
+@event.listens_for(db.session, 'after_flush')
+def collect_identity_changes(session, flush_context):
+    # 変更されたユーザー・グループ・データに対応するキーを集め、コミットしたときに消す
+    keys = session.info.setdefault('identity_changes', set())
+    for obj in [*session.new, *session.dirty, *session.deleted]:
+        if isinstance(obj, User):
+            keys.add(('user', obj.id))
+        elif isinstance(obj, Group):
+            keys.update({('group', obj.id), ('group_code', str(obj.id))})
+        elif isinstance(obj, Data):
+            keys.update({('group_data', obj.group_unique_id), ('index', obj.group_unique_id),
+                         ('lexical', obj.group_unique_id)})
+        elif isinstance(obj, IngestJob):
+            # 取り込みが終わるまでデータはチャットで使わない（resolve_chat_group）
+            keys.add(('group_data', obj.group_unique_id))
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_identity_cache(session):
+    keys = session.info.pop('identity_changes', None)
+    if keys:
+        identity_cache.invalidate(*keys)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_identity_changes(session):
+    session.info.pop('identity_changes', None)
 
 # ログインフォームの定義
 class LoginForm(FlaskForm):
@@ -270,12 +1380,39 @@ class AuthorRegistrationForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     submit = SubmitField('Register')
 
+def authenticate(model, mail, password):
+    # パスワードが正しければアカウントを返す
+    # ハッシュの方式（コスト）が PASSWORD_HASH_METHOD と違えば、ログインのついでに作り直す
+    account = model.query.filter_by(mail=mail).first()
+    if account is None or not account.check_password(password):
+        return None
+    if password_hasher.needs_rehash(account.password_hash):
+        try:
+            account.set_password(password)
+            db.session.commit()
+        except HashQueueFull:
+            # 混んでいるときは作り直しを次のログインに回す
+            pass
+    return account
+
+def login_busy_response(template, title, form):
+    flash('ログインが混み合っています。しばらくしてからもう一度お試しください', 'danger')
+    return render_template(template, title=title, form=form), 503, {'Retry-After': '5'}
+
+@app.errorhandler(HashQueueFull)
+def handle_hash_queue_full(e):
+    # 登録などでハッシュの待ち行列があふれた場合
+    return {'status': 'error', 'message': 'Server is busy. Please try again later.'}, 503, {'Retry-After': '5'}
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(mail=form.mail.data).first()
-        if user and user.check_password(form.password.data):
+        try:
+            user = authenticate(User, form.mail.data, form.password.data)
+        except HashQueueFull:
+            return login_busy_response('login.html', 'Login', form)
+        if user:
             login_user(user, remember=True)
             session['user_type'] = 'user'
             flash('Login Successful!', 'success')
@@ -306,8 +1443,11 @@ def register():
 def author_login():
     form = AuthorLoginForm()
     if form.validate_on_submit():
-        group = Group.query.filter_by(mail=form.mail.data).first()
-        if group and group.check_password(form.password.data):
+        try:
+            group = authenticate(Group, form.mail.data, form.password.data)
+        except HashQueueFull:
+            return login_busy_response('author_login.html', 'Author Login', form)
+        if group:
             logout_user()  # 既存のUserログイン情報をクリア
             login_user(group, remember=True)
             session['user_type'] = 'group'
@@ -321,7 +1461,12 @@ def author_login():
 @login_required
 def author_page():
     form = LogoutForm()
-    return render_template('author_page.html', title='Author Page', form=form)
+    jobs = []
+    if isinstance(current_user, Group):
+        jobs = IngestJob.query.filter_by(group_unique_id=current_user.unique_code) \
+            .order_by(IngestJob.id.desc()).limit(10).all()
+    return render_template('author_page.html', title='Author Page', form=form, jobs=jobs,
+                           provision_form=ProvisionUsersForm())
 
 @app.route('/author_register', methods=['GET', 'POST'])
 def author_register():
@@ -339,17 +1484,117 @@ def author_register():
             flash('Email already exists. Please choose a different one.', 'danger')
     return render_template('author_register.html', title='Author Register', form=form)
 
+class ProvisionUsersForm(FlaskForm):
+    file = FileField('CSV (mail,password,name)', validators=[FileRequired()])
+    submit = SubmitField('Register Users')
+
+def provision_users(group, text):
+    # CSV のユーザーをグループに一括で登録し、結果を返す（全員を1回のコミットで登録する）
+    rows, errors = parse_users_csv(text, max_users=app.config['PROVISION_MAX_USERS'])
+    workers = app.config['PROVISION_HASH_WORKERS']
+    pool = get_process_pool(workers) if workers > 1 else None
+    hashes = hash_passwords([row.pop('password') for row in rows], pool, workers,
+                            method=app.config['PASSWORD_HASH_METHOD'])
+    for row, password_hash in zip(rows, hashes):
+        row.update(password_hash=password_hash, group_code=str(group.id))
+    try:
+        created, existing = insert_users(db.session.connection(), User.__table__, rows,
+                                         batch_size=app.config['PROVISION_BATCH_SIZE'])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {
+        'created': len(created),
+        'existing': existing,
+        'errors': [{'line': line, 'message': message} for line, message in errors],
+    }
+
+@app.cli.command('provision-users')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--group', 'group_code', required=True, help='登録先のグループの unique_code')
+def provision_users_command(csv_file, group_code):
+    # flask --app app provision-users users.csv --group <unique_code>
+    group = Group.query.filter_by(unique_code=group_code).first()
+    if group is None:
+        raise click.ClickException(f'group not found: {group_code}')
+    start = time.perf_counter()
+    try:
+        result = provision_users(group, csv_file.read())
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+    click.echo(f"created {result['created']} users in {elapsed:.1f}s")
+    for mail in result['existing']:
+        click.echo(f'already registered: {mail}')
+    for error in result['errors']:
+        click.echo(f"line {error['line']}: {error['message']}")
+
+@app.route('/provision_users', methods=['POST'])
+@login_required
+def provision_users_view():
+    # 作成者（グループ）だけが自分のグループにユーザーを一括登録できる
+    if not isinstance(current_user, Group):
+        return {'status': 'error', 'message': 'Only authors can register users'}, 403
+    form = ProvisionUsersForm()
+    if not form.validate_on_submit():
+        flash('CSVファイルを選択してください', 'danger')
+        return redirect(url_for('author_page'))
+    try:
+        result = provision_users(current_user, form.file.data.read().decode('utf-8-sig'))
+    except (ValueError, UnicodeDecodeError) as e:
+        flash(f'CSVを読み込めませんでした: {e}', 'danger')
+        return redirect(url_for('author_page'))
+
+    flash(f"{result['created']}人のユーザーを登録しました", 'success')
+    if result['existing']:
+        flash(f"登録済みのメールアドレス: {', '.join(result['existing'])}", 'danger')
+    for error in result['errors']:
+        flash(f"{error['line']}行目: {error['message']}", 'danger')
+    return redirect(url_for('author_page'))
+
 @app.route('/chachat')
 @login_required
 def chachat():
-    user_chats = Chat.query.filter_by(user_unique_id=current_user.unique_id).all()
-    return render_template('chachat.html', title='chachat_main', chats=user_chats)
+    # 最新の数件だけを表示し、それより前はスクロール時に /chat_history から読み込む
+    # 保存待ちのチャットも表示されるよう、先に書き込んでおく
+    # ?page= を指定しなければ最新のチャットを開く
+    get_chat_log().flush()
+    chat_sessions = list_chat_sessions(current_user.unique_id)
+    chat_page_index = request.args.get('page', chat_sessions[0].chat_page_index, type=int)
+    if all(chat_session.chat_page_index != chat_page_index for chat_session in chat_sessions):
+        abort(404)
+    user_chats = load_chat_history(current_user.unique_id, chat_page_index)
+    has_more = len(user_chats) >= app.config['CHAT_HISTORY_PAGE_SIZE']
+    return render_template('chachat.html', title='chachat_main', chats=user_chats, has_more=has_more,
+                           chat_sessions=chat_sessions, chat_page_index=chat_page_index)
+
+@app.route('/new_chat', methods=['POST'])
+@login_required
+def new_chat():
+    chat_session = create_chat_session(current_user.unique_id)
+    return redirect(url_for('chachat', page=chat_session.chat_page_index))
+
+@app.route('/chat_history')
+@login_required
+def chat_history():
+    # 0 や負の値（LIMIT -1 は全件）で全履歴を返さないよう、1〜200 件に収める
+    limit = max(1, min(request.args.get('limit', app.config['CHAT_HISTORY_PAGE_SIZE'], type=int), 200))
+    get_chat_log().flush()
+    chats = load_chat_history(
+        current_user.unique_id,
+        chat_page_index=request.args.get('page', 0, type=int),
+        before_id=request.args.get('before', type=int),
+        limit=limit
+    )
+    return jsonify({'chats': [chat.to_dict() for chat in chats], 'has_more': len(chats) >= limit})
 
 @app.route('/file_upload', methods=['GET', 'POST'])
 @login_required
 def file_upload():
     form = FileUploadForm()
-    return render_template('file_upload.html', title='File Upload', form=form)
+    job_id = request.args.get('job_id', type=int)
+    return render_template('file_upload.html', title='File Upload', form=form, job_id=job_id)
 
 @app.route('/upload_file', methods=['POST'])
 @login_required
@@ -365,19 +1610,6 @@ def upload_file():
 
     if file:
         filename = secure_filename(file.filename)
-
-        # 一時ファイルに保存
-        with NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(file.read())
-            temp_file_path = temp_file.name
-
-        # ファイル内容をテキストに変換
-        pages = split_pdf(temp_file_path)
-        content = "\n".join([page.page_content for page in pages])
-
-        # 一時ファイルを削除
-        os.remove(temp_file_path)
-
         data_name = request.form['data_name']
 
         # current_user のクラスに応じて unique_id または unique_code を使用
@@ -389,121 +1621,230 @@ def upload_file():
             flash('Unknown user type', 'danger')
             return redirect(url_for('file_upload'))
 
-        # 重複データのチェック
-        existing_data = Data.query.filter_by(
-            group_unique_id=unique_id,
-            file_name=filename,
-            content=content,
-            data_name=data_name
-        ).first()
-
-        if existing_data:
-            flash('そのファイルはすでに登録されています', 'danger')
-            return redirect(url_for('file_upload'))
+        # ファイルを保存したらすぐに返し、取り込みはバックグラウンドで行う
+        # アップロードは一定の大きさずつコピーし、ファイル全体をメモリに読み込まない
+        file_path = os.path.join(get_upload_dir(), f"{uuid.uuid4().hex}_{filename}")
+        set_group_label(unique_id)
+        with time_stage('upload_read'):
+            file.save(file_path, buffer_size=app.config['UPLOAD_CHUNK_BYTES'])
 
-        new_data = Data(
+        job = IngestJob(
             group_unique_id=unique_id,
             file_name=filename,
-            content=content,
-            data_name=data_name
+            data_name=data_name,
+            file_path=file_path
         )
-        db.session.add(new_data)
+        db.session.add(job)
         db.session.commit()
-        flash('File successfully uploaded and data saved!', 'success')
-        return redirect(url_for('file_upload'))
-
-    if 'file' not in request.files:
-        flash('No file part', 'danger')
-        return redirect(request.url)
-
-    file = request.files['file']
-    if file.filename == '':
-        flash('No selected file', 'danger')
-        return redirect(request.url)
-
-    if file:
-        filename = secure_filename(file.filename)
-
-        # 一時ファイルに保存
-        with NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(file.read())
-            temp_file_path = temp_file.name
+        ingest_executor.submit(run_ingest_job, job.id)
 
-        # ファイル内容をテキストに変換
-        pages = split_pdf(temp_file_path)
-        content = "\n".join([page.page_content for page in pages])
+        flash('ファイルを受け付けました。取り込みが完了するまでお待ちください', 'success')
+        return redirect(url_for('file_upload', job_id=job.id))
 
-        # 一時ファイルを削除
-        os.remove(temp_file_path)
-
-        data_name = request.form['data_name']
-
-        # current_user のクラスに応じて unique_id または unique_code を使用
-        if isinstance(current_user, User):
-            unique_id = current_user.unique_id
-        elif isinstance(current_user, Group):
-            unique_id = current_user.unique_code
-        else:
-            flash('Unknown user type', 'danger')
-            return redirect(url_for('file_upload'))
-
-        new_data = Data(
-            group_unique_id=unique_id,
-            file_name=filename,
-            content=content,
-            data_name=data_name
-        )
-        db.session.add(new_data)
-        db.session.commit()
-        flash('File successfully uploaded and data saved!', 'success')
-        return redirect(url_for('file_upload'))
+@app.route('/upload_status/<int:job_id>')
+@login_required
+def upload_status(job_id):
+    job = db.session.get(IngestJob, job_id)
+    owner_id = current_user.unique_code if isinstance(current_user, Group) else current_user.unique_id
+    if job is None or job.group_unique_id != owner_id:
+        return {'status': 'error', 'message': 'Job not found'}, 404
+    return jsonify(job.to_dict())
 
 @app.route('/save_chat', methods=['POST'])
 @login_required
 def save_chat():
     data = request.get_json()
-    received_message = data['content']
-    is_user_message = data['is_user_message']
+    user_chat, group_unique_id, history = prepare_chat(data)
+
+    if group_unique_id is not None and data.get('stream'):
+        print(f"Found data for group: {group_unique_id}")
+        return stream_chat_response(group_unique_id, user_chat, history)
+    elif group_unique_id is not None:
+        print(f"Found data for group: {group_unique_id}")
+        try:
+            answer = generate_answer(group_unique_id, user_chat.content, history)
+            print(f"Generated answer: {answer}")
+
+            # 生成された回答を保存
+            save_chat_turn(user_chat, answer, history)
+
+            return {'status': 'success', 'answer': answer}, 200
+        except Exception as e:
+            print(f"Error during chat saving or answering: {e}")
+            save_chats(user_chat)
+            return {'status': 'error', 'message': str(e)}, 500
+    else:
+        return no_data_response(user_chat)
+
+def prepare_chat(data):
+    # 質問のチャットと、回答に使うグループの unique_code（データが無ければ None）と、
+    # プロンプトに入れる会話の履歴（データが無ければ None）を返す
+    # ユーザーのチャットは回答と一緒に保存する（save_chats）
+    # （回答の生成中にセッションへ追加しておくと、自動フラッシュで書き込みロックを取ったままになる）
+    try:
+        chat_page_index = int(data.get('chat_page_index', 0))
+    except (TypeError, ValueError):
+        abort(400)
+    chat_session = get_chat_session(current_user.unique_id, chat_page_index)
+    if chat_session is None:
+        abort(404)
+    if not chat_session.title and data['is_user_message']:
+        # チャットの一覧には最初の質問を表示する
+        chat_session.title = data['content'][:CHAT_TITLE_LENGTH]
+        db.session.commit()
 
-    # ユーザーのチャットを保存
     user_chat = Chat(
         user_unique_id=current_user.unique_id,
-        content=received_message,
-        chat_page_index=0,
-        is_user_message=is_user_message
+        content=data['content'],
+        chat_page_index=chat_page_index,
+        is_user_message=data['is_user_message']
     )
-    db.session.add(user_chat)
-    db.session.commit()
 
-    # データベースから回答を生成するためのデータを取得
-    group_code = current_user.group_code
-    group = Group.query.filter_by(id=group_code).first()
-    data_entry = Data.query.filter_by(group_unique_id=group.unique_code).first()
+    group_unique_id = resolve_chat_group(current_user.group_code)
+    set_group_label(group_unique_id)
+    history = load_prompt_history(chat_session) if group_unique_id is not None else None
+    return user_chat, group_unique_id, history
+
+def resolve_chat_group(group_code):
+    # グループの unique_code と、そのグループにデータがあるかはキャッシュから引く
+    token = identity_cache.token()
+    group_unique_id = identity_cache.get(('group_code', group_code))
+    if group_unique_id is MISSING:
+        group = Group.query.filter_by(id=group_code).first()
+        group_unique_id = group.unique_code if group is not None else None
+        identity_cache.put(('group_code', group_code), group_unique_id, token)
+    if group_unique_id is None:
+        return None
+
+    has_data = identity_cache.get(('group_data', group_unique_id))
+    if has_data is MISSING:
+        has_data = db.session.query(Data.id).filter_by(group_unique_id=group_unique_id) \
+            .filter(is_data_ready()).first() is not None
+        identity_cache.put(('group_data', group_unique_id), has_data, token)
+    return group_unique_id if has_data else None
+
+def make_bot_chat(user_chat, answer):
+    return Chat(
+        user_unique_id=user_chat.user_unique_id,
+        content=answer,
+        chat_page_index=user_chat.chat_page_index,
+        is_user_message=False
+    )
 
-    if data_entry:
-        data_content = data_entry.content
-        print(f"Found data content: {data_entry}")
+def no_data_response(user_chat):
+    print("No data content found for the group")
+    save_chats(user_chat)
+    return {'status': 'error', 'message': 'No data content found'}, 404
+
+def save_chats(*chats):
+    # チャットはキューに入れるだけで、書き込みはバックグラウンドでまとめて行う
+    # 1回のリクエストで保存するチャットは同じバッチに入るので、まとめて1回でコミットされる
+    get_chat_log().put(*chats)
+
+def save_chat_turn(user_chat, answer, history):
+    # 質問と回答を保存し、直近の会話が予算を超えたら会話の要約を進める
+    from chat_memory import message_tokens
+    save_chats(user_chat, make_bot_chat(user_chat, answer))
+    new_tokens = message_tokens(True, user_chat.content) + message_tokens(False, answer)
+    if history is not None and history.needs_summary(new_tokens):
+        schedule_chat_summary(user_chat.user_unique_id, user_chat.chat_page_index)
+
+chat_log = None
+chat_log_lock = threading.Lock()
+
+def get_chat_log():
+    # 書き込み用のスレッドを持つので、fork 後のワーカープロセスで最初に使うときに作る
+    global chat_log
+    with chat_log_lock:
+        if chat_log is None:
+            chat_log = WriteBehindQueue(
+                write_chats,
+                max_batch=app.config['CHAT_LOG_BATCH_SIZE'],
+                max_delay=app.config['CHAT_LOG_FLUSH_INTERVAL'],
+                name='chat-log',
+            )
+            # 終了時に残っているチャットを書き込む
+            atexit.register(chat_log.close)
+    return chat_log
+
+def write_chats(chats):
+    # 書き込み用のスレッドや、ほかのリクエストから呼ばれるので、ルートは chat_log として記録する
+    with app.app_context(), time_stage('db_commit', labels=('', 'chat_log')):
+        db.session.bulk_save_objects(chats)
+        db.session.commit()
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def stream_chat_response(group_unique_id, user_chat, history=None):
+    # Server-Sent Events 形式でトークンを送り、最後に質問と回答全体を保存する
+    def generate():
+        answer_parts = []
         try:
-            answer = generate_answer(data_content, received_message)
+            for token in stream_answer(group_unique_id, user_chat.content, history):
+                answer_parts.append(token)
+                yield sse_event({'token': token})
+
+            answer = "".join(answer_parts).strip()
             print(f"Generated answer: {answer}")
 
             # 生成された回答を保存
-            bot_chat = Chat(
-                user_unique_id=current_user.unique_id,
-                content=answer,
-                chat_page_index=0,
-                is_user_message=False
-            )
-            db.session.add(bot_chat)
-            db.session.commit()
+            save_chat_turn(user_chat, answer, history)
 
-            return {'status': 'success', 'answer': answer}, 200
+            yield sse_event({'status': 'success', 'done': True})
         except Exception as e:
-            print(f"Error during chat saving or answering: {e}")
-            return {'status': 'error', 'message': str(e)}, 500
-    else:
-        print("No data content found for the group")
-        return {'status': 'error', 'message': 'No data content found'}, 404
+            print(f"Error during chat streaming: {e}")
+            save_chats(user_chat)
+            yield sse_event({'status': 'error', 'message': str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    # キャッシュの調整用にヒット率や節約できた時間を返す
+    # スケジューラーと OpenAI のクライアントは、まだ作っていなければ（API キーが無い場合など）ここでは作らず null を返す
+    return jsonify({
+        'answer_cache': answer_cache.stats(),
+        'embedding_cache': get_embedding_cache().stats(),
+        'embedding_scheduler': embedding_scheduler.stats() if embedding_scheduler is not None else None,
+        'chat_log': get_chat_log().stats(),
+        'openai': openai_clients.stats() if openai_clients is not None else None,
+        'identity_cache': identity_cache.stats(),
+        'password_hasher': password_hasher.stats(),
+        'retrieval': dict(retrieval_stats),
+        'chat_summary': dict(summary_stats),
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus から取得する（ログインは不要。METRICS_TOKEN を設定した場合はトークンが必要）
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    body = metrics_registry.render(get_metrics_exporter().collect())
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.before_request
+def bind_request_labels():
+    # 処理時間はリクエストのルール（/upload_status/<int:job_id> など）ごとに記録する
+    get_metrics_exporter()
+    bind_labels(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # ストリーミングのレスポンスは、本文を送り終えるまでではなくヘッダーを返すまでの時間になる
+    start = g.get('request_start')
+    if start is not None:
+        observe_request(response.status_code, time.perf_counter() - start)
+    return response
 
 @app.route('/logout', methods=['GET', 'POST'])
 def logout():
@@ -518,7 +1859,30 @@ def logout():
 def index():
     return render_template("index.html")
 
-if __name__ == '__main__':
+def init_app():
+    # サーバーの起動時に一度だけ行う（asgi.py からも呼ぶ）
+    create_tables()
+    with app.app_context():
+        resume_ingest_jobs()
+    preload_rag()
+
+def create_tables():
     with app.app_context():
         db.create_all()
+        # 既存のテーブルには create_all でインデックスが追加されないため個別に作成する
+        for index in Chat.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def preload_rag():
+    # 回答の生成と取り込みで使うライブラリを読み込み、クライアントを作っておく
+    # （最初の質問を待たせないため。gunicorn では fork の前にマスターで呼ぶ）
+    import chat_memory, chunker, embedding_cache, embedding_scheduler, lexical_index, numpy_store  # noqa: F401
+    import pypdf  # noqa: F401
+    from langchain.chains.question_answering.stuff_prompt import PROMPT  # noqa: F401
+    from numpy_store import vectorstore_class
+    vectorstore_class(app.config['VECTOR_STORE'])
+    get_openai_clients()
+
+if __name__ == '__main__':
+    init_app()
     app.run(host="0.0.0.0", port=80, debug=False)
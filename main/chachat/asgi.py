@@ -0,0 +1,167 @@
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+from flask_login import current_user
+from uvicorn.middleware.wsgi import WSGIMiddleware, build_environ
+from werkzeug.exceptions import HTTPException
+
+from app import (
+    app as flask_app, login_manager, init_app, prepare_chat, no_data_response, agenerate_answer, astream_answer,
+    save_chats, save_chat_turn, get_chat_log, get_openai_clients, sse_event, SSE_HEADERS, bind_labels,
+    observe_request,
+)
+
+# 非同期で動かす場合の入口（ASGI）
+#   uvicorn asgi:app --host 0.0.0.0 --port 80
+# /save_chat だけをイベントループ上で処理し、LLM の応答を待つ間にスレッドを占有しない
+# それ以外の画面や API はこれまでどおり Flask（WSGI）をスレッドプールで動かす
+# スレッド数は環境変数 CHACHAT_ASGI_THREADS で指定する（Flask の処理と、検索・データベースの読み込みに使う）
+
+ASGI_THREADS = int(os.environ.get('CHACHAT_ASGI_THREADS', 10))
+
+
+class ChachatASGI:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+        self.threads = threads
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == '/save_chat' and scope['method'] == 'POST':
+            await self.save_chat(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # asyncio.to_thread で使うスレッドの数をそろえる
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.threads))
+                await asyncio.to_thread(init_app)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.to_thread(get_chat_log().flush)
+                await get_openai_clients().aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def save_chat(self, scope, receive, send):
+        start = time.perf_counter()
+        body = await read_body(receive)
+        # ログインと CSRF の確認、グループの取得は Flask の処理をそのまま使う
+        response, chat = await asyncio.to_thread(prepare_chat_request, scope, body)
+        if response is not None:
+            await send_flask_response(send, response)
+            return
+
+        user_chat, group_unique_id, history, stream = chat
+        # Flask の処理はスレッドで行ったので、ここで改めてラベルを決める（処理時間は Flask と同じく記録する）
+        bind_labels('/save_chat', group_unique_id)
+        print(f"Found data for group: {group_unique_id}")
+        if stream:
+            await stream_chat(send, group_unique_id, user_chat, history, start)
+            return
+        try:
+            answer = await agenerate_answer(group_unique_id, user_chat.content, history)
+            print(f"Generated answer: {answer}")
+            save_chat_turn(user_chat, answer, history)
+            observe_request(200, time.perf_counter() - start)
+            await send_json(send, 200, {'status': 'success', 'answer': answer})
+        except Exception as e:
+            print(f"Error during chat saving or answering: {e}")
+            save_chats(user_chat)
+            observe_request(500, time.perf_counter() - start)
+            await send_json(send, 500, {'status': 'error', 'message': str(e)})
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return body
+
+
+def prepare_chat_request(scope, body):
+    # 回答の生成に進む場合は (None, (質問のチャット, グループ, 会話の履歴, ストリーミングするか)) を、
+    # それ以外は (Flask のレスポンス, None) を返す
+    environ = build_environ(scope, {'type': 'http.request', 'body': body}, io.BytesIO(body))
+    with flask_app.request_context(environ):
+        try:
+            rv = flask_app.preprocess_request()
+            if rv is None and not current_user.is_authenticated:
+                rv = login_manager.unauthorized()
+            if rv is None:
+                data = request.get_json()
+                user_chat, group_unique_id, history = prepare_chat(data)
+                if group_unique_id is not None:
+                    return None, (user_chat, group_unique_id, history, bool(data.get('stream')))
+                rv = no_data_response(user_chat)
+        except HTTPException as e:
+            rv = flask_app.handle_user_exception(e)
+        response = flask_app.process_response(flask_app.make_response(rv))
+        # レスポンスの本文はここで読み切る（ストリーミングのレスポンスは返さない）
+        response.direct_passthrough = False
+        response.get_data()
+        return response, None
+
+
+async def stream_chat(send, group_unique_id, user_chat, history=None, start=None):
+    # Server-Sent Events 形式でトークンを送り、最後に質問と回答全体を保存する
+    headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+    headers += [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in SSE_HEADERS.items()]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    if start is not None:
+        observe_request(200, time.perf_counter() - start)
+
+    answer_parts = []
+    try:
+        async for token in astream_answer(group_unique_id, user_chat.content, history):
+            answer_parts.append(token)
+            await send_event(send, {'token': token})
+
+        answer = "".join(answer_parts).strip()
+        print(f"Generated answer: {answer}")
+        save_chat_turn(user_chat, answer, history)
+        await send_event(send, {'status': 'success', 'done': True}, more_body=False)
+    except Exception as e:
+        print(f"Error during chat streaming: {e}")
+        save_chats(user_chat)
+        await send_event(send, {'status': 'error', 'message': str(e)}, more_body=False)
+
+
+async def send_event(send, payload, more_body=True):
+    await send({'type': 'http.response.body', 'body': sse_event(payload).encode('utf-8'), 'more_body': more_body})
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin1'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_flask_response(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+app = ChachatASGI(flask_app)
@@ -0,0 +1,147 @@
+import tiktoken
+from langchain.prompts import PromptTemplate
+
+# プロンプトに入れる会話の長さは OpenAI のモデルと同じトークナイザーで数える
+ENCODING_NAME = 'cl100k_base'
+
+SUMMARY_HEADER = '会話の要約:'
+RECENT_HEADER = '直近の会話:'
+ROLE_LABELS = {True: 'User', False: 'Assistant'}
+
+# 会話の履歴があるときの回答のプロンプト（履歴が無いときは langchain の QA のプロンプトをそのまま使う）
+QA_WITH_HISTORY_PROMPT = PromptTemplate.from_template(
+    """Use the following pieces of context and the conversation so far to answer the question at the end. \
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+{context}
+
+{history}
+
+Question: {question}
+Helpful Answer:"""
+)
+
+
+def get_encoding():
+    # tiktoken がエンコーディングをプロセス内で覚えているので、2回目からは読み込まない
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens):
+    # 先頭から max_tokens トークンまでを残す（途中で切れた文字は落とす）
+    tokens = get_encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max(max_tokens, 0)]).rstrip('�')
+
+
+def format_message(is_user_message, content):
+    return f'{ROLE_LABELS[bool(is_user_message)]}: {content}'
+
+
+def message_tokens(is_user_message, content):
+    # 履歴の1行（改行を含む）のトークン数
+    return count_tokens(format_message(is_user_message, content)) + 1
+
+
+def truncate_message(is_user_message, content, max_tokens):
+    # 1行が max_tokens に収まるように本文を切り詰め、(本文, トークン数) を返す
+    # 区切りのトークンがつながって数がずれることがあるので、収まるまで縮める
+    limit = max_tokens - message_tokens(is_user_message, '')
+    while limit > 0:
+        content = truncate_tokens(content, limit)
+        tokens = message_tokens(is_user_message, content)
+        if tokens <= max_tokens:
+            return content, tokens
+        limit -= tokens - max_tokens
+    return '', 0
+
+
+def format_messages(messages):
+    return '\n'.join(format_message(is_user_message, content) for is_user_message, content in messages)
+
+
+class PromptHistory:
+    __slots__ = ('summary', 'messages', 'tokens', 'recent_tokens', 'recent_budget', 'overflow')
+
+    def __init__(self, summary, messages, tokens, recent_tokens, recent_budget, overflow):
+        # summary は要約済みの会話の要約、messages はプロンプトに入れる直近のメッセージ
+        # （(is_user_message, content) を古い順に並べたもの）、tokens は format() のトークン数
+        # recent_budget は直近の会話に使えるトークン数（recent_tokens はそのうち使った分）で、
+        # まだ要約していない会話がそれを超えているときは overflow が True になる
+        self.summary = summary
+        self.messages = messages
+        self.tokens = tokens
+        self.recent_tokens = recent_tokens
+        self.recent_budget = recent_budget
+        self.overflow = overflow
+
+    def __bool__(self):
+        return bool(self.summary or self.messages)
+
+    def needs_summary(self, new_tokens):
+        # 今回の質問と回答（new_tokens）を加えると直近の会話が予算を超えるか
+        return self.overflow or self.recent_tokens + new_tokens > self.recent_budget
+
+    def format(self):
+        parts = []
+        if self.summary:
+            parts.append(f'{SUMMARY_HEADER}\n{self.summary}')
+        if self.messages:
+            parts.append(f'{RECENT_HEADER}\n{format_messages(self.messages)}')
+        return '\n\n'.join(parts)
+
+
+def assemble_history(summary, messages, budget):
+    # 要約と、まだ要約していないメッセージ（古い順）から、budget トークンに収まる履歴を作る
+    # 直近の会話は新しい順に入るだけ入れる（最新のメッセージだけで収まらない場合は先頭を切り詰めて入れる）
+    # 行ごとのトークン数の合計で数えるので、つなげた全体はこれを超えない
+    summary = truncate_tokens(summary, budget // 2) if summary else ''
+    used = count_tokens(f'{SUMMARY_HEADER}\n{summary}\n\n') if summary else 0
+    recent_budget = budget - used - count_tokens(f'{RECENT_HEADER}\n')
+
+    selected = []
+    recent_tokens = 0
+    overflow = False
+    for is_user_message, content in reversed(messages):
+        line_tokens = message_tokens(is_user_message, content)
+        if recent_tokens + line_tokens > recent_budget:
+            overflow = True
+            if not selected:
+                content, line_tokens = truncate_message(is_user_message, content, recent_budget)
+                if content:
+                    selected.append((is_user_message, content))
+                    recent_tokens = line_tokens
+            break
+        selected.append((is_user_message, content))
+        recent_tokens += line_tokens
+    selected.reverse()
+    if selected:
+        used += recent_tokens + count_tokens(f'{RECENT_HEADER}\n')
+    return PromptHistory(summary, selected, used, recent_tokens, recent_budget, overflow)
+
+
+def select_messages_to_summarize(token_counts, keep_tokens, max_tokens):
+    # 古いメッセージから順に、残りが keep_tokens 以下になるまで（1回に max_tokens まで）要約に回す
+    # token_counts はまだ要約していないメッセージ（古い順）のトークン数で、返すのは要約に回すメッセージの数
+    remaining = sum(token_counts)
+    folded = 0
+    count = 0
+    for tokens in token_counts:
+        if remaining <= keep_tokens or (count and folded + tokens > max_tokens):
+            break
+        remaining -= tokens
+        folded += tokens
+        count += 1
+    return count
+
+
+def summarize_messages(llm, summary, messages, max_tokens):
+    # これまでの要約に新しいメッセージを書き足した要約を作る（要約全体を毎回作り直さない）
+    from langchain.memory.prompt import SUMMARY_PROMPT
+    prompt = SUMMARY_PROMPT.format(summary=summary, new_lines=format_messages(messages))
+    return truncate_tokens(llm.invoke(prompt).strip(), max_tokens)
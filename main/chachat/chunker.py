@@ -0,0 +1,141 @@
+import bisect
+import re
+
+import tiktoken
+from langchain.text_splitter import TextSplitter
+
+# 文末（。！？、英文のピリオド）と段落の区切りで文に分ける
+SENTENCE_END = re.compile(r'(?<=[。！？!?])|(?<=\.)\s+|\n{2,}')
+ASCII_WORD = re.compile(r'[A-Za-z0-9]')
+ASCII_TEXT = re.compile(r'[\x21-\x7e]')
+
+
+PDF_LINE_BREAK = re.compile(r'(.)\n(?!\n)(.)')
+
+
+def join_pdf_lines(text):
+    # PDFから取り出したテキストは文の途中で改行されるので、1行の改行はつなげる
+    # 英数字どうしの間だけ空白を入れ、日本語はそのままつなげる
+    return join_pdf_lines_with_map(text)[0]
+
+
+def join_pdf_lines_with_map(text):
+    # つなげた後のテキストと、改行を取り除いた位置（つなげた後のテキストでの位置、昇順）を返す
+    # 空白に置き換えた改行は長さが変わらないので記録しない
+    removed = []
+
+    def replace(match):
+        before, after = match.group(1), match.group(2)
+        if ASCII_WORD.match(before) and ASCII_WORD.match(after):
+            return before + ' ' + after
+        removed.append(match.start(1) + 1 - len(removed))
+        return before + after
+    return PDF_LINE_BREAK.sub(replace, text), removed
+
+
+def join_sentences(sentences):
+    # 英文どうしは空白でつなぎ、日本語はそのままつなげる
+    text = ''
+    for sentence in sentences:
+        if text and ASCII_TEXT.match(text[-1]) and ASCII_TEXT.match(sentence[0]):
+            text += ' '
+        text += sentence
+    return text
+
+
+def split_sentences(text):
+    return [sentence for sentence, _, _ in split_sentence_spans(text)]
+
+
+def split_sentence_spans(text):
+    # (文, 開始位置, 終了位置) を返す。位置は改行をつなげる前の text の中の文字位置
+    joined, removed = join_pdf_lines_with_map(text)
+
+    def original(position):
+        # それより前で取り除いた改行の数だけ後ろにずらす
+        return position + bisect.bisect_right(removed, position)
+
+    spans = []
+    start = 0
+    for separator in list(SENTENCE_END.finditer(joined)) + [None]:
+        end = separator.start() if separator else len(joined)
+        part = joined[start:end]
+        stripped = part.strip()
+        if stripped:
+            offset = start + len(part) - len(part.lstrip())
+            spans.append((stripped, original(offset), original(offset + len(stripped) - 1) + 1))
+        if separator:
+            start = separator.end()
+    return spans
+
+
+# トークン数（tiktoken）で大きさを測り、日本語の文の区切りを守って分割するテキスト分割器
+# 1文がチャンクより長い場合だけトークン単位で切る
+# split_documents にページごとの Document を渡せば、チャンクがページをまたぐことはない
+class SentenceTokenSplitter(TextSplitter):
+    def __init__(self, chunk_size=256, chunk_overlap=32, encoding_name='cl100k_base', **kwargs):
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        super().__init__(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=self.count_tokens,
+            **kwargs,
+        )
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def _split_long_sentence(self, sentence, start, end):
+        # 開始・終了位置はトークンを文字に戻した長さから求める（改行をつなげた分だけずれることがある）
+        tokens = self.encoding.encode(sentence, disallowed_special=())
+        step = self._chunk_size - self._chunk_overlap
+        pieces = []
+        for first in range(0, len(tokens), step):
+            piece = tokens[first:first + self._chunk_size]
+            piece_start = min(start + len(self.encoding.decode(tokens[:first])), end)
+            piece_text = self.encoding.decode(piece)
+            pieces.append((piece_text, len(piece), piece_start, min(piece_start + len(piece_text), end)))
+            if first + self._chunk_size >= len(tokens):
+                break
+        return pieces
+
+    def split_text(self, text):
+        return [chunk for chunk, _, _, _ in self.split_text_with_spans(text)]
+
+    def split_text_with_spans(self, text):
+        # (チャンク, 開始位置, 終了位置, トークン数) を返す。位置は text の中の文字位置
+        units = []
+        for sentence, start, end in split_sentence_spans(text):
+            size = self.count_tokens(sentence)
+            if size > self._chunk_size:
+                units.extend(self._split_long_sentence(sentence, start, end))
+            else:
+                units.append((sentence, size, start, end))
+
+        chunks = []
+        current = []
+        current_size = 0
+        for unit in units:
+            size = unit[1]
+            if current and current_size + size > self._chunk_size:
+                chunks.append(self._make_chunk(current))
+                # 末尾の文を重なりとして次のチャンクに持ち越す
+                overlap = []
+                overlap_size = 0
+                for previous in reversed(current):
+                    if overlap_size + previous[1] > self._chunk_overlap:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_size += previous[1]
+                if overlap_size + size > self._chunk_size:
+                    overlap, overlap_size = [], 0
+                current, current_size = overlap, overlap_size
+            current.append(unit)
+            current_size += size
+        if current:
+            chunks.append(self._make_chunk(current))
+        return chunks
+
+    def _make_chunk(self, units):
+        chunk = join_sentences([unit[0] for unit in units])
+        return chunk, units[0][2], units[-1][3], self.count_tokens(chunk)
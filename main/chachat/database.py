@@ -0,0 +1,52 @@
+import os
+import sqlite3
+
+from sqlalchemy import event
+
+# データベースの接続設定
+# 接続先は環境変数 CHACHAT_DATABASE_URL（または DATABASE_URL）で指定し、無ければ instance フォルダの site.db を使う
+# SQLite は WAL モードにして、読み込みと書き込みが互いに待たないようにする
+# PostgreSQL を使う場合は psycopg2 が必要（pip install psycopg2-binary）
+
+DEFAULT_DATABASE_URI = 'sqlite:///site.db'
+
+
+def database_uri():
+    uri = os.environ.get('CHACHAT_DATABASE_URL') or os.environ.get('DATABASE_URL') or DEFAULT_DATABASE_URI
+    # Heroku などの postgres:// は SQLAlchemy では使えないので書き換える
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite')
+
+
+def engine_options(uri, config):
+    if is_sqlite(uri):
+        # ロックの待ち時間は PRAGMA busy_timeout で設定する（sqlite3 の timeout も同じ値にそろえる）
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000}}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        # サーバー側で切断された接続を使わないよう、一定時間で張り直し、使う前に確認する
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def configure_sqlite(engine, config):
+    # SQLite の接続ごとに PRAGMA を設定する
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(config["SQLITE_BUSY_TIMEOUT_MS"])}')
+        # WAL では NORMAL でも破損はしない（電源断の直前のコミットが失われることがあるだけ）
+        cursor.execute(f'PRAGMA synchronous={config["SQLITE_SYNCHRONOUS"]}')
+        cursor.close()
+    return set_sqlite_pragmas
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain.schema.embeddings import Embeddings
+
+
+# 埋め込みベクトルをローカルのSQLiteに保存するキャッシュ
+# キーは hash(モデル名 + チャンク本文) なので、同じ文章は何度インデックスを作り直しても再計算しない
+class EmbeddingCache:
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' key TEXT PRIMARY KEY,'
+            ' vector BLOB NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' last_used REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)')
+        # 合計の大きさは複数のプロセスから書き込んでもずれないよう、1行の表に持って追加・削除と同じトランザクションで更新する
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache_size ('
+            ' id INTEGER PRIMARY KEY CHECK (id = 0),'
+            ' bytes INTEGER NOT NULL)'
+        )
+        # この表を作る前のキャッシュは、最初に開いたときに一度だけ数える
+        self._conn.execute(
+            'INSERT OR IGNORE INTO cache_size (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM embeddings'
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, model, texts):
+        keys = [self.make_key(model, text) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLiteの変数上限を超えないよう分けて問い合わせる
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                placeholders = ','.join('?' * len(part))
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    'UPDATE embeddings SET last_used = ? WHERE key = ?',
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+
+            results = [found.get(key) for key in keys]
+            hit_count = sum(1 for result in results if result is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            blob = array('f', vector).tobytes()
+            rows.append((self.make_key(model, text), blob, len(blob), now))
+
+        # 合計を読んでから削除するまでの間に、ほかのプロセスが書き込まないよう書き込みのロックを先に取る
+        # （with self._conn で、例外の場合はロールバックする）
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            keys = [row[0] for row in rows]
+            replaced = 0
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                placeholders = ','.join('?' * len(part))
+                replaced += self._conn.execute(
+                    f'SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})', part
+                ).fetchone()[0]
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)', rows
+            )
+            total_bytes = self._add_total_bytes(sum(row[2] for row in rows) - replaced)
+            self._evict(total_bytes)
+
+    def _add_total_bytes(self, delta):
+        self._conn.execute('UPDATE cache_size SET bytes = bytes + ? WHERE id = 0', (delta,))
+        return self._total_bytes()
+
+    def _total_bytes(self):
+        return self._conn.execute('SELECT bytes FROM cache_size WHERE id = 0').fetchone()[0]
+
+    def _evict(self, total_bytes):
+        # 上限を超えたら最後に使われた時刻が古いものから削除する (LRU)
+        while total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                'SELECT key, size FROM embeddings ORDER BY last_used LIMIT 256'
+            ).fetchall()
+            if not rows:
+                self._add_total_bytes(-total_bytes)
+                break
+            removed = []
+            removed_bytes = 0
+            for key, size in rows:
+                removed.append((key,))
+                removed_bytes += size
+                if total_bytes - removed_bytes <= self.max_bytes:
+                    break
+            self._conn.executemany('DELETE FROM embeddings WHERE key = ?', removed)
+            total_bytes = self._add_total_bytes(-removed_bytes)
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': entries,
+                'bytes': self._total_bytes(),
+                'max_bytes': self.max_bytes,
+            }
+
+
+# OpenAIEmbeddings などをラップして、キャッシュに無いテキストだけを問い合わせる
+# on_embed を渡すと、問い合わせるたびに on_embed(問い合わせたテキスト, かかった秒数) を呼ぶ
+class CachedEmbeddings(Embeddings):
+    def __init__(self, underlying, cache, model_name=None, on_embed=None):
+        self.underlying = underlying
+        self.cache = cache
+        self.model_name = model_name or getattr(underlying, 'model', type(underlying).__name__)
+        self.on_embed = on_embed
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        results = self.cache.get_many(self.model_name, texts)
+
+        # 同じ文章が複数回出てくる場合も一度だけ問い合わせる
+        missing = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+        if missing:
+            start = time.perf_counter()
+            vectors = self.underlying.embed_documents(missing)
+            self._embedded(missing, start)
+            self.cache.put_many(self.model_name, missing, vectors)
+            computed = dict(zip(missing, vectors))
+            results = [result if result is not None else computed[text] for text, result in zip(texts, results)]
+        return results
+
+    def embed_query(self, text):
+        result = self.cache.get_many(self.model_name, [text])[0]
+        if result is None:
+            start = time.perf_counter()
+            result = self.underlying.embed_query(text)
+            self._embedded([text], start)
+            self.cache.put_many(self.model_name, [text], [result])
+        return result
+
+    async def aembed_query(self, text):
+        # キャッシュ（ローカルの SQLite）はスレッドで引き、外れた場合だけ API の結果を待つ
+        # （取り込み中は書き込みのロックやキャッシュのロックを待つことがあるので、イベントループでは呼ばない）
+        result = (await asyncio.to_thread(self.cache.get_many, self.model_name, [text]))[0]
+        if result is None:
+            start = time.perf_counter()
+            result = await self.underlying.aembed_query(text)
+            self._embedded([text], start)
+            await asyncio.to_thread(self.cache.put_many, self.model_name, [text], [result])
+        return result
+
+    def _embedded(self, texts, start):
+        if self.on_embed is not None:
+            self.on_embed(texts, time.perf_counter() - start)
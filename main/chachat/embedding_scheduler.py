@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.schema.embeddings import Embeddings
+
+# 優先度（小さいほど先に処理する）
+INTERACTIVE = 0
+BULK = 1
+
+
+def is_rate_limit_error(error):
+    # openai.error.RateLimitError（0.x）や status_code=429 の例外（1.x）を判定する
+    if type(error).__name__ == 'RateLimitError':
+        return True
+    return getattr(error, 'http_status', None) == 429 or getattr(error, 'status_code', None) == 429
+
+
+class _Request:
+    __slots__ = ('results', 'remaining', 'error', 'done', 'callback')
+
+    def __init__(self, size, callback=None):
+        self.results = [None] * size
+        self.remaining = size
+        self.error = None
+        self.done = threading.Event()
+        # 完了時に呼ぶ関数（非同期の呼び出し元に知らせる）
+        self.callback = callback
+
+
+# プロセス内で共有する埋め込みのスケジューラー
+# 同時に届いた複数のリクエストのテキストをまとめて大きなバッチにし、
+# 同時に送るAPIリクエスト数を制限する。429 が返ったらジッター付きで待ってから再送し、
+# その間は新しいバッチも送らない。質問の埋め込み（INTERACTIVE）は取り込み（BULK）より先に送る
+class EmbeddingScheduler:
+    def __init__(self, embed_fn, max_batch_size=256, max_in_flight=4, max_wait=0.01,
+                 max_retries=6, base_delay=1.0, max_delay=30.0):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='embedding')
+        self._paused_until = 0.0
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name='embedding-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def embed(self, texts, priority=BULK):
+        texts = list(texts)
+        if not texts:
+            return []
+        request = _Request(len(texts))
+        self._enqueue(texts, request, priority)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    async def aembed(self, texts, priority=BULK):
+        # 結果を待つ間もスレッドを占有しない（イベントループに完了を知らせてもらう）
+        texts = list(texts)
+        if not texts:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+        request = _Request(len(texts), callback=lambda: loop.call_soon_threadsafe(resolve))
+        self._enqueue(texts, request, priority)
+        await future
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def _enqueue(self, texts, request, priority):
+        with self._cond:
+            for index, text in enumerate(texts):
+                heapq.heappush(self._queue, (priority, next(self._counter), text, request, index))
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            self._cond.notify()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _dispatch_loop(self):
+        while True:
+            # 送信枠が空くまで待つ間にキューにテキストがたまり、バッチが大きくなる
+            self._slots.acquire()
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # 取り込みだけの場合は少しだけ待って、他のリクエストのテキストもまとめる
+                if self._queue[0][0] != INTERACTIVE and len(self._queue) < self.max_batch_size:
+                    self._cond.wait(self.max_wait)
+                batch = [heapq.heappop(self._queue) for _ in range(min(self.max_batch_size, len(self._queue)))]
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        try:
+            # 同じテキストは1回だけ送る
+            unique_texts = list(dict.fromkeys(item[2] for item in batch))
+            attempt = 0
+            while True:
+                try:
+                    vectors = self.embed_fn(unique_texts)
+                    break
+                except Exception as e:
+                    if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                        raise
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                    attempt += 1
+                    with self._stats_lock:
+                        self.rate_limited += 1
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                    time.sleep(delay)
+
+            with self._stats_lock:
+                self.batches += 1
+                self.texts += len(unique_texts)
+            by_text = dict(zip(unique_texts, vectors))
+            for _, _, text, request, index in batch:
+                request.results[index] = by_text[text]
+                self._finish(request)
+        except Exception as e:
+            with self._stats_lock:
+                self.errors += 1
+            for _, _, _, request, _ in batch:
+                request.error = e
+                self._finish(request)
+        finally:
+            self._slots.release()
+
+    def _finish(self, request):
+        with self._stats_lock:
+            request.remaining -= 1
+            if request.remaining <= 0:
+                request.done.set()
+                if request.callback is not None:
+                    request.callback()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'batches': self.batches,
+                'texts': self.texts,
+                'avg_batch_size': self.texts / self.batches if self.batches else 0.0,
+                'rate_limited': self.rate_limited,
+                'errors': self.errors,
+                'queue_depth': self.queue_depth(),
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+
+# スケジューラー経由で埋め込みを作る Embeddings
+class ScheduledEmbeddings(Embeddings):
+    def __init__(self, scheduler, model, priority=BULK):
+        self.scheduler = scheduler
+        self.model = model
+        self.priority = priority
+
+    def embed_documents(self, texts):
+        return self.scheduler.embed(texts, self.priority)
+
+    def embed_query(self, text):
+        # 質問の埋め込みは取り込みより優先する
+        return self.scheduler.embed([text], INTERACTIVE)[0]
+
+    async def aembed_documents(self, texts):
+        return await self.scheduler.aembed(texts, self.priority)
+
+    async def aembed_query(self, text):
+        return (await self.scheduler.aembed([text], INTERACTIVE))[0]
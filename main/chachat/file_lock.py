@@ -0,0 +1,18 @@
+import fcntl
+
+
+# ファイルのロック（fcntl.flock）で、別のプロセスとの同時書き込みを防ぐ
+# flock は開いたファイルごとのロックなので、同じプロセスのスレッドの間の排他は呼び出し側で行う
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
@@ -0,0 +1,29 @@
+# gunicorn で起動する場合の設定
+#   cd main/chachat
+#   gunicorn -c gunicorn.conf.py app:app
+# アプリと langchain などのライブラリをマスターで一度だけ読み込み、fork したワーカーで共有する
+# （ワーカーの起動と最初の質問で読み込みを待たない）
+import os
+
+bind = os.environ.get('CHACHAT_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('CHACHAT_WORKERS', 2))
+threads = int(os.environ.get('CHACHAT_THREADS', 10))
+preload_app = True
+
+
+def when_ready(server):
+    # ワーカーを起動する前にマスターで呼ばれる
+    # 中断された取り込みジョブの再開はスレッドを使うので、マスターでは書き出すだけにする
+    from app import app, create_tables, db, preload_rag, save_interrupted_ingest_jobs
+    create_tables()
+    save_interrupted_ingest_jobs()
+    preload_rag()
+    # マスターで開いたデータベースの接続をワーカーに引き継がない
+    with app.app_context():
+        db.engine.dispose()
+
+
+def post_worker_init(worker):
+    # 中断された取り込みジョブは、最初に起動したワーカーが再投入する
+    from app import claim_interrupted_ingest_jobs
+    claim_interrupted_ingest_jobs()
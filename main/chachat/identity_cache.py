@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+# ログイン中のユーザーやグループの解決結果をプロセス内で一定時間（ttl 秒）覚えておくキャッシュ
+# 値が変わったときは invalidate() で消す。他のプロセスでの変更は ttl が過ぎるまで反映されない
+# 読み込みの途中で invalidate() された場合に古い値を入れないよう、
+# データベースを読む前に token() を取り、put() に渡す
+class IdentityCache:
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def token(self):
+        with self._lock:
+            return self._invalidations
+
+    def get(self, key, default=MISSING):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[1] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, token=None):
+        with self._lock:
+            if token is not None and token != self._invalidations:
+                return
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._invalidations += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self._invalidations,
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,242 @@
+import math
+import os
+import re
+import unicodedata
+from array import array
+from collections import Counter
+
+import numpy as np
+
+# 語の区切り（空白・句読点・記号）で分けた文字の並び
+WORD_PATTERN = re.compile(r'\w+')
+NGRAM_SIZES = (2, 3)
+
+
+def split_words(text):
+    # 全角・半角や大文字・小文字の違いは吸収する
+    return WORD_PATTERN.findall(unicodedata.normalize('NFKC', text).lower())
+
+
+def char_ngrams(text):
+    # 日本語は単語に分けずに文字の bi-gram・tri-gram を語として使う（数字や英単語も同じ）
+    terms = []
+    for word in split_words(text):
+        if len(word) < NGRAM_SIZES[0]:
+            terms.append(word)
+            continue
+        for n in NGRAM_SIZES:
+            terms.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return terms
+
+
+def normalize_text(text):
+    # 語の区切り（空白・句読点・記号）は1つの空白にまとめる
+    return ' '.join(split_words(text))
+
+
+def quoted_length(query, text):
+    # 質問のうち、text にそのまま続けて含まれている最も長い部分の文字数（語の区切りをまたいでよく、区切りは数えない）
+    # 語ごとの一致を足し合わせると、資料に出てくる単語を並べただけの言い換えも引用とみなしてしまう
+    query, text = normalize_text(query), normalize_text(text)
+    best = ''
+    for i in range(len(query)):
+        # best より長く一致する場合だけ伸ばす
+        end = i + len(best) + 1
+        while end <= len(query) and query[i:end] in text:
+            end += 1
+        if end - 1 - i > len(best):
+            best = query[i:end - 1]
+    return len(best.replace(' ', ''))
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    # 複数の検索結果の順位を 1 / (k + 順位) の和でまとめ、まとめた順に並べたキーを返す
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class LexicalResult:
+    __slots__ = ('hits', 'coverage', 'quoted')
+
+    def __init__(self, hits, coverage=0.0, quoted=0):
+        # hits は (chunk_id, BM25 スコア) をスコアの高い順に並べたもの
+        # coverage は資料に出てくる質問の語の IDF の合計のうち、1位のチャンクに含まれる語の割合（0〜1）
+        # quoted は質問のうち、1位のチャンクにそのまま含まれている文字数（quoted_length）
+        # インデックスにはチャンクの本文が無いので、quoted は本文を読み込む呼び出し側で入れる
+        self.hits = hits
+        self.coverage = coverage
+        self.quoted = quoted
+
+
+# グループのチャンクの文字 n-gram の転置インデックス（BM25 で順位を付ける）
+# 取り込みのたびに読み込んで add()・remove_data() で更新し、save() で書き直す
+# 検索だけに使うインスタンスは変更しないので、複数のスレッドから同時に search() してよい
+#
+# 保存した内容（.npz）:
+#   terms / offsets / docs / tfs  語ごとの (チャンクの番号, 出現回数) を語の順に並べたもの
+#   chunk_ids / data_ids / lengths  チャンクの番号ごとの DataChunk.id・Data.id・語の数
+# 読み込んだ後に追加した分は _added に持ち、削除したチャンクは _alive を 0 にしておいて
+# 保存のときに詰める
+class LexicalIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._chunk_ids = array('q')
+        self._data_ids = array('q')
+        self._lengths = array('i')
+        self._alive = bytearray()
+        self._live = 0
+        self._total_length = 0
+        self._rows = {}
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._docs = np.zeros(0, dtype=np.int32)
+        self._tfs = np.zeros(0, dtype=np.uint16)
+        self._added = {}
+
+    def __len__(self):
+        return self._live
+
+    def add(self, chunk_id, data_id, text):
+        counts = Counter(char_ngrams(text))
+        doc = len(self._chunk_ids)
+        length = sum(counts.values())
+        self._chunk_ids.append(chunk_id)
+        self._data_ids.append(data_id)
+        self._lengths.append(length)
+        self._alive.append(1)
+        self._live += 1
+        self._total_length += length
+        for term, tf in counts.items():
+            postings = self._added.get(term)
+            if postings is None:
+                postings = self._added[term] = (array('i'), array('H'))
+            postings[0].append(doc)
+            postings[1].append(min(tf, 0xFFFF))
+
+    def remove_data(self, data_id):
+        removed = 0
+        for doc, doc_data_id in enumerate(self._data_ids):
+            if doc_data_id == data_id and self._alive[doc]:
+                self._alive[doc] = 0
+                self._live -= 1
+                self._total_length -= self._lengths[doc]
+                removed += 1
+        return removed
+
+    def _postings(self, term):
+        row = self._rows.get(term)
+        if row is None:
+            docs, tfs = self._docs[:0], self._tfs[:0]
+        else:
+            start, end = self._offsets[row], self._offsets[row + 1]
+            docs, tfs = self._docs[start:end], self._tfs[start:end]
+        added = self._added.get(term)
+        if added:
+            docs = np.concatenate([docs, np.array(added[0], dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.array(added[1], dtype=np.uint16)])
+        return docs, tfs
+
+    def search(self, query, k=20):
+        terms = set(char_ngrams(query))
+        if not terms or self._live == 0:
+            return LexicalResult([])
+
+        alive = np.array(self._alive, dtype=bool)
+        lengths = np.array(self._lengths, dtype=np.float32)
+        average_length = self._total_length / self._live
+        scores = np.zeros(len(alive), dtype=np.float32)
+        matched = np.zeros(len(alive), dtype=np.float32)
+        total_idf = 0.0
+        for term in terms:
+            docs, tfs = self._postings(term)
+            keep = alive[docs]
+            docs, tfs = docs[keep], tfs[keep].astype(np.float32)
+            df = len(docs)
+            if df == 0:
+                continue
+            idf = math.log(1 + (self._live - df + 0.5) / (df + 0.5))
+            total_idf += idf
+            norm = self.k1 * (1 - self.b + self.b * lengths[docs] / average_length)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+            matched[docs] += idf
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) == 0:
+            return LexicalResult([])
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return LexicalResult([(self._chunk_ids[i], float(scores[i])) for i in top],
+                             float(matched[top[0]]) / total_idf)
+
+    def save(self, path):
+        # 削除したチャンクを詰め、読み込んだ後の追加分とあわせて語の順に並べ直して書き込む
+        alive = np.array(self._alive, dtype=bool)
+        renumber = np.cumsum(alive, dtype=np.int64) - 1
+
+        terms = list(self._rows)
+        term_ids = {term: i for i, term in enumerate(terms)}
+        for term in self._added:
+            if term not in term_ids:
+                term_ids[term] = len(terms)
+                terms.append(term)
+        added_terms = list(self._added)
+        added_counts = [len(self._added[term][0]) for term in added_terms]
+        posting_terms = np.concatenate([
+            np.repeat(np.arange(len(self._rows), dtype=np.int64), np.diff(self._offsets)),
+            np.repeat(np.array([term_ids[term] for term in added_terms], dtype=np.int64), added_counts),
+        ])
+        docs = np.concatenate([self._docs] + [np.array(self._added[term][0], dtype=np.int32) for term in added_terms])
+        tfs = np.concatenate([self._tfs] + [np.array(self._added[term][1], dtype=np.uint16) for term in added_terms])
+
+        keep = alive[docs]
+        posting_terms, docs, tfs = posting_terms[keep], renumber[docs[keep]].astype(np.int32), tfs[keep]
+        order = np.lexsort((docs, posting_terms))
+        posting_terms, docs, tfs = posting_terms[order], docs[order], tfs[order]
+        counts = np.bincount(posting_terms, minlength=len(terms))
+        # 削除で出現しなくなった語は落とす
+        used = counts > 0
+        offsets = np.zeros(int(used.sum()) + 1, dtype=np.int64)
+        np.cumsum(counts[used], out=offsets[1:])
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                terms=np.array([term for term, is_used in zip(terms, used) if is_used], dtype=str),
+                offsets=offsets,
+                docs=docs,
+                tfs=tfs,
+                chunk_ids=np.array(self._chunk_ids, dtype=np.int64)[alive],
+                data_ids=np.array(self._data_ids, dtype=np.int64)[alive],
+                lengths=np.array(self._lengths, dtype=np.int32)[alive],
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        index = cls(**kwargs)
+        with np.load(path) as f:
+            terms = f['terms'].tolist()
+            index._offsets = f['offsets']
+            index._docs = f['docs']
+            index._tfs = f['tfs']
+            index._chunk_ids = array('q', f['chunk_ids'].tobytes())
+            index._data_ids = array('q', f['data_ids'].tobytes())
+            lengths = f['lengths']
+        index._rows = dict(zip(terms, range(len(terms))))
+        index._lengths = array('i', lengths.astype(np.int32).tobytes())
+        index._alive = bytearray(b'\x01' * len(lengths))
+        index._live = len(lengths)
+        index._total_length = int(lengths.sum())
+        return index
+
+    def stats(self):
+        return {
+            'chunks': self._live,
+            'terms': len(self._rows) + sum(1 for term in self._added if term not in self._rows),
+            'postings': len(self._docs) + sum(len(docs) for docs, _ in self._added.values()),
+        }
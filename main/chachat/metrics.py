@@ -0,0 +1,268 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+
+# 処理時間のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+# Prometheus のテキスト形式で出力するカウンターとヒストグラム
+# ラベルの値はラベル名の順に並べたタプルで渡す（記録のたびに辞書を作らない）
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(values, other):
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}'
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # ラベルごとに [区切りごとの件数..., +Inf の件数, 合計] を持つ（出力のときに累積にする）
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: list(series) for labels, series in self._values.items()}
+
+    @staticmethod
+    def merge(values, other):
+        for labels, series in other.items():
+            mine = values.get(labels)
+            values[labels] = list(series) if mine is None else [a + b for a, b in zip(mine, series)]
+
+    def samples(self, values):
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for labels, series in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(self.labelnames, labels, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(series[-1])}'
+            yield f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render(self, snapshots=()):
+        # snapshots はほかのプロセスの snapshot()（MetricsExporter.collect）で、このプロセスの値に足して出力する
+        lines = []
+        for name, metric in self._metrics.items():
+            values = metric.snapshot()
+            for snapshot in snapshots:
+                metric.merge(values, snapshot.get(name, {}))
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type_name}')
+            lines.extend(metric.samples(values))
+        return '\n'.join(lines) + '\n'
+
+
+def dump_snapshot(snapshot):
+    return json.dumps({name: [[list(labels), value] for labels, value in values.items()]
+                       for name, values in snapshot.items()})
+
+
+def load_snapshot(text):
+    return {name: {tuple(labels): value for labels, value in values}
+            for name, values in json.loads(text).items()}
+
+
+# gunicorn などで複数のプロセスに分かれている場合に、どのプロセスの /metrics からも全体の値を返すため、
+# 各プロセスの値を interval 秒ごとに directory/<pid>.json に書き出し、/metrics ではほかのプロセスの分を足す
+# 終了したプロセスのファイルは読み込むときに消す（その分のカウンターは Prometheus からはリセットに見える）
+class MetricsExporter:
+    def __init__(self, registry, directory, interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='metrics-export', daemon=True)
+        self._thread.start()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Error during metrics export: {e}")
+
+    def write(self):
+        tmp_path = self._path(self.pid) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(dump_snapshot(self.registry.snapshot()))
+        os.replace(tmp_path, self._path(self.pid))
+
+    def collect(self):
+        snapshots = []
+        for file_name in os.listdir(self.directory):
+            pid, ext = os.path.splitext(file_name)
+            if ext != '.json' or not pid.isdigit() or int(pid) == self.pid:
+                continue
+            path = os.path.join(self.directory, file_name)
+            if not is_process_alive(int(pid)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(load_snapshot(f.read()))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# 記録するときのラベル（グループとルート）はリクエストごとに bind_labels() で決めておき、
+# 途中の処理ではラベルを受け渡さずに current_labels() で引く
+# （contextvars なので、asyncio のタスクや asyncio.to_thread で呼んだ先にも引き継がれる）
+class MetricLabels:
+    __slots__ = ('group', 'route')
+
+    def __init__(self, route='', group=''):
+        self.route = route
+        self.group = group
+
+
+_labels = contextvars.ContextVar('chachat_metric_labels', default=None)
+
+
+def bind_labels(route, group=''):
+    labels = MetricLabels(route, group or '')
+    _labels.set(labels)
+    return labels
+
+
+def set_group_label(group):
+    labels = _labels.get()
+    if labels is not None:
+        labels.group = group or ''
+
+
+def current_labels():
+    # (group, route) を返す
+    labels = _labels.get()
+    return (labels.group, labels.route) if labels is not None else ('', '')
+
+
+class StageTimer:
+    # with の中の処理時間を (stage, group, route) のヒストグラムに記録し、例外で抜けた場合は errors も数える
+    # （接続が切れてジェネレーターやタスクが止められた場合（GeneratorExit・CancelledError）は数えない）
+    __slots__ = ('histogram', 'errors', 'stage', 'labels', 'start')
+
+    def __init__(self, histogram, errors, stage, labels=None):
+        self.histogram = histogram
+        self.errors = errors
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = (self.stage,) + (self.labels or current_labels())
+        self.histogram.observe(labels, time.perf_counter() - self.start)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.errors.inc(labels)
+
+
+class TimedIterator:
+    # 要素を取り出すのにかかった時間の合計を elapsed に数える（ジェネレーターで読み込む PDF の解析時間など）
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.elapsed += time.perf_counter() - start
@@ -0,0 +1,325 @@
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.vectorstore import VectorStore
+
+from file_lock import FileLock
+
+# 新しいバージョンに既存の行列を何行ずつコピーするか
+APPEND_COPY_ROWS = 4096
+
+
+# NumPy だけで動くベクトルストア
+# 埋め込みは正規化した float32 の .npy 行列としてメモリマップで開くので、
+# 複数のワーカープロセスがOSのページキャッシュを共有できる
+# 検索は行列とベクトルの積1回と argpartition による上位k件の取り出しだけで行う
+#
+# ディレクトリの中身:
+#   CURRENT         現在のバージョンのフォルダ名
+#   v<id>/embeddings.npy  (n, d) float32
+#   v<id>/offsets.npy     (n + 1,) int64  texts.bin 内の各チャンクの開始位置
+#   v<id>/texts.bin       チャンク本文（UTF-8 を連結したもの）
+#   v<id>/metadatas.jsonl 1行に1チャンクのIDとメタデータ
+# 書き込みは新しいバージョンのフォルダを作ってから CURRENT を置き換えるので、
+# 読み込み中のプロセスが書きかけのファイルを見ることはない
+class NumpyVectorStore(VectorStore):
+    def __init__(self, persist_directory=None, embedding_function=None):
+        if persist_directory is None:
+            persist_directory = tempfile.mkdtemp(prefix='numpy_store_')
+        os.makedirs(persist_directory, exist_ok=True)
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self._lock = threading.Lock()
+        self._signature = None
+        self._matrix = None
+        self._offsets = None
+        self._texts = b''
+        self._ids = []
+        self._metadatas = []
+        # bulk_add() の中で書き込み中のバージョン
+        self._bulk = None
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _path(self, name):
+        return os.path.join(self.persist_directory, name)
+
+    def _write_lock(self):
+        # 別プロセスからの同時書き込みを防ぐ
+        return FileLock(self._path('.lock'))
+
+    def _reload_if_changed(self):
+        # 他のプロセスが書き込んだ場合だけ開き直す
+        try:
+            with open(self._path('CURRENT'), encoding='utf-8') as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            version = None
+        if version == self._signature and self._matrix is not None:
+            return
+        with self._lock:
+            if version == self._signature and self._matrix is not None:
+                return
+            if version is None:
+                self._matrix = np.zeros((0, 0), dtype=np.float32)
+                self._offsets = np.zeros(1, dtype=np.int64)
+                self._texts = b''
+                self._ids = []
+                self._metadatas = []
+            else:
+                directory = self._path(version)
+                self._matrix = np.load(os.path.join(directory, 'embeddings.npy'), mmap_mode='r')
+                self._offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+                self._texts = _map_file(os.path.join(directory, 'texts.bin'))
+                with open(os.path.join(directory, 'metadatas.jsonl'), encoding='utf-8') as f:
+                    rows = [json.loads(line) for line in f]
+                self._ids = [row['id'] for row in rows]
+                self._metadatas = [row['metadata'] for row in rows]
+            self._signature = version
+
+    def __len__(self):
+        self._reload_if_changed()
+        return self._matrix.shape[0]
+
+    def _text(self, i):
+        return self._texts[self._offsets[i]:self._offsets[i + 1]].decode('utf-8')
+
+    def _write(self, matrix, ids, texts, metadatas):
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+        version = f'v{uuid.uuid4().hex}'
+        directory = self._path(version)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'texts.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+        with open(os.path.join(directory, 'metadatas.jsonl'), 'w', encoding='utf-8') as f:
+            for row_id, metadata in zip(ids, metadatas):
+                f.write(json.dumps({'id': row_id, 'metadata': metadata}, ensure_ascii=False) + '\n')
+        np.save(os.path.join(directory, 'offsets.npy'), offsets)
+        np.save(os.path.join(directory, 'embeddings.npy'), np.ascontiguousarray(matrix, dtype=np.float32))
+        self._publish(version)
+
+    @contextmanager
+    def bulk_add(self):
+        # この中の追加は1つの新しいバージョンにまとめ、最後に一度だけ CURRENT を置き換える
+        # （既存の行列とテキストのコピーは最初の1回だけなので、何回に分けて追加しても全体の書き込みは増えない）
+        # 書き込み中の内容は CURRENT を置き換えるまでほかのプロセスからは見えない
+        if self._bulk is not None:
+            yield self
+            return
+        with self._write_lock():
+            self._reload_if_changed()
+            self._bulk = self._begin_bulk()
+            try:
+                yield self
+                self._finish_bulk(self._bulk)
+            except BaseException:
+                shutil.rmtree(self._bulk['directory'], ignore_errors=True)
+                raise
+            finally:
+                self._bulk = None
+
+    def _begin_bulk(self):
+        # 現在のバージョンを新しいフォルダに少しずつコピーする（丸ごとメモリに読み込まない）
+        # 行列とオフセットは追記できるよう、ヘッダーの無いファイルに書いておく
+        version = f'v{uuid.uuid4().hex}'
+        directory = self._path(version)
+        os.makedirs(directory)
+        old_count = self._matrix.shape[0]
+        if old_count:
+            previous = self._path(self._signature)
+            shutil.copyfile(os.path.join(previous, 'texts.bin'), os.path.join(directory, 'texts.bin'))
+            shutil.copyfile(os.path.join(previous, 'metadatas.jsonl'), os.path.join(directory, 'metadatas.jsonl'))
+        else:
+            open(os.path.join(directory, 'texts.bin'), 'wb').close()
+            open(os.path.join(directory, 'metadatas.jsonl'), 'w').close()
+        with open(os.path.join(directory, 'embeddings.f32'), 'wb') as f:
+            for start in range(0, old_count, APPEND_COPY_ROWS):
+                f.write(np.ascontiguousarray(self._matrix[start:start + APPEND_COPY_ROWS]).tobytes())
+        with open(os.path.join(directory, 'offsets.i64'), 'wb') as f:
+            f.write(np.ascontiguousarray(self._offsets, dtype=np.int64).tobytes())
+        return {
+            'version': version,
+            'directory': directory,
+            'count': old_count,
+            'dim': self._matrix.shape[1] if old_count else None,
+            'text_bytes': int(self._offsets[-1]),
+        }
+
+    def _stage(self, vectors, ids, texts, metadatas):
+        # 書き込み中のバージョンの各ファイルの末尾に追記する
+        if not texts:
+            return
+        bulk = self._bulk
+        directory = bulk['directory']
+        encoded = [text.encode('utf-8') for text in texts]
+        with open(os.path.join(directory, 'texts.bin'), 'ab') as f:
+            f.write(b''.join(encoded))
+        with open(os.path.join(directory, 'metadatas.jsonl'), 'a', encoding='utf-8') as f:
+            for row_id, metadata in zip(ids, metadatas):
+                f.write(json.dumps({'id': row_id, 'metadata': metadata}, ensure_ascii=False) + '\n')
+        offsets = np.cumsum([len(b) for b in encoded], dtype=np.int64) + bulk['text_bytes']
+        with open(os.path.join(directory, 'offsets.i64'), 'ab') as f:
+            f.write(offsets.tobytes())
+        with open(os.path.join(directory, 'embeddings.f32'), 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        bulk['count'] += len(encoded)
+        bulk['dim'] = vectors.shape[1]
+        bulk['text_bytes'] = int(offsets[-1])
+
+    def _finish_bulk(self, bulk):
+        directory = bulk['directory']
+        if bulk['count'] == self._matrix.shape[0]:
+            # 何も追加しなかった
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+        raw_path = os.path.join(directory, 'embeddings.f32')
+        raw = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(bulk['count'], bulk['dim']))
+        matrix = np.lib.format.open_memmap(
+            os.path.join(directory, 'embeddings.npy'), mode='w+', dtype=np.float32, shape=raw.shape,
+        )
+        for start in range(0, raw.shape[0], APPEND_COPY_ROWS):
+            matrix[start:start + APPEND_COPY_ROWS] = raw[start:start + APPEND_COPY_ROWS]
+        matrix.flush()
+        del matrix, raw
+        os.remove(raw_path)
+        offsets_path = os.path.join(directory, 'offsets.i64')
+        np.save(os.path.join(directory, 'offsets.npy'), np.fromfile(offsets_path, dtype=np.int64))
+        os.remove(offsets_path)
+        self._publish(bulk['version'])
+
+    def _publish(self, version):
+        previous = self._signature
+        with open(self._path('CURRENT.tmp'), 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(self._path('CURRENT.tmp'), self._path('CURRENT'))
+
+        # 古いバージョンは削除する（開いているプロセスのメモリマップはそのまま使える）
+        if previous and os.path.isdir(self._path(previous)):
+            shutil.rmtree(self._path(previous), ignore_errors=True)
+
+    def _all_rows(self):
+        self._reload_if_changed()
+        if self._matrix.shape[0] == 0:
+            return self._matrix, [], [], []
+        texts = [self._text(i) for i in range(self._matrix.shape[0])]
+        return np.asarray(self._matrix), list(self._ids), texts, list(self._metadatas)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = [dict(m) for m in metadatas] if metadatas else [{} for _ in texts]
+        vectors = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        return self.add_embeddings(texts, vectors, metadatas)
+
+    def add_embeddings(self, texts, vectors, metadatas):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        new_ids = [uuid.uuid4().hex for _ in texts]
+        with self.bulk_add():
+            self._stage(vectors, new_ids, list(texts), list(metadatas))
+        return new_ids
+
+    def get(self, where=None):
+        # Chroma の get(where=...) と同じ形で返す（メタデータの完全一致のみ対応）
+        self._reload_if_changed()
+        rows = [i for i, metadata in enumerate(self._metadatas) if _matches(metadata, where)]
+        return {
+            'ids': [self._ids[i] for i in rows],
+            'documents': [self._text(i) for i in rows],
+            'metadatas': [self._metadatas[i] for i in rows],
+        }
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return True
+        # 削除は全体を書き直す（再登録時にしか使わない）
+        remove = set(ids)
+        with self._write_lock():
+            matrix, row_ids, texts, metadatas = self._all_rows()
+            keep = [i for i, row_id in enumerate(row_ids) if row_id not in remove]
+            self._write(matrix[keep], [row_ids[i] for i in keep], [texts[i] for i in keep],
+                        [metadatas[i] for i in keep])
+        return True
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        self._reload_if_changed()
+        matrix = self._matrix
+        if matrix.shape[0] == 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = matrix @ query
+
+        if filter:
+            mask = np.array([_matches(metadata, filter) for metadata in self._metadatas], dtype=bool)
+            scores = np.where(mask, scores, -np.inf)
+            k = min(k, int(mask.sum()))
+        k = min(k, scores.shape[0])
+        if k <= 0:
+            return []
+
+        if k < scores.shape[0]:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(scores.shape[0])
+        top = top[np.argsort(-scores[top])]
+        return [
+            (Document(page_content=self._text(i), metadata=dict(self._metadatas[i])), float(scores[i]))
+            for i in top
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # スコアはコサイン類似度なので 0〜1 に変換する
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, persist_directory=None, **kwargs):
+        store = cls(persist_directory=persist_directory, embedding_function=embedding)
+        store.add_texts(texts, metadatas=metadatas)
+        return store
+
+
+def _map_file(path):
+    if os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _matches(metadata, where):
+    return not where or all(metadata.get(key) == value for key, value in where.items())
+
+
+def vectorstore_class(name):
+    # 設定値からベクトルストアのクラスを選ぶ（'numpy' または 'chroma'）
+    if name == 'numpy':
+        return NumpyVectorStore
+    from langchain.vectorstores import Chroma
+    return Chroma
@@ -0,0 +1,129 @@
+import threading
+
+import aiohttp
+import openai
+import requests
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.llms import OpenAI
+from requests.adapters import HTTPAdapter
+
+# OpenAI API のクライアントをプロセス内で共有する
+# openai 0.x は同期の呼び出しではスレッドごとに requests.Session を作り、
+# 非同期の呼び出しでは毎回 aiohttp.ClientSession を作るため、リクエストのたびに接続（TLS）を張り直していた
+# ここで作った接続プールを openai に渡し、keep-alive の接続を使い回す
+
+
+class _SharedSession(requests.Session):
+    # openai は一定時間ごとにスレッドのセッションを close() するが、共有のプールは閉じない
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class OpenAIClientRegistry:
+    def __init__(self, api_key=None, api_base=None, connect_timeout=10, read_timeout=120,
+                 pool_size=20, keepalive=30):
+        self.api_key = api_key
+        self.api_base = api_base
+        # (接続, 読み込み) のタイムアウト（秒）。非同期の呼び出しでは読み込みの方は全体の時間になる
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+
+        self.session = _SharedSession()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapters = [adapter]
+
+        self._aiohttp_session = None
+        self._lock = threading.Lock()
+        self._clients = {}
+        self.async_requests = 0
+        self.async_connections = 0
+
+    def install(self):
+        # openai モジュールの設定を一度だけ行う（リクエストごとに環境変数を読み直さない）
+        if self.api_key:
+            openai.api_key = self.api_key
+        if self.api_base:
+            openai.api_base = self.api_base
+        openai.requestssession = self.session
+        return self
+
+    def embeddings(self, **kwargs):
+        return self._get('embeddings', kwargs, lambda: OpenAIEmbeddings(
+            openai_api_key=self.api_key, request_timeout=self.timeout, **kwargs))
+
+    def llm(self, streaming=False, **kwargs):
+        kwargs = dict(kwargs, streaming=streaming)
+        return self._get('llm', kwargs, lambda: OpenAI(
+            openai_api_key=self.api_key, request_timeout=self.timeout, **kwargs))
+
+    def _get(self, kind, kwargs, factory):
+        # 同じ設定のラッパーは1つだけ作って使い回す
+        key = (kind, tuple(sorted(kwargs.items())))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = factory()
+            return client
+
+    def use_aiohttp_session(self):
+        # 実行中のタスクで openai の非同期呼び出しが共有の aiohttp セッションを使うようにする
+        # （イベントループの中で呼ぶこと）
+        with self._lock:
+            if self._aiohttp_session is None or self._aiohttp_session.closed:
+                self._aiohttp_session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive),
+                    trace_configs=[self._trace_config()],
+                )
+            session = self._aiohttp_session
+        openai.aiosession.set(session)
+        return session
+
+    def _trace_config(self):
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.async_requests += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.async_connections += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        return trace
+
+    async def aclose(self):
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+
+    def close(self):
+        self.session.shutdown()
+
+    def stats(self):
+        requests_sent = connections = 0
+        for adapter in self._adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        return {
+            'pool_size': self.pool_size,
+            'requests': requests_sent,
+            'connections': connections,
+            'reuse_rate': reuse_rate(requests_sent, connections),
+            'async_requests': self.async_requests,
+            'async_connections': self.async_connections,
+            'async_reuse_rate': reuse_rate(self.async_requests, self.async_connections),
+        }
+
+
+def reuse_rate(requests_sent, connections):
+    # 既存の接続で送ったリクエストの割合
+    return 1 - connections / requests_sent if requests_sent else 0.0
@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+def expand_method(method):
+    # 'scrypt' のような省略形を、ハッシュに保存される形（'scrypt:32768:8:1'）に展開する
+    # （werkzeug の既定値と同じ。起動時に実際にハッシュを計算して調べると scrypt で 0.1 秒ほどかかる）
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = args if args else (2 ** 15, 8, 1)
+        return f'scrypt:{int(n)}:{int(r)}:{int(p)}'
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f"Invalid hash method '{method}'.")
+
+
+# ログイン・登録時のパスワードのハッシュ（scrypt などの重い KDF）を決まった数のスレッドで計算する
+# scrypt・pbkdf2 は計算中に GIL を手放すので、スレッドでも CPU の数まで並列になる
+# 同時に計算する数を workers に抑え（scrypt の既定値は1回に約32MBのメモリを使う）、
+# 待っている数が max_queue を超えたら HashQueueFull を出してすぐに断る
+# workers=0 のときはプールを使わず、呼び出したスレッドでそのまま計算する
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=1, max_queue=64):
+        self.method = method
+        # 'scrypt' のような省略形は 'scrypt:32768:8:1' に展開されて保存されるので、展開した形で比べる
+        self.method_prefix = expand_method(method)
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash') if workers > 0 else None
+        self._lock = threading.Lock()
+        self._depth = 0
+        self.max_depth = 0
+        self.verified = 0
+        self.hashed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.hash_time = 0.0
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method_prefix
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self._executor is not None and self._depth >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HashQueueFull(f'{self._depth} password hashes are already queued')
+            self._depth += 1
+            self.max_depth = max(self.max_depth, self._depth)
+        submitted = time.perf_counter()
+        try:
+            if self._executor is None:
+                started = submitted
+                result = func(*args)
+            else:
+                result, started = self._executor.submit(self._timed, func, args).result()
+            finished = time.perf_counter()
+        finally:
+            with self._lock:
+                self._depth -= 1
+        with self._lock:
+            if func is check_password_hash:
+                self.verified += 1
+            else:
+                self.hashed += 1
+            self.wait_time += started - submitted
+            self.hash_time += finished - started
+        return result
+
+    @staticmethod
+    def _timed(func, args):
+        started = time.perf_counter()
+        return func(*args), started
+
+    def stats(self):
+        with self._lock:
+            done = self.verified + self.hashed
+            return {
+                'method': self.method_prefix,
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'depth': self._depth,
+                'max_depth': self.max_depth,
+                'verified': self.verified,
+                'hashed': self.hashed,
+                'rejected': self.rejected,
+                'avg_wait': self.wait_time / done if done else 0.0,
+                'avg_hash_time': self.hash_time / done if done else 0.0,
+            }
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# PDFのテキスト抽出をページ範囲ごとに複数のプロセスへ分けて行う
+# ページ数が少ないファイルや workers が1以下のときは、これまでどおり1プロセスで順に取り出す
+# pypdf は app の import を遅くしないよう、PDFを開くときに読み込む
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_process_pool(workers):
+    # プロセスプールはワーカー数ごとに1つだけ作って使い回す
+    # スレッドを持つアプリのプロセスから fork しないよう spawn で起動する
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools[workers] = pool
+        return pool
+
+
+def shutdown_process_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _pools.clear()
+
+
+def default_workers():
+    return min(4, os.cpu_count() or 1)
+
+
+def count_pages(file_path):
+    from pypdf import PdfReader
+    return len(PdfReader(file_path).pages)
+
+
+def extract_page_range(file_path, start, end):
+    # ワーカープロセスで実行する。ファイルは各プロセスで開き直す
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    return [reader.pages[page_no].extract_text() for page_no in range(start, end)]
+
+
+def iter_pdf_pages(file_path, workers=1, pages_per_shard=16, min_parallel_pages=64):
+    # ページのテキストをページ順に1つずつ返す
+    # 並列の場合も、先に投入しておくページ範囲はワーカー数の2倍までにしてメモリを抑える
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    total = len(reader.pages)
+    if workers <= 1 or total < min_parallel_pages:
+        for page in reader.pages:
+            yield page.extract_text()
+        return
+    del reader
+
+    # 各ワーカーは開いたファイルのページ一覧を最初に読み込むので、1ワーカーあたり4範囲程度に収める
+    pages_per_shard = max(pages_per_shard, -(-total // (workers * 4)))
+    pool = get_process_pool(workers)
+    shards = deque((start, min(start + pages_per_shard, total)) for start in range(0, total, pages_per_shard))
+    pending = deque()
+    try:
+        while shards or pending:
+            while shards and len(pending) < workers * 2:
+                start, end = shards.popleft()
+                pending.append(pool.submit(extract_page_range, file_path, start, end))
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def load_pdf_documents(path, workers=1, pages_per_shard=16, min_parallel_pages=64):
+    # PyPDFLoader.load_and_split() と同じ Document のリストを返す（URLも指定できる）
+    from langchain.document_loaders import PyPDFLoader
+    from langchain.schema import Document
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    loader = PyPDFLoader(path)
+    if workers <= 1:
+        return loader.load_and_split()
+    # URL の場合 file_path はダウンロード先の一時ファイルなので、PyPDFLoader と同じく元の URL を source にする
+    docs = [
+        Document(page_content=text, metadata={'source': loader.source, 'page': page_no})
+        for page_no, text in enumerate(iter_pdf_pages(loader.file_path, workers, pages_per_shard, min_parallel_pages))
+    ]
+    return RecursiveCharacterTextSplitter().split_documents(docs)
@@ -0,0 +1,101 @@
+import csv
+import io
+import secrets
+import string
+from functools import partial
+
+from sqlalchemy import select
+from werkzeug.security import generate_password_hash
+
+# CSV（mail,password,name）からユーザーをまとめて登録する
+# パスワードのハッシュはプロセスプールで並列に計算し、ユーザーは一意制約に任せてまとめて INSERT する
+# （ID やメールアドレスの重複を事前に問い合わせず、挿入できなかった行だけを調べ直す）
+
+REQUIRED_COLUMNS = ('mail', 'password', 'name')
+ID_CHARACTERS = string.ascii_letters + string.digits
+
+
+def parse_users_csv(text, max_users=None):
+    # 取り込む行と、取り込めない行の (行番号, 理由) を返す。同じメールアドレスは最初の行だけを使う
+    reader = csv.DictReader(io.StringIO(text))
+    missing = [name for name in REQUIRED_COLUMNS if name not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"CSV must have columns: {', '.join(REQUIRED_COLUMNS)} (missing: {', '.join(missing)})")
+
+    rows = []
+    errors = []
+    seen = set()
+    for row in reader:
+        line = reader.line_num
+        mail = (row.get('mail') or '').strip()
+        password = row.get('password') or ''
+        name = (row.get('name') or '').strip()
+        if not mail or not password or not name:
+            errors.append((line, 'mail, password and name are required'))
+        elif '@' not in mail or len(mail) > 120:
+            errors.append((line, f'invalid mail: {mail}'))
+        elif len(name) > 64:
+            errors.append((line, 'name must be 64 characters or less'))
+        elif mail in seen:
+            errors.append((line, f'duplicate mail in CSV: {mail}'))
+        else:
+            seen.add(mail)
+            rows.append({'mail': mail, 'password': password, 'name': name})
+        if max_users is not None and len(rows) > max_users:
+            raise ValueError(f'too many users (max {max_users})')
+    return rows, errors
+
+
+def hash_passwords(passwords, pool=None, workers=1, method='scrypt'):
+    # User.set_password と同じハッシュを返す（method は PASSWORD_HASH_METHOD）
+    if pool is None or workers <= 1 or len(passwords) < 2:
+        return [generate_password_hash(password, method) for password in passwords]
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return list(pool.map(partial(generate_password_hash, method=method), passwords, chunksize=chunksize))
+
+
+def generate_unique_id(length=10):
+    return ''.join(secrets.choice(ID_CHARACTERS) for _ in range(length))
+
+
+def insert_ignoring_conflicts(dialect_name, table):
+    # 一意制約に違反する行は挿入せずに飛ばす INSERT 文
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise ValueError(f'bulk provisioning is not supported on {dialect_name}')
+    return insert(table).on_conflict_do_nothing()
+
+
+def insert_users(connection, table, rows, batch_size=500, max_attempts=5):
+    # rows は password_hash・group_code などを含む辞書（unique_id はここで付ける）
+    # 挿入したメールアドレスと、すでに登録されていたメールアドレスを返す
+    # コミットは呼び出し側で行う（全員を1つのトランザクションで登録する）
+    statement = insert_ignoring_conflicts(connection.dialect.name, table).returning(table.c.mail)
+    inserted = []
+    existing = []
+    pending = rows
+    for _ in range(max_attempts):
+        for row in pending:
+            row['unique_id'] = generate_unique_id()
+        done = set()
+        for start in range(0, len(pending), batch_size):
+            done.update(connection.execute(statement, pending[start:start + batch_size]).scalars())
+        inserted.extend(row['mail'] for row in pending if row['mail'] in done)
+
+        conflicts = [row for row in pending if row['mail'] not in done]
+        if not conflicts:
+            return inserted, existing
+        # 挿入できなかった行のうち、メールアドレスが登録済みのものは飛ばし、残り（ID の重複）は ID を変えて再試行する
+        taken = set()
+        mails = [row['mail'] for row in conflicts]
+        for start in range(0, len(mails), batch_size):
+            taken.update(connection.execute(
+                select(table.c.mail).where(table.c.mail.in_(mails[start:start + batch_size]))).scalars())
+        existing.extend(mail for mail in mails if mail in taken)
+        pending = [row for row in conflicts if row['mail'] not in taken]
+        if not pending:
+            return inserted, existing
+    raise RuntimeError(f'could not generate unique ids for {len(pending)} users')
@@ -8,6 +8,8 @@ function chatToBottom() {
 }
 
 const userText = document.getElementById('chatbot-text');
+// 表示中のチャット（サイドバーで選んだもの）
+const chatPageIndex = Number(document.getElementById('chatbot-ul').dataset.chatPageIndex);
 const chatSubmitBtn = document.getElementById('chatbot-submit');
 
 // --------------------ロボットの投稿--------------------
@@ -26,6 +28,39 @@ function robotOutput(text) {
 
 	// 一番下までスクロール
 	chatToBottom();
+
+	return div;
+}
+
+// --------------------ロボットの投稿（ストリーミング）--------------------
+// Server-Sent Events 形式で届くトークンを吹き出しに順に追加する
+async function robotStreamOutput(response) {
+	const div = robotOutput('');
+	const reader = response.body.getReader();
+	const decoder = new TextDecoder('utf-8');
+	let buffer = '';
+
+	while (true) {
+		const { value, done } = await reader.read();
+		if (done) break;
+		buffer += decoder.decode(value, { stream: true });
+
+		// イベントは空行で区切られている
+		const events = buffer.split('\n\n');
+		buffer = events.pop();
+		for (const event of events) {
+			if (!event.startsWith('data: ')) continue;
+			const data = JSON.parse(event.slice('data: '.length));
+			if (data.token) {
+				div.textContent += data.token;
+				chatToBottom();
+			} else if (data.status === 'success') {
+				console.log('チャットが保存されました');
+			} else if (data.status === 'error') {
+				console.error('チャットの保存に失敗しました:', data.message);
+			}
+		}
+	}
 }
 
 // --------------------自分の投稿（送信ボタンを押した時の処理）--------------------
@@ -50,7 +85,7 @@ chatSubmitBtn.addEventListener('click', () => {
 	div.classList.add('chatbot-right');
 	div.textContent = userText.value;
 
-	// チャットデータをサーバーに送信
+	// チャットデータをサーバーに送信（回答はストリーミングで受け取る）
 	fetch('/save_chat', {
 		method: 'POST',
 		headers: {
@@ -59,22 +94,25 @@ chatSubmitBtn.addEventListener('click', () => {
 		},
 		body: JSON.stringify({
 			content: userText.value,
-			is_user_message: true  // 自分（User）から送ったメッセージであることを識別
+			is_user_message: true,  // 自分（User）から送ったメッセージであることを識別
+			chat_page_index: chatPageIndex,
+			stream: true
 		})
-	}).then(response => response.json())
-		.then(data => {
-			if (data.status === 'success') {
-				console.log('チャットが保存されました');
-				if (data.answer) {
-					// サーバーからの返答を表示
-					robotOutput(data.answer);
-				}
+	}).then(response => {
+		if (response.ok && (response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+			return robotStreamOutput(response);
+		}
+		return response.json().then(data => {
+			if (data.status === 'success' && data.answer) {
+				// サーバーからの返答を表示
+				robotOutput(data.answer);
 			} else {
 				console.error('チャットの保存に失敗しました');
 			}
-		}).catch(error => {
-			console.error('エラーが発生しました:', error);
 		});
+	}).catch(error => {
+		console.error('エラーが発生しました:', error);
+	});
 
 	// 一番下までスクロール
 	chatToBottom();
@@ -83,45 +121,50 @@ chatSubmitBtn.addEventListener('click', () => {
 	userText.value = '';
 });
 
-// --------------------新しいチャットを作成する機能--------------------
-document.getElementById('newChatButton').addEventListener('click', createNewChat);
-
-function createNewChat() {
-	// 新しいチャットの要素を作成
-	const chatList = document.getElementById('chatList');
-	const newChat = document.createElement('div');
-	newChat.className = 'chat-item';
-	newChat.textContent = '新しいチャット ' + (chatList.children.length + 1);
-	chatList.appendChild(newChat);
-
-	// 新しいチャットがクリックされた時のイベントリスナーを追加
-	newChat.addEventListener('click', function () {
-		openChatWindow(newChat.textContent);
-	});
-
-	// クリックされたらチャットウィンドウに内容を表示
-	openChatWindow(newChat.textContent);
-
-	// チャット画面を初期化
-	initializeChat();
-}
+// --------------------過去のチャットの読み込み（上にスクロールした時）--------------------
+let isLoadingHistory = false;
 
-function openChatWindow(chatTitle) {
-	const chatWindow = document.getElementById('chatWindow');
-	chatWindow.style.display = 'block';
-	chatWindow.innerHTML = `<h2>${chatTitle}</h2><p>ここにチャットの内容が表示されます。</p>`;
+function createChatItem(chat) {
+	const side = chat.is_user_message ? 'right' : 'left';
+	const li = document.createElement('li');
+	li.classList.add(side);
+	li.dataset.chatId = chat.id;
+	const div = document.createElement('div');
+	div.classList.add('chatbot-' + side);
+	div.textContent = chat.content;
+	li.appendChild(div);
+	return li;
 }
 
-function initializeChat() {
-	// チャット内容をクリア
+function loadOlderChats() {
 	const ul = document.getElementById('chatbot-ul');
-	ul.innerHTML = '';
+	if (isLoadingHistory || ul.dataset.hasMore !== 'true') return;
 
-	// ユーザーデータをリセット
-	userData = [];
+	const oldest = ul.querySelector('li[data-chat-id]');
+	if (!oldest) return;
 
-	// 初めからロボットのメッセージを表示
-	setTimeout(() => {
-		robotOutput('新しいチャットが始まりました');
-	}, 100); // 少し遅延を入れて確実に表示されるようにする
+	isLoadingHistory = true;
+	fetch(`/chat_history?page=${chatPageIndex}&before=${oldest.dataset.chatId}`)
+		.then(response => response.json())
+		.then(data => {
+			// 追加した分だけスクロール位置をずらして、表示中の位置を保つ
+			const chatField = document.getElementById('chatbot-body');
+			const previousHeight = chatField.scrollHeight;
+			const fragment = document.createDocumentFragment();
+			data.chats.forEach(chat => fragment.appendChild(createChatItem(chat)));
+			ul.insertBefore(fragment, ul.firstChild);
+			chatField.scrollTop += chatField.scrollHeight - previousHeight;
+			ul.dataset.hasMore = data.has_more ? 'true' : 'false';
+		}).catch(error => {
+			console.error('エラーが発生しました:', error);
+		}).finally(() => {
+			isLoadingHistory = false;
+		});
 }
+
+document.getElementById('chatbot-body').addEventListener('scroll', (event) => {
+	if (event.target.scrollTop < 50) loadOlderChats();
+});
+
+// 最初は最新のメッセージを表示する
+chatToBottom();
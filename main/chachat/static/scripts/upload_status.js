@@ -0,0 +1,42 @@
+// --------------------取り込みジョブの進捗表示--------------------
+const statusLabels = {
+	queued: '待機中',
+	parsing: 'ページを解析中',
+	embedding: 'ページを解析・埋め込み中',
+	done: '完了',
+	error: 'エラー'
+};
+
+function renderJobStatus(element, job) {
+	let text = `${job.data_name} (${job.file_name}): ${statusLabels[job.status] || job.status}`;
+	if (job.total_pages) {
+		text += ` ページ ${job.processed_pages}/${job.total_pages}`;
+	}
+	// チャンク数はページを読み進めながら数えるので、完了するまでは件数だけ表示する
+	if (job.total_chunks) {
+		text += ` チャンク ${job.processed_chunks}/${job.total_chunks}`;
+	} else if (job.processed_chunks) {
+		text += ` チャンク ${job.processed_chunks}`;
+	}
+	if (job.error) {
+		text += ` - ${job.error}`;
+	}
+	element.textContent = text;
+}
+
+function pollJobStatus(element) {
+	const jobId = element.dataset.jobId;
+	fetch(`/upload_status/${jobId}`)
+		.then(response => response.json())
+		.then(job => {
+			renderJobStatus(element, job);
+			// 完了するまで1秒ごとに確認する
+			if (job.status !== 'done' && job.status !== 'error') {
+				setTimeout(() => pollJobStatus(element), 1000);
+			}
+		}).catch(error => {
+			console.error('エラーが発生しました:', error);
+		});
+}
+
+document.querySelectorAll('.ingest-job').forEach(pollJobStatus);
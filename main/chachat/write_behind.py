@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import deque
+
+
+# 書き込みを後回しにしてまとめて行うキュー
+# put() はキューに入れてすぐに返り、バックグラウンドのスレッドが件数（max_batch）か
+# 待ち時間（max_delay 秒）のどちらかに達したところで flush_fn にまとめて渡す
+# キューが max_pending 件を超えたときは、呼び出し元のスレッドでその場で書き込む
+class WriteBehindQueue:
+    def __init__(self, flush_fn, max_batch=200, max_delay=0.5, max_pending=10000, max_attempts=3, name='write-behind'):
+        self.flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._first_pending_at = None
+        self._closed = False
+        self.flushes = 0
+        self.written = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, *items):
+        with self._cond:
+            for item in items:
+                self._items.append((item, 0))
+            self.max_depth = max(self.max_depth, len(self._items))
+            overflow = len(self._items) > self.max_pending
+            # 最初の1件で待ち時間を数え始め、件数に達したらすぐに書き込ませる
+            if self._first_pending_at is None or len(self._items) >= self.max_batch:
+                if self._first_pending_at is None:
+                    self._first_pending_at = time.monotonic()
+                self._cond.notify()
+        if overflow or self._closed:
+            self.flush()
+
+    def depth(self):
+        with self._cond:
+            return len(self._items)
+
+    def _take(self):
+        # 呼び出し側で self._cond を取っていること
+        batch = [self._items.popleft() for _ in range(min(self.max_batch, len(self._items)))]
+        self._first_pending_at = time.monotonic() if self._items else None
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.flush_fn([item for item, _ in batch])
+        except Exception as e:
+            print(f"Error during write-behind flush: {e}")
+            retry = [(item, attempts + 1) for item, attempts in batch if attempts + 1 < self.max_attempts]
+            with self._cond:
+                self.failed_flushes += 1
+                self.dropped += len(batch) - len(retry)
+                # 失敗した分は先頭に戻して次の書き込みで再試行する
+                self._items.extendleft(reversed(retry))
+                if retry and self._first_pending_at is None:
+                    self._first_pending_at = time.monotonic()
+            return False
+        with self._cond:
+            self.flushes += 1
+            self.written += len(batch)
+        return True
+
+    def flush(self):
+        # キューにあるものをすべて書き込む（終了時や、直後に読み込む場合に使う）
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = self._take()
+                if not batch or not self._write(batch):
+                    return
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._items) >= self.max_batch:
+                        break
+                    if self._first_pending_at is not None:
+                        remaining = self._first_pending_at + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            with self._flush_lock:
+                with self._cond:
+                    batch = self._take()
+                if batch and not self._write(batch):
+                    # 失敗が続く場合に書き込みを繰り返さないよう少し待つ
+                    time.sleep(self.max_delay)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._items),
+                'max_depth': self.max_depth,
+                'flushes': self.flushes,
+                'written': self.written,
+                'avg_batch_size': self.written / self.flushes if self.flushes else 0.0,
+                'failed_flushes': self.failed_flushes,
+                'dropped': self.dropped,
+            }
@@ -0,0 +1,75 @@
+# 語句の一致だけで検索する（埋め込みを省く）かどうかの判定
+#   cd main && python -m pytest tests
+import os
+import random
+import sys
+import tempfile
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ['CHACHAT_INSTANCE_PATH'] = tempfile.mkdtemp(prefix='chachat-test-')
+os.environ['CHACHAT_VECTOR_STORE'] = 'numpy'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chachat'))
+
+import pytest  # noqa: E402
+
+import app as chachat  # noqa: E402
+from lexical_index import LexicalIndex, quoted_length  # noqa: E402
+
+GROUP = 'test0001'
+WORDS = ['freelance', 'survey', 'remote', 'work', 'income', 'contract', 'skill', 'client',
+         'project', 'hours', 'rate', 'platform', 'growth', 'market', 'report', 'result']
+
+
+def make_chunks():
+    # 英語の単語を並べたページ（benchmarks/pdfgen.py と同じ語）と、設問を書いた日本語のページ
+    rng = random.Random(0)
+    chunks = ['\n'.join(f'Page {page + 1} item {i + 1}: ' + ' '.join(rng.choice(WORDS) for _ in range(8))
+                        for i in range(10))
+              for page in range(20)]
+    chunks.append('問12「副業の有無」では、42.5％が「ある」と回答した。前回の調査から3ポイント上昇している。')
+    return chunks
+
+
+@pytest.fixture(scope='module')
+def group_index():
+    chachat.create_tables()
+    with chachat.app.app_context():
+        db = chachat.db
+        db.session.add(chachat.Group(unique_code=GROUP, mail='test@example.com', name='test', password_hash='x'))
+        data = chachat.Data(GROUP, 'survey.pdf', '', 'survey')
+        db.session.add(data)
+        db.session.flush()
+        lexical = LexicalIndex()
+        for page_no, text in enumerate(make_chunks()):
+            chunk = chachat.DataChunk(data.id, GROUP, page_no, text, 0, len(text), 0)
+            db.session.add(chunk)
+            db.session.flush()
+            lexical.add(chunk.id, data.id, text)
+        db.session.commit()
+        os.makedirs(chachat.get_index_dir(GROUP), exist_ok=True)
+        lexical.save(chachat.get_lexical_index_path(GROUP))
+        chachat.touch_index_version(GROUP)
+        yield
+
+
+def test_quoted_length_spans_word_boundaries():
+    text = '問12「副業の有無」では、42.5％が「ある」と回答した。'
+    assert quoted_length('問12「副業の有無」の結果を教えて', text) == len('問12副業の有無')
+    # 資料に出てくる語でも、続けて含まれていなければ足し合わせない
+    assert quoted_length('hours that people work', 'work on remote hours') == len('hours')
+    assert quoted_length('the remote work income', 'client remote work income rate') == len('remoteworkincome')
+
+
+def test_paraphrase_takes_hybrid_path(group_index):
+    with chachat.app.app_context():
+        lexical = chachat.search_lexical(GROUP, 'what are the hours that the people work?')
+    assert lexical.hits
+    assert lexical.quoted < chachat.app.config['LEXICAL_FAST_PATH_MIN_CHARS']
+    assert not chachat.is_lexical_confident(lexical)
+
+
+def test_quoted_question_takes_lexical_path(group_index):
+    with chachat.app.app_context():
+        lexical = chachat.search_lexical(GROUP, '問12「副業の有無」の結果を教えて')
+        assert chachat.load_chunk_texts([lexical.hits[0][0]], {})[0].startswith('問12')
+    assert chachat.is_lexical_confident(lexical)
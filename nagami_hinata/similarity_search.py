@@ -5,27 +5,33 @@ from split import split_pdf
 import os
 from dotenv import load_dotenv
 from langchain.vectorstores import Chroma
+from langchain.embeddings import CacheBackedEmbeddings
 from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.storage import LocalFileStore
 
 path = "https://blog.freelance-jp.org/wp-content/uploads/2023/03/FreelanceSurvey2023.pdf"
 query = "「フリーランスのリモートワークの実態」について教えて。"
 
-pages = split_pdf(path)
+# split_pdf は複数のプロセスでページを抽出するので、スクリプトの本体はここから実行する
+if __name__ == '__main__':
+    pages = split_pdf(path)
 
-# .envファイルを読み込む
-load_dotenv()
+    # .envファイルを読み込む
+    load_dotenv()
 
-# APIキーの登録が必要
-os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
-openai_api_key = os.environ.get("OPENAI_API_KEY")
+    # APIキーの登録が必要
+    os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
+    openai_api_key = os.environ.get("OPENAI_API_KEY")
 
-# 埋め込みを作成
-embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+    # 埋め込みを作成（一度埋め込んだページは embedding_cache フォルダから読み込み、再計算しない）
+    underlying = OpenAIEmbeddings(openai_api_key=openai_api_key)
+    store = LocalFileStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_cache'))
+    embeddings = CacheBackedEmbeddings.from_bytes_store(underlying, store, namespace=underlying.model)
 
-chroma_index = Chroma.from_documents(pages, embeddings)
+    chroma_index = Chroma.from_documents(pages, embeddings)
 
-docs = chroma_index.similarity_search(query, k=2)
+    docs = chroma_index.similarity_search(query, k=2)
 
-for doc in docs:
-    print(doc.page_content)
-    print()
\ No newline at end of file
+    for doc in docs:
+        print(doc.page_content)
+        print()
\ No newline at end of file
@@ -1,8 +1,35 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 from langchain.document_loaders import PyPDFLoader
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+def extract_page_range(file_path: str, start: int, end: int) -> list:
+    # ワーカープロセスで実行する。ファイルは各プロセスで開き直す
+    reader = PdfReader(file_path)
+    return [reader.pages[page_no].extract_text() for page_no in range(start, end)]
 
-def split_pdf(path: str) -> list:
+def split_pdf(path: str, workers: int = None, pages_per_shard: int = 16) -> list:
+    # ページ数の多いPDFはページ範囲ごとに複数のプロセスで抽出する（workers=1 で従来どおり1プロセス）
+    # 呼び出し側のスクリプトは if __name__ == '__main__': の中で実行すること
+    if workers is None:
+        workers = min(4, os.cpu_count() or 1)
     loader = PyPDFLoader(path)
-    pages = loader.load_and_split()
+    if workers <= 1:
+        return loader.load_and_split()
+
+    # URL の場合 file_path はダウンロード先の一時ファイルなので、source には元の URL を入れる
+    total = len(PdfReader(loader.file_path).pages)
+    ranges = [(start, min(start + pages_per_shard, total)) for start in range(0, total, pages_per_shard)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(extract_page_range, loader.file_path, start, end) for start, end in ranges]
+        texts = [text for future in futures for text in future.result()]
+    docs = [Document(page_content=text, metadata={'source': loader.source, 'page': page_no})
+            for page_no, text in enumerate(texts)]
+    pages = RecursiveCharacterTextSplitter().split_documents(docs)
 
     return pages
 
@@ -11,4 +38,4 @@ def split_pdf(path: str) -> list:
 #     print(page.metadata['source'])
 #     print('--------------------------------------------------')
 #     print(page.page_content)
-#     print('==================================================')
\ No newline at end of file
+#     print('==================================================')